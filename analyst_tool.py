@@ -0,0 +1,57 @@
+# analyst_tool.py
+"""
+Command-line search over the scam intelligence collected by the honeypot.
+
+    python analyst_tool.py search '"gift card" urg*' --type "Romance Scam" --since 2025-01-01
+    python analyst_tool.py search crypto --cursor <next cursor from the previous page>
+    python analyst_tool.py recent --limit 10
+"""
+import argparse
+from database_manager import DatabaseManager, DB_NAME, SEARCH_PAGE_SIZE
+
+
+def print_rows(rows, next_cursor):
+    for row in rows:
+        print(f"[{row['id']}] {row['classification_timestamp']}  {row['scam_type']}  "
+              f"chat {row['chat_id']} ({row['contact_name']})")
+        if row.get('snippet'):
+            print(f"    {row['snippet']}")
+        else:
+            print(f"    Tactic: {row['scammer_tactic']}")
+    if not rows:
+        print("No matching records.")
+    if next_cursor:
+        print(f"\nMore results: --cursor {next_cursor}")
+
+
+def main(args):
+    db_manager = DatabaseManager(args.db, read_pool_size=1)
+    try:
+        if args.command == 'search':
+            rows, next_cursor = db_manager.search_scams(args.query, scam_type=args.type, since=args.since,
+                                                        until=args.until, limit=args.limit, cursor=args.cursor)
+        else:
+            rows, next_cursor = db_manager.search_scams(scam_type=args.type, since=args.since, until=args.until,
+                                                        limit=args.limit, cursor=args.cursor)
+        print_rows(rows, next_cursor)
+    finally:
+        db_manager.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Search the scam intelligence database.")
+    parser.add_argument('--db', default=DB_NAME, help="Database path.")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    search = subparsers.add_parser('search', help="Ranked full-text search (\"phrases\", prefix*).")
+    search.add_argument('query')
+    recent = subparsers.add_parser('recent', help="Newest records first.")
+    for subparser in (search, recent):
+        subparser.add_argument('--type', help="Only this scam_type.")
+        subparser.add_argument('--since', help="Classified at or after this ISO date/time.")
+        subparser.add_argument('--until', help="Classified before this ISO date/time.")
+        subparser.add_argument('--limit', type=int, default=SEARCH_PAGE_SIZE, help="Results per page.")
+        subparser.add_argument('--cursor', help="Cursor printed by the previous page.")
+    try:
+        main(parser.parse_args())
+    except ValueError as e:
+        parser.error(str(e))
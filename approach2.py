@@ -1,18 +1,24 @@
 
 # approach_merged.py
 
+import time
+_import_started = time.perf_counter()  # Start-up is timed from here (see StartupTimer in main)
 import asyncio
-import joblib
-import pandas as pd
 from telethon import TelegramClient, events
 from collections import defaultdict
 import logging
 import os
 import json
 from datetime import datetime, timezone
-from llm_interaction import GeminiLLM, OllamaLLM
+from llm_interaction import (GeminiLLM, OllamaLLM, OllamaChatSession, LLMResponseCache, close_sessions, SENTENCE_END,
+                             any_of, stop_after_words, stop_at_sentence_end)
 from database_manager import DatabaseManager
 from llm_analyzer import LLMAnalyzer
+from chat_scheduler import ChatScheduler, OVERFLOW_BLOCK
+from inference_executor import ClassificationExecutor, MODE_THREAD
+from state_store import ConversationStateStore, STATE_DB_PATH
+from metrics import registry as metrics, start_exporters, StartupTimer
+from profiling import HandlerProfiler
 
 # --- LLM Backend Configuration ---
 LLM_BACKEND = 'ollama'  # Options: 'ollama' or 'gemini'
@@ -29,6 +35,15 @@ SENTIMENT_MODEL_PATH = 'sentiment_model.joblib'
 CONVERSATION_LENGTH_THRESHOLD = 10  # Initial classification after this many total messages
 BENIGN_RECHECK_INTERVAL = 15       # Recheck benign chats every X total messages after initial classification
 
+# --- Scheduling Configuration ---
+MAX_CONCURRENT_CHATS = 32           # Chats handled in parallel
+MAX_QUEUE_DEPTH = 20                # Pending messages per chat before the overflow policy applies
+QUEUE_OVERFLOW = OVERFLOW_BLOCK     # 'block' (backpressure) or 'drop_oldest'
+STAGE_LIMITS = {'llm': 8, 'classification': 4, 'db': 2}
+CLASSIFY_MODE = MODE_THREAD         # 'thread' or 'process' (workers preload spaCy and the models)
+CLASSIFY_WORKERS = 4
+CLASSIFY_TIMEOUT = 30               # Seconds
+
 # --- Weighted Voting Configuration ---
 WEIGHT_MAIN_MODEL = 0.50
 WEIGHT_KEYWORD_RULE = 0.40
@@ -41,6 +56,14 @@ BENIGN_SAVE_FOLDER = 'BENIGN_FOR_TRAINING/'
 
 # --- LLM Configuration ---
 GEMINI_API_KEY = "your_api_key" # Only needed if using Gemini
+STREAM_REPLIES = True   # Stream persona replies and send at the first sentence boundary
+PERSONA_MAX_WORDS = 15  # Generation is cut off once the reply reaches this many words
+OLLAMA_CHAT_SESSIONS = True     # Ollama replies see the chat's earlier turns (token-budgeted window)
+# Response caching (llm_cache.db): identical prompts are answered from the cache instead of the LLM
+CACHE_ANALYSIS = False          # Scam analyses of an identical conversation
+ANALYSIS_CACHE_TTL = 30 * 24 * 3600
+CACHE_REPLIES = False           # Persona replies to an identical message (e.g. templated openers)
+REPLY_CACHE_TTL = 24 * 3600
 MISTRAL_SYSTEM_PROMPT = """
 You are playing the role of a young, naive, and curious person. You are easily impressed, especially by promises of easy money or romance.
 
@@ -62,27 +85,93 @@ Your goal is to play along with potential scammers, making them believe you are
 Your entire purpose is to gather intelligence by convincingly playing the part of a naive victim.
 """
 
+# --- Metrics Configuration ---
+METRICS_PORT = 9108             # Prometheus endpoint on 127.0.0.1 (None disables it)
+METRICS_DUMP_PATH = None        # e.g. 'honeypot_metrics.prom', rewritten every METRICS_DUMP_INTERVAL seconds
+METRICS_DUMP_INTERVAL = 15
+
+# --- Profiling Configuration ---
+# Off unless PROFILE_EVERY=N is set (cProfile every Nth message) or SIGUSR1 toggles it at runtime.
+PROFILE_DIR = 'profiles/approach2'
+
 # --- Feature Extraction & Dependencies ---
 try:
-    from feature_extractor import process_chat_history_for_features
-    import spacy
-    nlp = spacy.load("en_core_web_sm")
-except (ImportError, OSError) as e:
+    from feature_extractor import ChatFeatureAccumulator, load_ner_model
+except ImportError as e:
     print(f"❌ Error loading dependencies: {e}. Please ensure 'feature_extractor.py' and 'spacy' are available.")
     exit()
+# The spaCy pipeline; main() loads it in the background while Telegram connects
+nlp = None
 
 # --- Logging ---
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
 # --- Globals ---
 conversation_history = defaultdict(list)
+# Running feature state per chat, kept in step with conversation_history
+feature_accumulators = {}
 # Tracks conversations that were initially benign and are now being passively monitored
 # Stores {chat_id: {'last_benign_check_length': total_messages_at_last_benign_check}}
 monitored_conversations = {}
+# Durable copy of the above, so a restart resumes in-progress engagements (opened in main)
+state_store = None
+
+# --- Metrics ---
+# Gauges over the live state are registered in main(), once it exists.
+MESSAGE_SECONDS = metrics.histogram('honeypot_message_seconds', "Time to handle one incoming message, end to end.")
+STAGE_SECONDS = metrics.histogram('honeypot_stage_seconds', "Time spent in each step of handling a message.",
+                                  ('stage',))
+CLASSIFICATIONS = metrics.counter('honeypot_classifications_total', "Conversations classified, by result.",
+                                  ('result',))
+LLM_ERRORS = metrics.counter('honeypot_llm_errors_total', "LLM calls that failed or returned no usable text.",
+                             ('call',))
 
 
 # --- Helper Functions ---
 
+def append_to_history(chat_id, message, me_id, persist=True):
+    """Appends a message to the chat history, its incremental feature state and the state store."""
+    conversation_history[chat_id].append(message)
+    if chat_id not in feature_accumulators:
+        feature_accumulators[chat_id] = ChatFeatureAccumulator(me_id, nlp)
+    feature_accumulators[chat_id].append(message)
+    if persist and state_store is not None:
+        state_store.append_message(chat_id, message)
+
+def clear_history(chat_id):
+    """Drops the stored history and feature state for a chat, in memory and on disk."""
+    conversation_history.pop(chat_id, None)
+    feature_accumulators.pop(chat_id, None)
+    monitored_conversations.pop(chat_id, None)
+    if state_store is not None:
+        state_store.clear_chat(chat_id)
+
+def set_monitored(chat_id, checkpoint):
+    """Records a benign classification checkpoint for a chat."""
+    monitored_conversations[chat_id] = checkpoint
+    state_store.set_state(chat_id, 'monitored', checkpoint)
+
+async def restore_chat(chat_id, me_id):
+    """Reloads a chat saved by an earlier run the first time it is seen after a restart."""
+    if state_store.is_restored(chat_id):
+        # Only a chat's first message since start-up needs to go to SQLite.
+        return
+    restored = await asyncio.to_thread(state_store.restore_chat, chat_id)
+    if not restored:
+        return
+    messages, state = restored
+    for message in messages:
+        append_to_history(chat_id, message, me_id, persist=False)
+    if 'monitored' in state:
+        monitored_conversations[chat_id] = state['monitored']
+    if messages:
+        logging.info(f"Restored {len(messages)} messages for chat {chat_id} from the state store.")
+
+def seed_chat_session(session, history):
+    """Replays earlier messages of a chat into a new OllamaChatSession."""
+    for message in history:
+        session.add_turn('assistant' if message['sender_type'] == 'user' else 'user', str(message['text']))
+
 def is_recent_id(user_id: int) -> int:
     """
     Checks if a Telegram user ID is likely to be recent based on its starting digits.
@@ -92,6 +181,27 @@ def is_recent_id(user_id: int) -> int:
     # This logic is based on observations of newer Telegram account IDs.
     return 1 if str(user_id).startswith(('74', '75', '76', '77', '78', '79')) else 0
 
+def trim_persona_reply(text, max_words=PERSONA_MAX_WORDS):
+    """Cuts a reply at its first sentence boundary (see SENTENCE_END) and at max_words words."""
+    match = SENTENCE_END.search(text)
+    if match:
+        text = text[:match.end()]
+    return " ".join(text.split()[:max_words])
+
+async def stream_persona_reply(client, chat_id, llm, prompt):
+    """
+    Streams a persona reply while Telegram shows 'typing', stopping generation at
+    the first sentence boundary or PERSONA_MAX_WORDS, whichever comes first.
+    """
+    stop_when = any_of(stop_at_sentence_end(), stop_after_words(PERSONA_MAX_WORDS))
+    # A chat session records the trimmed reply that is sent, not the whole stream.
+    options = {'final_text': trim_persona_reply} if isinstance(llm, OllamaChatSession) else {}
+    tokens = []
+    async with client.action(chat_id, 'typing'):
+        async for token in llm.astream_response(prompt, MISTRAL_SYSTEM_PROMPT, stop_when=stop_when, **options):
+            tokens.append(token)
+    return trim_persona_reply("".join(tokens))
+
 def save_chat_for_retraining(chat_id, history, contact_name, me_user, target_folder):
     """Saves the conversation history to the specified folder for retraining."""
     timestamp = datetime.now(timezone.utc).strftime("%Y%m%d_%H%M%S")
@@ -114,25 +224,60 @@ def save_chat_for_retraining(chat_id, history, contact_name, me_user, target_fol
 
 # --- Main Application Logic ---
 
-async def main():
-    # Load all models and artifacts
+async def load_models(startup):
+    """
+    Loads spaCy and the classifiers off the event loop and returns the
+    ClassificationExecutor. main() shuts the honeypot down if this fails.
+    """
+    global nlp
     logging.info("Loading models...")
     try:
-        main_pipeline = joblib.load(MAIN_MODEL_PATH)
-        sentiment_model = joblib.load(SENTIMENT_MODEL_PATH)
-        logging.info("Main model and sentiment model loaded successfully.")
+        with startup.phase('spacy'):
+            nlp = await asyncio.to_thread(load_ner_model)
+        # Chats that arrived while spaCy was loading
+        for accumulator in list(feature_accumulators.values()):
+            accumulator.nlp_model = nlp
+        with startup.phase('models'):
+            classifier = await asyncio.to_thread(
+                ClassificationExecutor,
+                {'main': MAIN_MODEL_PATH, 'sentiment': SENTIMENT_MODEL_PATH},
+                mode=CLASSIFY_MODE, max_workers=CLASSIFY_WORKERS, timeout=CLASSIFY_TIMEOUT, nlp_model=nlp,
+                stage_histogram=STAGE_SECONDS
+            )
+            await classifier.warm_up()
     except Exception as e:
         logging.error(f"❌ Model loading failed: {e}. Please ensure model files are present.")
-        return
+        raise
+    startup.mark('ready')
+    logging.info(f"Main model and sentiment model loaded successfully. Start-up: {startup.summary()}")
+    return classifier
+
+async def main(client=None):
+    """Runs the honeypot; client replaces the TelegramClient (e.g. replay_harness.FakeTelegramClient)."""
+    global state_store
+    startup = StartupTimer(_import_started, metrics.gauge('honeypot_startup_seconds',
+                                                          "Seconds each start-up phase took.", ('phase',)))
+    startup.mark('imports')
+    for path in (MAIN_MODEL_PATH, SENTIMENT_MODEL_PATH):
+        if not os.path.exists(path):
+            logging.error(f"❌ Model file not found at '{path}'. Please ensure model files are present.")
+            return
 
-    client = TelegramClient(SESSION_NAME, API_ID, API_HASH)
+    if client is None:
+        client = TelegramClient(SESSION_NAME, API_ID, API_HASH)
 
-    # Initialize Database Manager
+    # Initialize Database Manager (writes are queued and committed in batches off the event loop)
     db_manager = DatabaseManager()
 
+    # Optional LLM response caches
+    analysis_cache = LLMResponseCache('analysis', ttl=ANALYSIS_CACHE_TTL) if CACHE_ANALYSIS else None
+    reply_cache = LLMResponseCache('reply', ttl=REPLY_CACHE_TTL) if CACHE_REPLIES else None
+    caches = [cache for cache in (analysis_cache, reply_cache) if cache is not None]
+
     # Initialize LLM Analyzer
     try:
-        llm_analyzer_instance = LLMAnalyzer(LLM_BACKEND, GEMINI_API_KEY if LLM_BACKEND == 'gemini' else None)
+        llm_analyzer_instance = LLMAnalyzer(LLM_BACKEND, GEMINI_API_KEY if LLM_BACKEND == 'gemini' else None,
+                                            cache=analysis_cache)
         logging.info("LLM Analyzer initialized.")
     except ValueError as e:
         logging.error(f"❌ Error initializing LLM Analyzer: {e}")
@@ -140,54 +285,82 @@ async def main():
 
     # Initialize LLM based on the chosen backend
     if LLM_BACKEND == 'gemini':
-        llm_instances = defaultdict(lambda: GeminiLLM(model_name="gemini-1.5-flash", api_key=GEMINI_API_KEY))
+        llm_instances = defaultdict(lambda: GeminiLLM(model_name="gemini-1.5-flash", api_key=GEMINI_API_KEY,
+                                                      cache=reply_cache))
         logging.info("Using Gemini as the LLM backend.")
     elif LLM_BACKEND == 'ollama':
-        llm_instances = defaultdict(lambda: OllamaLLM(model_name="mistral"))
+        ollama_class = OllamaChatSession if OLLAMA_CHAT_SESSIONS else OllamaLLM
+        llm_instances = defaultdict(lambda: ollama_class(model_name="mistral", cache=reply_cache))
         logging.info("Using Ollama (Mistral) as the LLM backend.")
     else:
         logging.error(f"❌ Invalid LLM_BACKEND: '{LLM_BACKEND}'. Please choose 'ollama' or 'gemini'.")
         return
 
-    await client.start()
-    me = await client.get_me()
+    state_store = ConversationStateStore(STATE_DB_PATH)
+
+    # Messages get persona replies while the models warm up; only classification waits for them.
+    models = asyncio.create_task(load_models(startup))
+
+    with startup.phase('telegram'):
+        await client.start()
+        me = await client.get_me()
+    if models.done() and models.exception() is not None:
+        # Loading failed while Telegram connected; don't answer anyone without the classifiers.
+        await client.disconnect()
+        state_store.close()
+        db_manager.close()
+        for cache in caches:
+            cache.close()
+        return
     logging.info(f"Logged in as {me.first_name}. Auto-reply and data collection mode is active.")
 
-    @client.on(events.NewMessage(incoming=True))
     async def handle_new_message(event):
-        if not event.is_private:
-            return
-
+        """Handles one message; the scheduler runs at most one of these per chat at a time."""
         chat_id = event.chat_id
-        sender = await event.get_sender()
+        with STAGE_SECONDS.time(stage='get_sender'):
+            sender = await event.get_sender()
+        with STAGE_SECONDS.time(stage='restore'):
+            await restore_chat(chat_id, me.id)
 
         # 1. Append incoming message to history
-        conversation_history[chat_id].append({
+        append_to_history(chat_id, {
             'date': event.message.date,
             'text': str(event.message.text),
             'sender_id': sender.id,
             'sender_type': 'contact'
-        })
+        }, me.id)
 
         # 2. Generate and send an LLM reply ONLY if not in monitored_conversations
         if chat_id not in monitored_conversations:
             try:
+                new_session = chat_id not in llm_instances
                 current_llm = llm_instances[chat_id]
-                llm_response = current_llm.generate_response(prompt=event.message.text, system_prompt=MISTRAL_SYSTEM_PROMPT)
+                if new_session and isinstance(current_llm, OllamaChatSession):
+                    # After a restart, pick up the conversation where it left off.
+                    seed_chat_session(current_llm, conversation_history[chat_id][:-1])
+                async with scheduler.stage('llm'):
+                    with STAGE_SECONDS.time(stage='llm_reply'):
+                        if STREAM_REPLIES:
+                            llm_response = await stream_persona_reply(client, chat_id, current_llm, event.message.text)
+                        else:
+                            llm_response = await current_llm.agenerate_response(prompt=event.message.text, system_prompt=MISTRAL_SYSTEM_PROMPT)
 
                 if llm_response and not llm_response.startswith("Error:"):
-                    await client.send_message(chat_id, llm_response)
+                    with STAGE_SECONDS.time(stage='send'):
+                        await client.send_message(chat_id, llm_response)
                     logging.info(f"🗣️ LLM replied to {sender.first_name} (Chat ID: {chat_id})")
 
                     # Append the LLM's reply to the history
-                    conversation_history[chat_id].append({
+                    append_to_history(chat_id, {
                         'date': datetime.now(timezone.utc), 'text': llm_response,
                         'sender_id': me.id, 'sender_type': 'user'
-                    })
+                    }, me.id)
                 else:
+                    LLM_ERRORS.inc(call='reply')
                     logging.error(f"❌ LLM failed to generate a valid response for {chat_id}")
 
             except Exception as e:
+                LLM_ERRORS.inc(call='reply')
                 logging.error(f"🔥 LLM interaction failed for {chat_id}: {e}", exc_info=True)
         else:
             logging.info(f"Monitoring chat {chat_id} with {sender.first_name}. LLM replies suspended.")
@@ -208,14 +381,16 @@ async def main():
                 perform_classification = True
 
         if perform_classification:
-            features_df = process_chat_history_for_features(conversation_history[chat_id], me.id, sender.id, nlp)
+            classifier = await models
+            async with scheduler.stage('classification'):
+                with STAGE_SECONDS.time(stage='classification'):
+                    features_df, votes = await classifier.classify(feature_accumulators[chat_id],
+                                                                   {'id_is_recent': is_recent_id(sender.id)})
 
             if features_df is not None:
-                features_df['id_is_recent'] = is_recent_id(sender.id)
-
                 # --- WEIGHTED VOTE PREDICTION LOGIC ---
-                pred_main = main_pipeline.predict(features_df)[0]
-                pred_sentiment = sentiment_model.predict(features_df[['sentiment_escalation']])[0]
+                pred_main = votes['main']
+                pred_sentiment = votes['sentiment']
                 ratio = features_df['keyword_ratio'].iloc[0]
                 pred_keyword = 1 if ratio > KEYWORD_RATIO_THRESHOLD else 0
 
@@ -224,6 +399,7 @@ async def main():
                                  (pred_keyword * WEIGHT_KEYWORD_RULE)
 
                 final_prediction = 1 if weighted_score >= 0.5 else 0
+                CLASSIFICATIONS.inc(result='honeytrap' if final_prediction == 1 else 'benign')
 
                 result_text = 'Honeytrap (1)' if final_prediction == 1 else 'Benign (0)'
                 logging.warning(
@@ -235,45 +411,52 @@ async def main():
                 # --- Action based on final prediction ---
                 if final_prediction == 1: # Honeytrap
                     target_folder = HONEYTRAP_SAVE_FOLDER
-                    save_chat_for_retraining(chat_id, conversation_history[chat_id], sender.first_name, me, target_folder)
+                    async with scheduler.stage('db'):
+                        with STAGE_SECONDS.time(stage='save_json'):
+                            save_chat_for_retraining(chat_id, conversation_history[chat_id], sender.first_name, me, target_folder)
 
                     # Perform LLM Analysis and Save to Database
                     logging.info(f"Initiating detailed LLM analysis for potential honeytrap with {sender.first_name}.")
-                    analysis_results = await llm_analyzer_instance.extract_and_summarize_scam(conversation_history[chat_id])
+                    async with scheduler.stage('llm'):
+                        with STAGE_SECONDS.time(stage='llm_analysis'):
+                            analysis_results = await llm_analyzer_instance.extract_and_summarize_scam(conversation_history[chat_id])
 
                     if analysis_results:
                         try:
-                            db_manager.insert_scam_data(
-                                chat_id=chat_id,
-                                contact_name=sender.first_name,
-                                scam_type=analysis_results.get('scam_type', 'N/A'),
-                                scammer_tactic=analysis_results.get('scammer_tactic', 'N/A'),
-                                red_flags_identified=analysis_results.get('red_flags_identified', 'N/A'),
-                                extracted_details=json.dumps(analysis_results.get('extracted_details', [])), # Store as JSON string
-                                hacker_strategy_summary=analysis_results.get('hacker_strategy_summary', 'N/A')
-                            )
+                            async with scheduler.stage('db'):
+                                with STAGE_SECONDS.time(stage='db_insert'):
+                                    db_manager.insert_scam_data(
+                                        chat_id=chat_id,
+                                        contact_name=sender.first_name,
+                                        scam_type=analysis_results.get('scam_type', 'N/A'),
+                                        scammer_tactic=analysis_results.get('scammer_tactic', 'N/A'),
+                                        red_flags_identified=analysis_results.get('red_flags_identified', 'N/A'),
+                                        extracted_details=json.dumps(analysis_results.get('extracted_details', [])), # Store as JSON string
+                                        hacker_strategy_summary=analysis_results.get('hacker_strategy_summary', 'N/A')
+                                    )
                             logging.info(f"✅ Extracted scam data for {sender.first_name} saved to database.")
                         except Exception as db_e:
                             logging.error(f"❌ Error saving extracted scam data to database: {db_e}")
                     else:
+                        LLM_ERRORS.inc(call='analysis')
                         logging.warning(f"Could not perform LLM analysis for chat {chat_id}.")
 
-                    # Clear history and LLM instance for honeytraps
-                    del conversation_history[chat_id]
+                    # Clear history, monitoring state and LLM instance for honeytraps
+                    clear_history(chat_id)
                     if chat_id in llm_instances:
                         del llm_instances[chat_id]
-                    if chat_id in monitored_conversations: # Remove from monitored if it was reclassified as honeytrap
-                        del monitored_conversations[chat_id]
                     logging.info(f"History for honeytrap chat {chat_id} has been saved and cleared.")
 
                 else: # Benign
                     target_folder = BENIGN_SAVE_FOLDER
-                    save_chat_for_retraining(chat_id, conversation_history[chat_id], sender.first_name, me, target_folder)
+                    async with scheduler.stage('db'):
+                        with STAGE_SECONDS.time(stage='save_json'):
+                            save_chat_for_retraining(chat_id, conversation_history[chat_id], sender.first_name, me, target_folder)
 
                     # Set up for re-monitoring or update last check length
-                    monitored_conversations[chat_id] = {
+                    set_monitored(chat_id, {
                         'last_benign_check_length': current_total_length
-                    }
+                    })
                     if chat_id not in monitored_conversations: # If it's the first time marking as benign
                         logging.info(f"Chat {chat_id} with {sender.first_name} classified as Benign. Suspending LLM replies and entering monitoring mode for re-evaluation every {BENIGN_RECHECK_INTERVAL} messages.")
                     else: # If it was already monitored and re-classified as benign
@@ -281,27 +464,84 @@ async def main():
 
 
             else:
+                CLASSIFICATIONS.inc(result='failed')
                 logging.error(f"Could not extract features for classification of chat {chat_id}. History will not be saved.")
                 # If feature extraction fails, still clear history to prevent infinite loop
-                if chat_id in conversation_history:
-                    del conversation_history[chat_id]
+                clear_history(chat_id)
                 if chat_id in llm_instances:
                     del llm_instances[chat_id]
-                if chat_id in monitored_conversations:
-                    del monitored_conversations[chat_id]
 
 
-    logging.info("Listening for new messages...")
-    await client.run_until_disconnected()
+    async def timed_handler(event):
+        with MESSAGE_SECONDS.time():
+            await handle_new_message(event)
+
+    profiler = HandlerProfiler.from_env(
+        PROFILE_DIR,
+        chat_size=lambda event: len(conversation_history.get(event.chat_id, ())),
+        memory_probes={
+            'conversation_history': lambda: {'chats': len(conversation_history),
+                                             'messages': sum(map(len, list(conversation_history.values())))},
+            'llm_instances': lambda: {'instances': len(llm_instances),
+                                      'history_turns': sum(len(getattr(llm, 'history', ()))
+                                                           for llm in list(llm_instances.values()))},
+        })
+    profiler.install_signal_handler()
+
+    scheduler = ChatScheduler(profiler.wrap(timed_handler), max_concurrent_chats=MAX_CONCURRENT_CHATS,
+                              max_queue_depth=MAX_QUEUE_DEPTH, overflow=QUEUE_OVERFLOW,
+                              stage_limits=STAGE_LIMITS)
+
+    metrics.gauge('honeypot_active_chats', "Chats with a message queued or being handled.",
+                  callback=lambda: scheduler.active_chats)
+    metrics.gauge('honeypot_tracked_chats', "Chats whose history is held in memory.",
+                  callback=lambda: len(conversation_history))
+    metrics.gauge('honeypot_history_messages', "Messages held in memory across all chat histories.",
+                  callback=lambda: sum(map(len, list(conversation_history.values()))))
+    metrics.gauge('honeypot_llm_sessions', "Per-chat LLM instances held in memory.",
+                  callback=lambda: len(llm_instances))
+    metrics.counter('honeypot_dropped_messages_total', "Messages dropped because their chat's queue was full.",
+                    callback=lambda: scheduler.dropped)
+    metrics.counter('honeypot_llm_cache_hits_total', "LLM responses answered from the response cache.", ('cache',),
+                    callback=lambda: {(cache.namespace,): cache.hits for cache in caches})
+    start_exporters(metrics, METRICS_PORT, METRICS_DUMP_PATH, METRICS_DUMP_INTERVAL)
+
+    @client.on(events.NewMessage(incoming=True))
+    async def on_new_message(event):
+        if not event.is_private:
+            return
+        # Messages are queued per chat: ordered within a chat, parallel across chats.
+        await scheduler.submit(event.chat_id, event)
+
+    def stop_if_models_failed(task):
+        if not task.cancelled() and task.exception() is not None:
+            asyncio.ensure_future(client.disconnect())
+
+    # A later loading failure disconnects the client, which ends run_until_disconnected().
+    models.add_done_callback(stop_if_models_failed)
+    startup.mark('listening')
+    logging.info(f"Listening for new messages ({startup.phases['listening']:.2f}s after start-up)...")
+    try:
+        await client.run_until_disconnected()
+    finally:
+        await scheduler.close()
+        profiler.disable()
+        if models.done() and not models.cancelled() and models.exception() is None:
+            models.result().close()
+        else:
+            models.cancel()
+        await close_sessions()
+        state_store.close()
+        db_manager.close()
+        for cache in caches:
+            logging.info(f"LLM {cache.namespace} cache: {cache.stats()}")
+            cache.close()
+        metrics.close()
 
 if __name__ == "__main__":
     # A simple check for placeholder credentials
     if 'YOUR_API_ID' in API_ID or 'YOUR_API_HASH' in API_HASH:
         logging.error("🚨 Please replace 'YOUR_API_ID' and 'YOUR_API_HASH' in the script before running.")
     else:
-        db_manager = None
-        try:
-            asyncio.run(main())
-        finally:
-            if 'db_manager' in locals() and db_manager:
-                db_manager.close()
+        # main() closes the database manager on shutdown, committing any queued writes.
+        asyncio.run(main())
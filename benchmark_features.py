@@ -0,0 +1,273 @@
+# benchmark_features.py
+"""
+Micro-benchmarks for feature_extractor.py.
+
+Times process_chat_history_for_features and each calculate_*_features
+function on synthetic chats of different sizes and contact/user message
+mixes. Each case records wall time (min and median over several runs),
+the peak and retained memory traced by tracemalloc, and how much of the
+time went to VADER (polarity_scores) and spaCy (nlp.pipe). The sentiment and
+MONEY caches are cleared before every run unless --warm-cache is given, so
+the numbers reflect first-time scoring.
+
+Results are written as JSON. Given --baseline, every case is compared with
+the same case in an earlier results file and the script exits with status 1
+if any case's best time got slower than --threshold times the baseline.
+
+    python benchmark_features.py --output bench.json
+    python benchmark_features.py --sizes 10 100 1000 --baseline bench.json --output bench_new.json
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+import statistics
+import subprocess
+import tracemalloc
+from datetime import datetime, timedelta, timezone
+
+import feature_extractor
+from feature_extractor import (process_chat_history_for_features, prepare_chat_frame, calculate_behavioral_features,
+                               calculate_linguistic_features, calculate_keyword_category_features,
+                               calculate_graph_proxy_features, sentiment_service, entity_service, load_ner_model)
+
+# --- Configuration ---
+CHAT_SIZES = [10, 100, 1_000, 10_000, 100_000]
+CONTACT_SHARES = [0.2, 0.5, 0.8]    # Fraction of messages sent by the contact
+MAX_REPEATS = 7
+TIME_BUDGET = 2.0                   # Seconds of timed runs per case, beyond the first run
+REGRESSION_THRESHOLD = 1.25         # Slower than this many times the baseline is a regression
+NOISE_FLOOR = 0.0005                # Seconds; differences below this are never regressions
+USER_ID = 1_000_000_001
+CONTACT_ID = 7_400_000_002
+
+WORDS = ("hey how are you doing today lol ok sure what then and so really wow nice tell me more "
+         "send money bank transfer crypto investment profit guarantee urgent now quick hurry fee cash "
+         "lonely trust secret love desperate easy money get rich risk-free huge return wire today").split()
+AMOUNTS = ["$500", "$ 1,200", "Rs. 5000", "25 lakhs", "100 dollars", "$49.99"]
+
+
+# --- Synthetic Chats ---
+def make_history(n_messages, contact_share, seed=0):
+    """A reproducible chat of n_messages in the history_list format, with timing gaps from seconds to days."""
+    rnd = random.Random(seed)
+    date = datetime(2025, 1, 1, 9, tzinfo=timezone.utc)
+    history = []
+    for _ in range(n_messages):
+        date += timedelta(seconds=rnd.choice((5, 30, 90, 600, 4_000, 30_000, 90_000)))
+        words = rnd.choices(WORDS, k=rnd.randint(2, 16))
+        if rnd.random() < 0.15:
+            words.insert(rnd.randrange(len(words) + 1), rnd.choice(AMOUNTS))
+        text = " ".join(words) + rnd.choice(("", "", "?", "!", " 😂"))
+        sender = CONTACT_ID if rnd.random() < contact_share else USER_ID
+        history.append({'date': date.isoformat(), 'text': text, 'sender_id': sender})
+    return history
+
+
+# --- Instrumentation ---
+class _Stopwatch:
+    def __init__(self):
+        self.seconds = 0.0
+
+
+class _TimedAnalyzer:
+    """Wraps a VADER analyzer, adding the time spent in polarity_scores to a stopwatch."""
+
+    def __init__(self, analyzer, stopwatch):
+        self._analyzer = analyzer
+        self._stopwatch = stopwatch
+
+    def polarity_scores(self, text):
+        start = time.perf_counter()
+        try:
+            return self._analyzer.polarity_scores(text)
+        finally:
+            self._stopwatch.seconds += time.perf_counter() - start
+
+
+class _TimedNLP:
+    """Wraps a spaCy pipeline, adding the time spent producing docs from pipe() to a stopwatch."""
+
+    def __init__(self, nlp, stopwatch):
+        self._nlp = nlp
+        self._stopwatch = stopwatch
+
+    def __getattr__(self, name):
+        return getattr(self._nlp, name)
+
+    def pipe(self, texts, **kwargs):
+        docs = self._nlp.pipe(texts, **kwargs)
+        while True:
+            start = time.perf_counter()
+            try:
+                doc = next(docs)
+            except StopIteration:
+                return
+            finally:
+                self._stopwatch.seconds += time.perf_counter() - start
+            yield doc
+
+
+def _reset_caches():
+    sentiment_service.clear()
+    entity_service.clear()
+
+
+# --- Cases ---
+def benchmark_cases(nlp_model):
+    """(name, setup(history) -> args, run(*args)) for every benchmarked function."""
+    frame = lambda history: (prepare_chat_frame(history, USER_ID),)
+    return [
+        ('process_chat_history_for_features', lambda history: (history,),
+         lambda history: process_chat_history_for_features(history, USER_ID, CONTACT_ID, nlp_model)),
+        ('calculate_behavioral_features', frame,
+         lambda df_chat: calculate_behavioral_features(df_chat, USER_ID, CONTACT_ID)),
+        ('calculate_linguistic_features', frame,
+         lambda df_chat: calculate_linguistic_features(df_chat, nlp_model)),
+        ('calculate_keyword_category_features', frame, calculate_keyword_category_features),
+        ('calculate_graph_proxy_features', frame, calculate_graph_proxy_features),
+    ]
+
+
+def run_case(run, args, warm_cache, max_repeats, time_budget, vader, spacy_time):
+    """Times run(*args); returns the case's measurements."""
+    times, vader_times, spacy_times = [], [], []
+    while len(times) < max_repeats and (len(times) < 2 or sum(times[1:]) < time_budget):
+        if not warm_cache:
+            _reset_caches()
+        vader.seconds = spacy_time.seconds = 0.0
+        start = time.perf_counter()
+        run(*args)
+        times.append(time.perf_counter() - start)
+        vader_times.append(vader.seconds)
+        spacy_times.append(spacy_time.seconds)
+        if len(times) == 1 and times[0] > time_budget:
+            break
+
+    # One extra, untimed run under tracemalloc, which slows allocation-heavy code a lot.
+    if not warm_cache:
+        _reset_caches()
+    tracemalloc.start()
+    before, _ = tracemalloc.get_traced_memory()
+    run(*args)
+    after, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    median = statistics.median(times)
+    vader_median = statistics.median(vader_times)
+    spacy_median = statistics.median(spacy_times)
+    return {
+        'repeats': len(times),
+        'min_s': min(times),
+        'median_s': median,
+        'vader_s': vader_median,
+        'spacy_s': spacy_median,
+        'vader_share': vader_median / median if median else 0.0,
+        'spacy_share': spacy_median / median if median else 0.0,
+        'alloc_peak_bytes': peak - before,
+        'alloc_retained_bytes': after - before,
+    }
+
+
+def run_benchmarks(nlp_model, sizes=CHAT_SIZES, contact_shares=CONTACT_SHARES, functions=None, warm_cache=False,
+                   max_repeats=MAX_REPEATS, time_budget=TIME_BUDGET, seed=0):
+    vader, spacy_time = _Stopwatch(), _Stopwatch()
+    sentiment_service._analyzer = _TimedAnalyzer(sentiment_service.analyzer, vader)
+    timed_nlp = _TimedNLP(nlp_model, spacy_time)
+    results = []
+    for name, setup, run in benchmark_cases(timed_nlp):
+        if functions and name not in functions:
+            continue
+        for size in sizes:
+            for share in contact_shares:
+                args = setup(make_history(size, share, seed))
+                result = {'function': name, 'messages': size, 'contact_share': share}
+                result.update(run_case(run, args, warm_cache, max_repeats, time_budget, vader, spacy_time))
+                results.append(result)
+                print(f"{name:<36} {size:>7} msgs  contact {share:.0%}  "
+                      f"median {result['median_s'] * 1000:10.2f} ms  "
+                      f"VADER {result['vader_share']:4.0%}  spaCy {result['spacy_share']:4.0%}  "
+                      f"peak {result['alloc_peak_bytes'] / 1024:10.0f} KiB")
+    sentiment_service._analyzer = sentiment_service._analyzer._analyzer
+    return results
+
+
+# --- Comparison ---
+def _case_key(result):
+    return (result['function'], result['messages'], result['contact_share'])
+
+
+def compare_to_baseline(results, baseline_results, threshold=REGRESSION_THRESHOLD, noise_floor=NOISE_FLOOR):
+    """
+    Returns the cases whose best time got slower than threshold x the baseline's.
+    The minimum is compared rather than the median as it is the least affected
+    by other load on the machine.
+    """
+    baseline = {_case_key(result): result for result in baseline_results}
+    regressions = []
+    for result in results:
+        before = baseline.get(_case_key(result))
+        if before is None:
+            continue
+        ratio = result['min_s'] / before['min_s'] if before['min_s'] else float('inf')
+        if ratio > threshold and result['min_s'] - before['min_s'] > noise_floor:
+            regressions.append({**dict(zip(('function', 'messages', 'contact_share'), _case_key(result))),
+                                'baseline_s': before['min_s'], 'current_s': result['min_s'],
+                                'ratio': ratio})
+    return regressions
+
+
+def _git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the feature extraction functions.")
+    parser.add_argument('--sizes', type=int, nargs='+', default=CHAT_SIZES, help="Messages per chat.")
+    parser.add_argument('--contact-shares', type=float, nargs='+', default=CONTACT_SHARES,
+                        help="Fractions of messages sent by the contact.")
+    parser.add_argument('--functions', nargs='+', help="Only these functions (default: all).")
+    parser.add_argument('--warm-cache', action='store_true', help="Keep the sentiment/MONEY caches between runs.")
+    parser.add_argument('--repeats', type=int, default=MAX_REPEATS, help="Maximum timed runs per case.")
+    parser.add_argument('--spacy-model', default=feature_extractor.SPACY_MODEL_NAME, help="spaCy model name or path.")
+    parser.add_argument('--output', default='feature_benchmarks.json', help="Results file.")
+    parser.add_argument('--baseline', help="Earlier results file to check for regressions.")
+    parser.add_argument('--threshold', type=float, default=REGRESSION_THRESHOLD,
+                        help="Slowdown ratio that counts as a regression.")
+    args = parser.parse_args()
+
+    nlp = load_ner_model(args.spacy_model)
+    results = run_benchmarks(nlp, args.sizes, args.contact_shares, args.functions, args.warm_cache, args.repeats)
+    report = {
+        'meta': {
+            'commit': _git_commit(),
+            'timestamp': datetime.now(timezone.utc).isoformat(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'spacy_model': args.spacy_model,
+            'warm_cache': args.warm_cache,
+        },
+        'results': results,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"\nResults written to '{args.output}'.")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare_to_baseline(results, baseline['results'], args.threshold)
+        for regression in regressions:
+            print(f"REGRESSION {regression['function']} ({regression['messages']} msgs, "
+                  f"contact {regression['contact_share']:.0%}): {regression['baseline_s'] * 1000:.2f} ms -> "
+                  f"{regression['current_s'] * 1000:.2f} ms ({regression['ratio']:.2f}x)")
+        if regressions:
+            sys.exit(1)
+        print(f"No regressions against '{args.baseline}' (commit {baseline['meta'].get('commit')}).")
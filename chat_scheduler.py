@@ -0,0 +1,111 @@
+# chat_scheduler.py
+"""
+Per-chat serialized work queues with bounded cross-chat concurrency.
+
+Every chat gets its own FIFO queue, drained by at most one worker task, so
+messages from one chat are handled strictly in arrival order and that chat's
+state is never touched by two handlers at once. Different chats run in
+parallel up to a global limit, and named stage semaphores cap how many
+handlers may be inside an expensive stage (LLM, classification, DB) at once.
+"""
+import asyncio
+import logging
+from collections import deque
+from contextlib import asynccontextmanager
+
+# --- Defaults ---
+MAX_CONCURRENT_CHATS = 32
+MAX_QUEUE_DEPTH = 20
+OVERFLOW_BLOCK = 'block'              # submit() waits for room: backpressure
+OVERFLOW_DROP_OLDEST = 'drop_oldest'  # the oldest queued item is discarded
+DEFAULT_STAGE_LIMITS = {'llm': 8, 'classification': 4, 'db': 2}
+
+
+class _ChatQueue:
+    __slots__ = ('items', 'not_full', 'worker')
+
+    def __init__(self):
+        self.items = deque()
+        self.not_full = asyncio.Event()
+        self.not_full.set()
+        self.worker = None
+
+
+class ChatScheduler:
+    """Runs handler(item) for each submitted item, ordered per chat_id."""
+
+    def __init__(self, handler, max_concurrent_chats=MAX_CONCURRENT_CHATS, max_queue_depth=MAX_QUEUE_DEPTH,
+                 overflow=OVERFLOW_BLOCK, stage_limits=None):
+        if overflow not in (OVERFLOW_BLOCK, OVERFLOW_DROP_OLDEST):
+            raise ValueError(f"Unsupported overflow policy: {overflow}")
+        self.handler = handler
+        self.max_queue_depth = max_queue_depth
+        self.overflow = overflow
+        self._slots = asyncio.Semaphore(max_concurrent_chats)
+        self._stages = {name: asyncio.Semaphore(limit)
+                        for name, limit in (stage_limits or DEFAULT_STAGE_LIMITS).items()}
+        self._queues = {}
+        self.dropped = 0
+
+    @asynccontextmanager
+    async def stage(self, name):
+        """Limits how many handlers are inside the named stage at once; unknown stages are unlimited."""
+        semaphore = self._stages.get(name)
+        if semaphore is None:
+            yield
+            return
+        async with semaphore:
+            yield
+
+    def queue_depth(self, chat_id):
+        queue = self._queues.get(chat_id)
+        return len(queue.items) if queue else 0
+
+    @property
+    def active_chats(self):
+        return len(self._queues)
+
+    async def submit(self, chat_id, item):
+        """Queues item for chat_id, applying the overflow policy when the queue is full."""
+        queue = self._queues.get(chat_id)
+        if queue is None:
+            queue = self._queues[chat_id] = _ChatQueue()
+
+        while len(queue.items) >= self.max_queue_depth:
+            if self.overflow == OVERFLOW_DROP_OLDEST:
+                queue.items.popleft()
+                self.dropped += 1
+                logging.warning(f"Queue for chat {chat_id} is full; dropped its oldest pending message.")
+                break
+            queue.not_full.clear()
+            await queue.not_full.wait()
+            # The worker may have finished and removed the queue while we waited.
+            queue = self._queues.setdefault(chat_id, queue)
+
+        queue.items.append(item)
+        if queue.worker is None:
+            queue.worker = asyncio.create_task(self._drain(chat_id, queue))
+
+    async def _drain(self, chat_id, queue):
+        try:
+            while queue.items:
+                item = queue.items.popleft()
+                queue.not_full.set()
+                async with self._slots:
+                    try:
+                        await self.handler(item)
+                    except Exception as e:
+                        logging.error(f"Handler failed for chat {chat_id}: {e}", exc_info=True)
+        finally:
+            queue.worker = None
+            if not queue.items and self._queues.get(chat_id) is queue:
+                del self._queues[chat_id]
+            queue.not_full.set()
+
+    async def close(self):
+        """Cancels all workers; queued items are discarded."""
+        workers = [queue.worker for queue in self._queues.values() if queue.worker is not None]
+        for worker in workers:
+            worker.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+        self._queues.clear()
@@ -2,92 +2,237 @@
 import os
 import glob
 import json
+import argparse
+from concurrent.futures import ProcessPoolExecutor
 import pandas as pd
-import spacy
-from feature_extractor import process_chat_history_for_features, is_recent_id
+from feature_extractor import process_many_chat_histories, is_recent_id, sentiment_service, entity_service, load_ner_model
+from feature_cache import FeatureCache, content_hash
 
-def main():
+# --- Configuration ---
+DATA_MAP = {
+    'benign_chats': 0,
+    'honeypot_chats': 1
+}
+OUTPUT_CSV = 'training_data.csv'
+DEFAULT_SHARD_SIZE = 64
+
+def load_chat_export(file_path):
     """
-    Finds chat files, robustly processes them using the main feature extractor,
-    and creates a master training CSV.
+    Reads one chat export and returns (history_list, user_id, contact_id).
+    Raises ValueError with the reason if the file cannot be used.
     """
-    print("Loading spaCy model...")
-    nlp = spacy.load("en_core_web_sm")
+    with open(file_path, 'rb') as f:
+        return parse_chat_export(f.read())
 
-    all_chat_features = []
-    data_map = {
-        'benign_chats': 0,
-        'honeypot_chats': 1
+def parse_chat_export(raw):
+    """Same as load_chat_export, for the raw bytes of an export."""
+    try:
+        data = json.loads(raw.decode('utf-8'))
+    except (json.JSONDecodeError, UnicodeDecodeError):
+        raise ValueError("Invalid JSON format.")
+
+    user_info = data.get('user_info')
+    history_list = data.get('messages')
+
+    if not user_info or not isinstance(history_list, list):
+        raise ValueError("JSON is missing 'user_info' or 'messages' list.")
+
+    user_id = user_info.get('id')
+    if not user_id:
+        raise ValueError("'id' not found in 'user_info'.")
+
+    contact_id = data.get('chat_id')
+    if not contact_id or contact_id == user_id:
+        found_id = None
+        for msg in history_list:
+            sender = msg.get('from_id') or msg.get('peer_id', {}).get('user_id')
+            if sender and sender != user_id:
+                found_id = sender
+                break
+        contact_id = found_id
+
+    if contact_id is None:
+        raise ValueError("Could not determine contact_id.")
+    return history_list, user_id, contact_id
+
+# --- Worker State ---
+# Each worker process (or the main process in serial mode) loads spaCy and VADER
+# at most once, and only when a shard contains a file missing from the cache.
+_nlp = None
+_cache = None
+
+def init_worker(cache_path=None):
+    global _cache
+    if cache_path:
+        _cache = FeatureCache(cache_path, read_only=True)
+
+def _get_nlp():
+    global _nlp
+    if _nlp is None:
+        _nlp = load_ner_model()
+        sentiment_service.analyzer
+    return _nlp
+
+def _cache_counters():
+    return {
+        'sentiment': sentiment_service.stats(),
+        'ner': entity_service.stats(),
     }
 
-    for folder, label in data_map.items():
-        print(f"\nProcessing folder: '{folder}' with label: {label}")
-        json_files = glob.glob(os.path.join(folder, '*.json'))
+def process_shard(shard):
+    """
+    Extracts features for a list of (file_path, label) pairs.
+    Returns (rows, log_lines, cache_deltas, new_entries) with rows in input
+    order; new_entries maps content hashes to freshly extracted rows for the
+    feature cache. A file that fails is logged and skipped without losing the
+    rest of the shard.
+    """
+    before = _cache_counters()
+    log_lines = []
+    raw_files = {}
+    for file_path, _ in shard:
+        try:
+            with open(file_path, 'rb') as f:
+                raw_files[file_path] = f.read()
+        except OSError as e:
+            log_lines.append(f"  - ERROR reading {os.path.basename(file_path)}: {e}")
+    hashes = {file_path: content_hash(raw) for file_path, raw in raw_files.items()}
+    cached = _cache.get_many(set(hashes.values())) if _cache is not None else {}
 
-        if not json_files:
-            print(f"  - No JSON files found in '{folder}'.")
+    chats = []
+    labels = {}
+    contact_ids = {}
+    for file_path, label in shard:
+        if file_path not in raw_files:
+            continue
+        filename = os.path.basename(file_path)
+        labels[file_path] = label
+        if hashes[file_path] in cached:
+            log_lines.append(f"  - {filename}: cached")
+            continue
+        log_lines.append(f"  - Analyzing {filename}...")
+        try:
+            history_list, user_id, contact_id = parse_chat_export(raw_files[file_path])
+        except ValueError as e:
+            log_lines.append(f"  - Skipping {filename}: {e}")
+            continue
+        except Exception as e:
+            log_lines.append(f"  - ERROR processing {filename}: {e}")
             continue
+        chats.append((file_path, history_list, user_id, contact_id))
+        contact_ids[file_path] = contact_id
 
-        for file_path in json_files:
-            filename = os.path.basename(file_path)
-            print(f"  - Analyzing {filename}...")
-            try:
-                with open(file_path, 'r', encoding='utf-8') as f:
-                    data = json.load(f)
-                
-                user_info = data.get('user_info')
-                history_list = data.get('messages')
-
-                if not user_info or not isinstance(history_list, list):
-                    print(f"  - Skipping {filename}: JSON is missing 'user_info' or 'messages' list.")
-                    continue
-                
-                user_id = user_info.get('id')
-                if not user_id:
-                    print(f"  - Skipping {filename}: 'id' not found in 'user_info'.")
-                    continue
-
-                contact_id = data.get('chat_id')
-                if not contact_id or contact_id == user_id:
-                    found_id = None
-                    for msg in history_list:
-                        sender = msg.get('from_id') or msg.get('peer_id', {}).get('user_id')
-                        if sender and sender != user_id:
-                            found_id = sender
-                            break
-                    contact_id = found_id
-
-                if contact_id is None:
-                    print(f"  - Skipping {filename}: Could not determine contact_id.")
-                    continue
-
-                features_df = process_chat_history_for_features(
-                    history_list=history_list,
-                    user_id=user_id,
-                    contact_id=contact_id,
-                    nlp_model=nlp
-                )
-
-                if features_df is not None:
-                    features = features_df.to_dict('records')[0]
-                    features['id_is_recent'] = is_recent_id(contact_id)
-                    features['label'] = label
-                    all_chat_features.append(features)
-
-            except json.JSONDecodeError:
-                print(f"  - Skipping {filename}: Invalid JSON format.")
-            except Exception as e:
-                print(f"  - ERROR processing {filename}: {e}")
+    features_df = pd.DataFrame()
+    if chats:
+        try:
+            features_df = process_many_chat_histories(chats, _get_nlp())
+        except Exception:
+            # Fall back to one chat at a time to isolate the file that broke the batch.
+            frames = []
+            for chat in chats:
+                try:
+                    frames.append(process_many_chat_histories([chat], _get_nlp()))
+                except Exception as e:
+                    log_lines.append(f"  - ERROR processing {os.path.basename(chat[0])}: {e}")
+            features_df = pd.concat(frames) if frames else pd.DataFrame()
+
+    extracted = {}
+    new_entries = {}
+    for file_path, features in zip(features_df.index, features_df.to_dict('records')):
+        features['id_is_recent'] = is_recent_id(contact_ids[file_path])
+        extracted[file_path] = features
+        new_entries[hashes[file_path]] = features
+
+    rows = []
+    for file_path, _ in shard:
+        features = extracted.get(file_path) or cached.get(hashes.get(file_path))
+        if features is not None:
+            rows.append({**features, 'label': labels[file_path]})
+
+    after = _cache_counters()
+    deltas = {
+        name: {key: after[name][key] - before[name][key] for key in ('hits', 'misses')}
+        for name in after
+    }
+    return rows, log_lines, deltas, new_entries
+
+def collect_files():
+    """Returns [(file_path, label)] in a deterministic order."""
+    files = []
+    for folder, label in DATA_MAP.items():
+        json_files = sorted(glob.glob(os.path.join(folder, '*.json')))
+        print(f"Folder '{folder}' (label {label}): {len(json_files)} JSON files.")
+        files.extend((file_path, label) for file_path in json_files)
+    return files
+
+def main(workers=1, shard_size=DEFAULT_SHARD_SIZE, output_filename=OUTPUT_CSV, use_cache=True):
+    """
+    Finds chat files, robustly processes them using the main feature extractor,
+    and creates a master training CSV. With workers > 1 the file list is
+    sharded across a process pool; shards are consumed in order, so the CSV
+    is identical to a serial run. Unchanged files are served from the feature
+    cache stored next to the CSV.
+    """
+    files = collect_files()
+    if not files:
+        print("\nNo data was processed. Could not create dataset.")
+        return
+
+    cache = None
+    cache_path = None
+    if use_cache:
+        cache_path = os.path.join(os.path.dirname(os.path.abspath(output_filename)), 'feature_cache.db')
+        cache = FeatureCache(cache_path)
+    shards = [files[i:i + shard_size] for i in range(0, len(files), shard_size)]
+
+    all_chat_features = []
+    cache_totals = {name: {'hits': 0, 'misses': 0} for name in ('sentiment', 'ner')}
+    done = 0
+
+    def consume(results):
+        nonlocal done
+        for shard, (rows, log_lines, deltas, new_entries) in zip(shards, results):
+            for line in log_lines:
+                print(line)
+            all_chat_features.extend(rows)
+            if cache is not None:
+                cache.put_many(new_entries)
+            for name, counts in deltas.items():
+                for key, value in counts.items():
+                    cache_totals[name][key] += value
+            done += len(shard)
+            print(f"[{done}/{len(files)} files processed]")
+
+    if workers > 1:
+        print(f"\nProcessing {len(files)} files in {len(shards)} shards on {workers} workers...")
+        with ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(cache_path,)) as executor:
+            consume(executor.map(process_shard, shards))
+    else:
+        init_worker(cache_path)
+        consume(process_shard(shard) for shard in shards)
+    if cache is not None:
+        cache.close()
 
     if not all_chat_features:
         print("\nNo data was processed. Could not create dataset.")
         return
 
+    stats = cache_totals['sentiment']
+    print(f"\nSentiment cache: {stats['hits']} hits, {stats['misses']} misses.")
+    stats = cache_totals['ner']
+    print(f"NER cache: {stats['hits']} hits, {stats['misses']} misses.")
+
     final_df = pd.DataFrame(all_chat_features).fillna(0)
-    output_filename = 'training_data.csv'
     final_df.to_csv(output_filename, index=False)
     print(f"\n✅ Success! Dataset created at '{output_filename}' with {len(final_df)} samples.")
+    print("train-detector.py and run_retraining.py import it into the training store on their next run.")
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Build the training CSV from exported chats.")
+    parser.add_argument('--workers', type=int, default=1, help="Worker processes (1 = serial).")
+    parser.add_argument('--shard-size', type=int, default=DEFAULT_SHARD_SIZE, help="Files per worker task.")
+    parser.add_argument('--output', default=OUTPUT_CSV, help="Output CSV path.")
+    parser.add_argument('--no-cache', action='store_true', help="Re-extract every file, ignoring the feature cache.")
+    args = parser.parse_args()
+    main(workers=args.workers, shard_size=args.shard_size, output_filename=args.output, use_cache=not args.no_cache)
@@ -0,0 +1,274 @@
+# database_manager.py
+"""
+Access layer for scam_intelligence.db, the store of LLM-extracted scam
+intelligence.
+
+Writes go through a BatchedSQLiteWriter: insert_scam_data() only queues an
+upsert, and a background thread commits queued upserts in batches, so the
+detector never waits on SQLite or an fsync. Analysts read through a small
+pool of read-only WAL connections that never block, or are blocked by, the
+writer. The free-text columns are indexed by an FTS5 table kept in sync by
+triggers, which backs search_scams().
+"""
+import re
+import json
+import queue
+import base64
+import logging
+from contextlib import contextmanager
+from datetime import datetime
+
+from sqlite_writer import BatchedSQLiteWriter, connect, DEFAULT_PRAGMAS
+
+# --- Configuration ---
+DB_NAME = "scam_intelligence.db"
+READ_POOL_SIZE = 4
+WRITE_PRAGMAS = {
+    **DEFAULT_PRAGMAS,
+    'temp_store': 'MEMORY',
+    'cache_size': -32000,         # KiB
+    'wal_autocheckpoint': 1000,   # Pages
+}
+READ_PRAGMAS = {
+    'busy_timeout': 5000,
+    'query_only': 'ON',
+    'cache_size': -16000,
+    'mmap_size': 268435456,
+}
+
+SCAM_COLUMNS = ['chat_id', 'contact_name', 'classification_timestamp', 'scam_type', 'scammer_tactic',
+                'red_flags_identified', 'extracted_details', 'hacker_strategy_summary']
+
+# Same table as dummy_data.py creates; the UNIQUE constraint doubles as the chat_id index.
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS scams (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    chat_id INTEGER UNIQUE,
+    contact_name TEXT,
+    classification_timestamp TEXT,
+    scam_type TEXT,
+    scammer_tactic TEXT,
+    red_flags_identified TEXT,
+    extracted_details TEXT,
+    hacker_strategy_summary TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_scams_scam_type ON scams (scam_type, classification_timestamp);
+CREATE INDEX IF NOT EXISTS idx_scams_timestamp ON scams (classification_timestamp);
+"""
+
+# --- Full-Text Search ---
+FTS_COLUMNS = ['contact_name', 'scammer_tactic', 'red_flags_identified', 'extracted_details', 'hacker_strategy_summary']
+# bm25 column weights, in FTS_COLUMNS order
+FTS_WEIGHTS = (0.5, 2.0, 2.0, 1.0, 1.0)
+SEARCH_PAGE_SIZE = 20
+
+_fts_columns = ', '.join(FTS_COLUMNS)
+_new_values = ', '.join(f'new.{column}' for column in FTS_COLUMNS)
+_old_values = ', '.join(f'old.{column}' for column in FTS_COLUMNS)
+# The triggers only see plain INSERT/UPDATE/DELETE: the rows INSERT OR REPLACE deletes fire no
+# trigger (recursive_triggers is off), leaving stale index entries. Write to scams with upserts.
+FTS_SCHEMA = f"""
+CREATE VIRTUAL TABLE IF NOT EXISTS scams_fts USING fts5(
+    {_fts_columns},
+    content='scams', content_rowid='id',
+    tokenize='porter unicode61', prefix='2 3'
+);
+CREATE TRIGGER IF NOT EXISTS scams_fts_insert AFTER INSERT ON scams BEGIN
+    INSERT INTO scams_fts (rowid, {_fts_columns}) VALUES (new.id, {_new_values});
+END;
+CREATE TRIGGER IF NOT EXISTS scams_fts_delete AFTER DELETE ON scams BEGIN
+    INSERT INTO scams_fts (scams_fts, rowid, {_fts_columns}) VALUES ('delete', old.id, {_old_values});
+END;
+CREATE TRIGGER IF NOT EXISTS scams_fts_update AFTER UPDATE ON scams BEGIN
+    INSERT INTO scams_fts (scams_fts, rowid, {_fts_columns}) VALUES ('delete', old.id, {_old_values});
+    INSERT INTO scams_fts (rowid, {_fts_columns}) VALUES (new.id, {_new_values});
+END;
+"""
+
+# One constant statement, so sqlite3's statement cache prepares it once per connection.
+UPSERT_SCAM_SQL = f"""
+INSERT INTO scams ({', '.join(SCAM_COLUMNS)})
+VALUES ({', '.join('?' * len(SCAM_COLUMNS))})
+ON CONFLICT (chat_id) DO UPDATE SET
+    {', '.join(f'{column} = excluded.{column}' for column in SCAM_COLUMNS[1:])}
+"""
+
+
+def _as_text(value):
+    """LLM output fields may be lists or dicts; store those as JSON."""
+    if value is None or isinstance(value, str):
+        return value
+    return json.dumps(value)
+
+
+def dict_row_factory(cursor, row):
+    return {column[0]: value for column, value in zip(cursor.description, row)}
+
+
+def _setup_schema(conn):
+    has_fts = conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'scams_fts'").fetchone() is not None
+    conn.executescript(SCHEMA + FTS_SCHEMA)
+    if not has_fts:
+        # Index the rows written before the FTS table existed.
+        conn.execute("INSERT INTO scams_fts (scams_fts) VALUES ('rebuild')")
+
+
+_QUERY_TERM = re.compile(r'"([^"]*)"|(\S+)')
+
+def build_match_query(text):
+    """
+    Turns analyst input into a safe FTS5 query: "quoted text" is a phrase,
+    a trailing * makes a prefix search, and every other word is a plain
+    term. All parts must match. Returns None if there is nothing to search.
+    """
+    parts = []
+    for phrase, word in _QUERY_TERM.findall(text):
+        term = phrase if phrase else word
+        prefix = not phrase and term.endswith('*')
+        term = term.rstrip('*').replace('"', '""').strip()
+        if term:
+            parts.append(f'"{term}"' + ('*' if prefix else ''))
+    return ' '.join(parts) or None
+
+
+def _encode_cursor(values):
+    return base64.urlsafe_b64encode(json.dumps(values).encode('utf-8')).decode('ascii')
+
+
+def _decode_cursor(cursor):
+    try:
+        return json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+    except (ValueError, UnicodeError) as e:
+        raise ValueError(f"Invalid search cursor: {cursor!r}") from e
+
+
+class DatabaseManager:
+    """Batched, non-blocking writes and pooled reads for the scams table."""
+
+    def __init__(self, db_path=DB_NAME, read_pool_size=READ_POOL_SIZE):
+        self.db_path = db_path
+        self._writer = BatchedSQLiteWriter(db_path, setup=_setup_schema,
+                                           pragmas=WRITE_PRAGMAS, name='scam-db-writer')
+        self._readers = queue.Queue()
+        for _ in range(read_pool_size):
+            conn = connect(db_path, READ_PRAGMAS, check_same_thread=False)
+            conn.row_factory = dict_row_factory
+            self._readers.put(conn)
+        self._read_pool_size = read_pool_size
+        logging.info(f"DatabaseManager ready for '{db_path}' ({read_pool_size} read connections).")
+
+    # --- Writes ---
+    def insert_scam_data(self, chat_id, contact_name, scam_type, scammer_tactic, red_flags_identified,
+                         extracted_details, hacker_strategy_summary, classification_timestamp=None):
+        """Queues an upsert of one chat's scam record (keyed on chat_id) and returns immediately."""
+        timestamp = classification_timestamp or datetime.now().isoformat()
+        self._writer.execute(UPSERT_SCAM_SQL, (
+            chat_id, contact_name, timestamp, _as_text(scam_type), _as_text(scammer_tactic),
+            _as_text(red_flags_identified), _as_text(extracted_details), _as_text(hacker_strategy_summary)
+        ))
+
+    def flush(self):
+        """Blocks until every queued write is committed."""
+        self._writer.flush()
+
+    # --- Reads ---
+    @contextmanager
+    def read_connection(self):
+        """Borrows a read-only connection from the pool; rows come back as dicts."""
+        conn = self._readers.get()
+        try:
+            yield conn
+        finally:
+            self._readers.put(conn)
+
+    def get_scam(self, chat_id):
+        with self.read_connection() as conn:
+            return conn.execute("SELECT * FROM scams WHERE chat_id = ?", (chat_id,)).fetchone()
+
+    def recent_scams(self, limit=50, scam_type=None):
+        """Newest records first, optionally for one scam_type."""
+        with self.read_connection() as conn:
+            if scam_type is None:
+                return conn.execute("SELECT * FROM scams ORDER BY classification_timestamp DESC LIMIT ?",
+                                    (limit,)).fetchall()
+            return conn.execute(
+                "SELECT * FROM scams WHERE scam_type = ? ORDER BY classification_timestamp DESC LIMIT ?",
+                (scam_type, limit)
+            ).fetchall()
+
+    def search_scams(self, query=None, scam_type=None, since=None, until=None, limit=SEARCH_PAGE_SIZE, cursor=None):
+        """
+        Searches scam records. With a query (see build_match_query) results
+        are ranked by bm25 relevance and carry a highlighted snippet; without
+        one they are newest first. since/until bound classification_timestamp
+        (ISO strings, until exclusive). Returns (rows, next_cursor); pass
+        next_cursor back to get the following page, None means no more pages.
+        """
+        filters, params = [], []
+        if scam_type is not None:
+            filters.append("s.scam_type = ?")
+            params.append(scam_type)
+        if since is not None:
+            filters.append("s.classification_timestamp >= ?")
+            params.append(since)
+        if until is not None:
+            filters.append("s.classification_timestamp < ?")
+            params.append(until)
+        after = _decode_cursor(cursor) if cursor else None
+
+        match = build_match_query(query) if query else None
+        if match is None:
+            return self._browse_scams(filters, params, after, limit)
+
+        # Rank inside FTS5 first; snippets are only built for the returned page.
+        weights = ', '.join(str(weight) for weight in FTS_WEIGHTS)
+        if after:
+            filters.append("(r.score > ? OR (r.score = ? AND s.id > ?))")
+            params += [after[0], after[0], after[1]]
+        sql = f"""
+            SELECT s.*, r.score FROM (
+                SELECT rowid, bm25(scams_fts, {weights}) AS score FROM scams_fts WHERE scams_fts MATCH ?
+            ) r JOIN scams s ON s.id = r.rowid
+            {'WHERE ' + ' AND '.join(filters) if filters else ''}
+            ORDER BY r.score, s.id LIMIT ?
+        """
+        with self.read_connection() as conn:
+            rows = conn.execute(sql, [match, *params, limit + 1]).fetchall()
+            page = rows[:limit]
+            snippets = {row['rowid']: row['snippet'] for row in conn.execute(
+                f"SELECT rowid, snippet(scams_fts, -1, '[', ']', '...', 12) AS snippet FROM scams_fts "
+                f"WHERE scams_fts MATCH ? AND rowid IN ({', '.join('?' * len(page))})",
+                [match, *(row['id'] for row in page)]
+            )} if page else {}
+        for row in page:
+            row['snippet'] = snippets.get(row['id'])
+        next_cursor = _encode_cursor([page[-1]['score'], page[-1]['id']]) if len(rows) > limit else None
+        return page, next_cursor
+
+    def _browse_scams(self, filters, params, after, limit):
+        """Newest first, keyed on (classification_timestamp, id) so the timestamp indexes serve each page."""
+        if after and after[0] is None:
+            filters.append("(s.classification_timestamp IS NULL AND s.id < ?)")
+            params.append(after[1])
+        elif after:
+            # NULL timestamps sort after every dated row.
+            filters.append("(s.classification_timestamp < ? OR (s.classification_timestamp = ? AND s.id < ?) "
+                           "OR s.classification_timestamp IS NULL)")
+            params += [after[0], after[0], after[1]]
+        sql = f"""
+            SELECT s.* FROM scams s
+            {'WHERE ' + ' AND '.join(filters) if filters else ''}
+            ORDER BY s.classification_timestamp DESC, s.id DESC LIMIT ?
+        """
+        with self.read_connection() as conn:
+            rows = conn.execute(sql, [*params, limit + 1]).fetchall()
+        page = rows[:limit]
+        next_cursor = (_encode_cursor([page[-1]['classification_timestamp'], page[-1]['id']])
+                       if len(rows) > limit else None)
+        return page, next_cursor
+
+    def close(self):
+        """Commits pending writes and closes every connection."""
+        self._writer.close()
+        for _ in range(self._read_pool_size):
+            self._readers.get().close()
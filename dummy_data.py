@@ -83,9 +83,19 @@ def seed_database():
             # Generate a slightly different timestamp for each entry
             timestamp = (datetime.now() - timedelta(days=len(dummy_scams) - i)).isoformat()
             
+            # An upsert rather than INSERT OR REPLACE, which would leave stale entries in
+            # database_manager.py's full-text index (scams_fts).
             cursor.execute("""
-                INSERT OR REPLACE INTO scams (chat_id, contact_name, classification_timestamp, scam_type, scammer_tactic, red_flags_identified, extracted_details, hacker_strategy_summary)
+                INSERT INTO scams (chat_id, contact_name, classification_timestamp, scam_type, scammer_tactic, red_flags_identified, extracted_details, hacker_strategy_summary)
                 VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (chat_id) DO UPDATE SET
+                    contact_name = excluded.contact_name,
+                    classification_timestamp = excluded.classification_timestamp,
+                    scam_type = excluded.scam_type,
+                    scammer_tactic = excluded.scammer_tactic,
+                    red_flags_identified = excluded.red_flags_identified,
+                    extracted_details = excluded.extracted_details,
+                    hacker_strategy_summary = excluded.hacker_strategy_summary
             """, (
                 scam["chat_id"],
                 scam["contact_name"],
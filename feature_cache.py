@@ -0,0 +1,99 @@
+# feature_cache.py
+"""
+Persistent cache of extracted feature rows for chat export files.
+
+Rows are keyed by a SHA-256 of the export's raw bytes plus a feature
+extractor version. The version is a digest of feature_extractor.py's source,
+the active keyword lexicon and the spaCy model name, so editing any feature
+definition invalidates every cached row without manual intervention.
+"""
+import os
+import json
+import sqlite3
+import hashlib
+import logging
+
+import feature_extractor
+
+# --- Configuration ---
+FEATURE_CACHE_PATH = 'feature_cache.db'
+
+
+def content_hash(data):
+    """SHA-256 hex digest of a file's raw bytes."""
+    return hashlib.sha256(data).hexdigest()
+
+
+def feature_extractor_version():
+    """Digest of everything that determines the value of a feature row."""
+    digest = hashlib.sha256()
+    with open(feature_extractor.__file__, 'rb') as f:
+        digest.update(f.read())
+    matcher = feature_extractor.keyword_matcher
+    for phrase in sorted(matcher.phrases):
+        digest.update(f"{phrase}\t{','.join(sorted(matcher.categories[phrase]))}\n".encode('utf-8'))
+    digest.update(feature_extractor.SPACY_MODEL_NAME.encode('utf-8'))
+    return digest.hexdigest()[:16]
+
+
+class FeatureCache:
+    """SQLite-backed map of (content hash, extractor version) -> feature row."""
+
+    def __init__(self, path=FEATURE_CACHE_PATH, version=None, read_only=False):
+        self.path = path
+        self.version = version or feature_extractor_version()
+        self.read_only = read_only
+        if read_only:
+            if not os.path.exists(path):
+                self.conn = None
+                return
+            self.conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+        else:
+            self.conn = sqlite3.connect(path)
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS feature_rows (
+                    content_hash TEXT NOT NULL,
+                    version TEXT NOT NULL,
+                    features TEXT NOT NULL,
+                    PRIMARY KEY (content_hash, version)
+                )
+            """)
+            stale = self.conn.execute("DELETE FROM feature_rows WHERE version != ?", (self.version,)).rowcount
+            self.conn.commit()
+            if stale:
+                logging.info(f"Feature cache: dropped {stale} rows from older feature extractor versions.")
+
+    def get_many(self, hashes):
+        """Returns {content_hash: features} for the hashes that are cached."""
+        if self.conn is None or not hashes:
+            return {}
+        found = {}
+        hashes = list(hashes)
+        for i in range(0, len(hashes), 500):
+            chunk = hashes[i:i + 500]
+            placeholders = ",".join("?" * len(chunk))
+            rows = self.conn.execute(
+                f"SELECT content_hash, features FROM feature_rows WHERE version = ? AND content_hash IN ({placeholders})",
+                (self.version, *chunk)
+            )
+            for key, features in rows:
+                found[key] = json.loads(features)
+        return found
+
+    def put_many(self, entries):
+        """Stores {content_hash: features} in one transaction."""
+        if self.read_only:
+            raise RuntimeError("FeatureCache opened read-only.")
+        if not entries:
+            return
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO feature_rows (content_hash, version, features) VALUES (?, ?, ?)",
+            [(key, self.version, json.dumps(features)) for key, features in entries.items()]
+        )
+        self.conn.commit()
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
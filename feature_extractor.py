@@ -1,8 +1,13 @@
 # feature_extractor.py
+import numpy as np
 import pandas as pd
 import spacy
 from vaderSentiment.vaderSentiment import SentimentIntensityAnalyzer
+import os
 import re
+import hashlib
+import threading
+from collections import Counter, OrderedDict, deque
 from datetime import timedelta
 import logging
 
@@ -15,6 +20,285 @@ URGENT_WORDS = {'now', 'quick', 'immediately', 'urgent', 'hurry', 'today', 'inst
 FINANCIAL_WORDS = {'investment', 'crypto', 'profit', 'guarantee', 'bank', 'money', 'rich', 'cash', 'wire', 'fee'}
 GREEDY_WORDS = {'easy money', 'risk-free', 'huge return', 'guaranteed profit', 'once in a lifetime', 'get rich'}
 ALL_SUSPICIOUS_WORDS = EMOTIONAL_WORDS | URGENT_WORDS | FINANCIAL_WORDS | GREEDY_WORDS
+KEYWORD_CATEGORIES = {
+    'emotional': EMOTIONAL_WORDS,
+    'urgent': URGENT_WORDS,
+    'financial': FINANCIAL_WORDS,
+    'greedy': GREEDY_WORDS,
+}
+# Extra lexicons: one phrase per line in <category>.txt, '#' starts a comment.
+LEXICON_DIR = os.environ.get('LEXICON_DIR', 'lexicons')
+
+# --- Keyword Matching ---
+def _normalize_phrase(phrase):
+    return " ".join(phrase.lower().split())
+
+def _is_word_char(char):
+    return char.isalnum() or char == '_'
+
+def load_lexicon_file(path):
+    """Reads a lexicon file into a set of normalized phrases."""
+    phrases = set()
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            phrase = _normalize_phrase(line.split('#', 1)[0])
+            if phrase:
+                phrases.add(phrase)
+    return phrases
+
+def load_lexicon_dir(directory=LEXICON_DIR):
+    """Returns {category: phrases} for every .txt file in directory, or {} if it does not exist."""
+    if not os.path.isdir(directory):
+        return {}
+    lexicons = {}
+    for filename in sorted(os.listdir(directory)):
+        if filename.endswith('.txt'):
+            category = os.path.splitext(filename)[0]
+            lexicons.setdefault(category, set()).update(load_lexicon_file(os.path.join(directory, filename)))
+    return lexicons
+
+class KeywordMatcher:
+    """
+    Aho-Corasick automaton over a set of categorised phrases. A text is scanned
+    once regardless of lexicon size, and a match only counts when it starts and
+    ends on a word boundary, so 'now' does not match inside 'know'.
+    Texts passed in are expected to be lowercased already.
+    """
+
+    def __init__(self, lexicons):
+        self.categories = {}
+        for category, phrases in lexicons.items():
+            for phrase in phrases:
+                phrase = _normalize_phrase(phrase)
+                if phrase:
+                    self.categories.setdefault(phrase, set()).add(category)
+        self.category_names = sorted({c for cats in self.categories.values() for c in cats})
+        self.phrases = frozenset(self.categories)
+        self._build()
+
+    @classmethod
+    def from_lexicons(cls, lexicon_dir=LEXICON_DIR, extra_files=()):
+        """Built-in keyword sets plus any lexicon files found in lexicon_dir or listed in extra_files."""
+        lexicons = {category: set(words) for category, words in KEYWORD_CATEGORIES.items()}
+        for category, phrases in load_lexicon_dir(lexicon_dir).items():
+            lexicons.setdefault(category, set()).update(phrases)
+        for path in extra_files:
+            category = os.path.splitext(os.path.basename(path))[0]
+            lexicons.setdefault(category, set()).update(load_lexicon_file(path))
+        return cls(lexicons)
+
+    def _build(self):
+        goto = [{}]
+        outputs = [[]]
+        for phrase in self.phrases:
+            state = 0
+            for char in phrase:
+                nxt = goto[state].get(char)
+                if nxt is None:
+                    nxt = len(goto)
+                    goto[state][char] = nxt
+                    goto.append({})
+                    outputs.append([])
+                state = nxt
+            outputs[state].append(phrase)
+
+        # Breadth-first so every failure link points at an already finished state.
+        fail = [0] * len(goto)
+        queue = deque(goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, nxt in goto[state].items():
+                queue.append(nxt)
+                f = fail[state]
+                while f and char not in goto[f]:
+                    f = fail[f]
+                if state:
+                    fail[nxt] = goto[f].get(char, 0)
+                outputs[nxt] = outputs[nxt] + outputs[fail[nxt]]
+        self._goto = goto
+        self._fail = fail
+        self._outputs = outputs
+
+    def find(self, text):
+        """Yields (start, end, phrase) for every word-bounded match in text."""
+        goto, fail, outputs = self._goto, self._fail, self._outputs
+        state = 0
+        length = len(text)
+        for i, char in enumerate(text):
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            if not outputs[state]:
+                continue
+            end = i + 1
+            if end < length and _is_word_char(text[end]):
+                continue
+            for phrase in outputs[state]:
+                start = end - len(phrase)
+                if start == 0 or not _is_word_char(text[start - 1]):
+                    yield start, end, phrase
+
+    def matched_phrases(self, text):
+        """Distinct phrases found in text."""
+        return frozenset(phrase for _, _, phrase in self.find(text))
+
+    def category_counts(self, text):
+        """Number of hits per category; every category is present in the result."""
+        counts = dict.fromkeys(self.category_names, 0)
+        for _, _, phrase in self.find(text):
+            for category in self.categories[phrase]:
+                counts[category] += 1
+        return counts
+
+keyword_matcher = KeywordMatcher.from_lexicons()
+
+# --- Shared Sentiment Service ---
+SENTIMENT_CACHE_SIZE = 100_000
+
+def _text_key(text):
+    """Stable digest of a message text, used as a cache key."""
+    return hashlib.blake2b(text.encode('utf-8', 'surrogatepass'), digest_size=16).digest()
+
+class SentimentService:
+    """
+    One VADER analyzer shared by every caller, with a bounded LRU cache of
+    compound scores keyed by message text hash. Safe to call from several threads.
+    """
+
+    def __init__(self, cache_size=SENTIMENT_CACHE_SIZE):
+        self.cache_size = cache_size
+        self._analyzer = None
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def analyzer(self):
+        if self._analyzer is None:
+            self._analyzer = SentimentIntensityAnalyzer()
+        return self._analyzer
+
+    def score(self, text):
+        """Returns the VADER compound score for one message."""
+        return self.score_many([text])[0]
+
+    def score_many(self, texts):
+        """Returns compound scores for a list of messages, scoring each distinct uncached text once."""
+        texts = [str(text) for text in texts]
+        keys = [_text_key(text) for text in texts]
+        cache = self._cache
+        found = {}
+        with self._lock:
+            for key in keys:
+                score = cache.get(key)
+                if score is not None:
+                    cache.move_to_end(key)
+                    found[key] = score
+
+        computed = {}
+        for text, key in zip(texts, keys):
+            if key not in found and key not in computed:
+                computed[key] = self.analyzer.polarity_scores(text)['compound']
+
+        with self._lock:
+            self.misses += len(computed)
+            self.hits += len(keys) - len(computed)
+            cache.update(computed)
+            while len(cache) > self.cache_size:
+                cache.popitem(last=False)
+        return [found[key] if key in found else computed[key] for key in keys]
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'cached': len(self._cache)}
+
+    def clear(self):
+        self._cache.clear()
+        self.hits = self.misses = 0
+
+sentiment_service = SentimentService()
+
+# --- Named Entity Service ---
+SPACY_MODEL_NAME = "en_core_web_sm"
+# Only doc.ents is used; in the en_core_web_* pipelines 'ner' has its own tok2vec layer.
+NER_EXCLUDED_COMPONENTS = ["tok2vec", "tagger", "morphologizer", "parser", "senter", "attribute_ruler", "lemmatizer"]
+NER_CACHE_SIZE = 100_000
+NER_BATCH_SIZE = 256
+NER_N_PROCESS = 1
+
+def load_ner_model(model_name=SPACY_MODEL_NAME):
+    """Loads a spaCy pipeline trimmed down to the NER component."""
+    return spacy.load(model_name, exclude=NER_EXCLUDED_COMPONENTS)
+
+class MoneyEntityService:
+    """
+    Counts MONEY entities per message with a bounded LRU cache. Uncached
+    messages go through nlp.pipe together; n_process > 1 is only used once a
+    call has more than batch_size new messages, as worker start-up costs more
+    than it saves on small batches. Safe to call from several threads.
+    """
+
+    def __init__(self, cache_size=NER_CACHE_SIZE, batch_size=NER_BATCH_SIZE, n_process=NER_N_PROCESS):
+        self.cache_size = cache_size
+        self.batch_size = batch_size
+        self.n_process = n_process
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _model_key(nlp_model):
+        meta = nlp_model.meta
+        return (meta.get('lang'), meta.get('name'), meta.get('version'), tuple(nlp_model.pipe_names))
+
+    def count(self, text, nlp_model):
+        return self.count_many([text], nlp_model)[0]
+
+    def count_many(self, texts, nlp_model):
+        """Returns the number of MONEY entities in each message."""
+        cache = self._cache
+        model_key = self._model_key(nlp_model)
+        keys = []
+        found = {}
+        missing = {}
+        with self._lock:
+            for text in texts:
+                text = str(text)
+                key = (model_key, _text_key(text))
+                keys.append(key)
+                if key in found:
+                    continue
+                count = cache.get(key)
+                if count is not None:
+                    cache.move_to_end(key)
+                    found[key] = count
+                else:
+                    missing[key] = text
+
+        computed = {}
+        if missing:
+            n_process = self.n_process if len(missing) > self.batch_size else 1
+            docs = nlp_model.pipe(missing.values(), batch_size=self.batch_size, n_process=n_process)
+            for key, doc in zip(missing, docs):
+                computed[key] = sum(1 for ent in doc.ents if ent.label_ == 'MONEY')
+
+        with self._lock:
+            self.misses += len(computed)
+            self.hits += len(keys) - len(computed)
+            cache.update(computed)
+            while len(cache) > self.cache_size:
+                cache.popitem(last=False)
+        return [computed[key] if key in computed else found[key] for key in keys]
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'cached': len(self._cache)}
+
+    def clear(self):
+        self._cache.clear()
+        self.hits = self.misses = 0
+
+entity_service = MoneyEntityService()
 
 def calculate_behavioral_features(df_chat, user_id, contact_id):
     """Calculates features based on the timing and patterns of messages."""
@@ -50,11 +334,11 @@ def calculate_linguistic_features(df_chat, nlp_model):
     if contact_messages.empty:
         return default_features
 
-    contact_text = " ".join(contact_messages['text'].astype(str))
-    text_lower = contact_text.lower()
-    analyzer = SentimentIntensityAnalyzer()
-    contact_sentiments = contact_messages['text'].astype(str).apply(
-        lambda text: analyzer.polarity_scores(text)['compound']
+    contact_texts = contact_messages['text'].astype(str).tolist()
+    contact_text = " ".join(contact_texts)
+    contact_sentiments = pd.Series(
+        sentiment_service.score_many(contact_texts),
+        dtype=float
     )
     features['avg_contact_sentiment'] = contact_sentiments.mean() if not contact_sentiments.empty else 0
     features['sentiment_escalation'] = 0
@@ -65,13 +349,26 @@ def calculate_linguistic_features(df_chat, nlp_model):
         if pd.notna(first_half) and pd.notna(second_half):
             features['sentiment_escalation'] = abs(second_half - first_half)
 
-    keyword_chars = sum(len(word) for word in ALL_SUSPICIOUS_WORDS if word in text_lower)
+    # Each distinct phrase counts once; matches are per message and never span two messages.
+    found = set()
+    for text in contact_texts:
+        found |= keyword_matcher.matched_phrases(text.lower())
+    keyword_chars = sum(len(phrase) for phrase in found)
     total_chars = len(contact_text)
     features['keyword_ratio'] = keyword_chars / total_chars if total_chars > 0 else 0
-    doc = nlp_model(contact_text)
-    features['money_entity_count'] = len([ent for ent in doc.ents if ent.label_ == 'MONEY'])
+    features['money_entity_count'] = sum(entity_service.count_many(contact_texts, nlp_model))
     return features
 
+def calculate_keyword_category_features(df_chat, matcher=None):
+    """Counts keyword hits per lexicon category over the contact's messages."""
+    matcher = matcher or keyword_matcher
+    counts = dict.fromkeys(matcher.category_names, 0)
+    contact_messages = df_chat[df_chat['sender_type'] == 'contact']
+    for text in contact_messages['text'].astype(str):
+        for category, hits in matcher.category_counts(text.lower()).items():
+            counts[category] += hits
+    return {f'{category}_keyword_hits': hits for category, hits in counts.items()}
+
 def calculate_graph_proxy_features(df_chat):
     """Calculates proxy features for graph-based analysis from a single chat."""
     if df_chat.empty:
@@ -85,27 +382,636 @@ def is_recent_id(user_id: int) -> int:
     if user_id is None: return 0
     return int(str(user_id).startswith(('74', '75', '76', '77', '78', '79')))
 
-def process_chat_history_for_features(history_list, user_id, contact_id, nlp_model):
+def prepare_chat_frame(history_list, user_id):
+    """The date-sorted DataFrame, with a sender_type column, that the calculate_* functions take."""
+    df_chat = pd.DataFrame(history_list)
+    df_chat['date'] = pd.to_datetime(df_chat['date'], errors='coerce')
+    df_chat.dropna(subset=['date'], inplace=True)
+    
+    df_chat['text'] = df_chat['text'].fillna('').astype(str)
+    df_chat['sender_id'] = df_chat['sender_id'].astype(int)
+    df_chat['sender_type'] = df_chat['sender_id'].apply(lambda x: 'user' if x == int(user_id) else 'contact')
+    return df_chat.sort_values(by='date', kind='stable').reset_index(drop=True)
+
+def process_chat_history_for_features(history_list, user_id, contact_id, nlp_model, keyword_categories=False):
     """
     Processes raw chat history and calculates all features.
     This is the main orchestrator function.
+    With keyword_categories=True, per-category keyword hit counts are appended;
+    the saved models are trained without them.
     """
     if not history_list:
         logging.warning("Cannot process features: received an empty history list.")
         return None
     
-    df_chat = pd.DataFrame(history_list)
-    df_chat['date'] = pd.to_datetime(df_chat['date'], errors='coerce')
-    df_chat.dropna(subset=['date'], inplace=True)
-    
-    df_chat['text'] = df_chat['text'].fillna('').astype(str)
-    df_chat['sender_id'] = df_chat['sender_id'].astype(int)
-    df_chat['sender_type'] = df_chat['sender_id'].apply(lambda x: 'user' if x == int(user_id) else 'contact')
-    df_chat = df_chat.sort_values(by='date').reset_index(drop=True)
+    df_chat = prepare_chat_frame(history_list, user_id)
     
     behavioral = calculate_behavioral_features(df_chat, user_id, contact_id)
     linguistic = calculate_linguistic_features(df_chat, nlp_model)
     graph = calculate_graph_proxy_features(df_chat)
     all_features = {**behavioral, **linguistic, **graph}
+    if keyword_categories:
+        all_features.update(calculate_keyword_category_features(df_chat))
     
-    return pd.DataFrame([all_features])
\ No newline at end of file
+    return pd.DataFrame([all_features])
+
+# --- Batch Feature Extraction ---
+NS_PER_SECOND = 1_000_000_000
+NS_PER_DAY = 86_400 * NS_PER_SECOND
+INITIATION_GAP_NS = 3_600 * NS_PER_SECOND
+NS_PER_UNIT = {'s': NS_PER_SECOND, 'ms': 1_000_000, 'us': 1_000, 'ns': 1}
+
+def _clean_text(value):
+    if value is None or (isinstance(value, float) and np.isnan(value)):
+        return ''
+    return str(value)
+
+def _build_long_frame(chats):
+    """
+    Flattens (chat_key, history_list, user_id, contact_id) tuples into one
+    long-format frame with one row per message, sorted by chat then date.
+    Chats that would make process_chat_history_for_features return None or
+    raise are left out; returns (frame, chat_keys, unit_ns), where unit_ns is
+    the resolution each chat's dates were parsed at.
+    """
+    chat_keys = []
+    unit_ns = []
+    codes, stamps, hours, texts, is_contact = [], [], [], [], []
+    for chat_key, history_list, user_id, contact_id in chats:
+        if not history_list:
+            logging.warning(f"Cannot process features for {chat_key}: received an empty history list.")
+            continue
+        try:
+            # Dates are parsed per chat so format inference matches the single-chat path.
+            dates = pd.to_datetime(pd.Series([msg.get('date') for msg in history_list]), errors='coerce')
+            valid = dates.notna().to_numpy()
+            dates = dates[valid]
+            chat_messages = [msg for msg, ok in zip(history_list, valid) if ok]
+            user_id = int(user_id)
+            senders = [int(msg['sender_id']) for msg in chat_messages]
+        except Exception as e:
+            logging.warning(f"Cannot process features for {chat_key}: {e}")
+            continue
+        code = len(chat_keys)
+        chat_keys.append(chat_key)
+        unit_ns.append(NS_PER_UNIT[dates.dt.unit])
+        codes.extend([code] * len(chat_messages))
+        stamps.append(dates.dt.as_unit('ns').array.asi8 if len(dates) else np.empty(0, dtype=np.int64))
+        hours.append(dates.dt.hour.to_numpy() if len(dates) else np.empty(0, dtype=np.int64))
+        texts.extend(_clean_text(msg.get('text')) for msg in chat_messages)
+        is_contact.extend(sender != user_id for sender in senders)
+
+    df = pd.DataFrame({
+        'chat': np.asarray(codes, dtype=np.int64),
+        'ts': np.concatenate(stamps) if stamps else np.empty(0, dtype=np.int64),
+        'hour': np.concatenate(hours) if hours else np.empty(0, dtype=np.int64),
+        'text': pd.Series(texts, dtype=object),
+        'is_contact': np.asarray(is_contact, dtype=bool),
+    })
+    order = np.lexsort((df['ts'].to_numpy(), df['chat'].to_numpy()))
+    return df.iloc[order].reset_index(drop=True), chat_keys, np.asarray(unit_ns, dtype=np.int64)
+
+def process_many_chat_histories(chats, nlp_model, keyword_categories=False):
+    """
+    Batch counterpart of process_chat_history_for_features.
+    chats is an iterable of (chat_key, history_list, user_id, contact_id).
+    All chats are processed as one long frame with grouped operations, and
+    sentiment and NER see every contact message in one batch. Returns a
+    DataFrame indexed by chat_key, one row per chat, with the same values the
+    single-chat function gives. Chats it would reject are left out.
+    """
+    df, chat_keys, unit_ns = _build_long_frame(chats)
+    n_chats = len(chat_keys)
+    index = pd.RangeIndex(n_chats)
+    chat = df['chat']
+    contact = df['is_contact']
+
+    def per_chat(series):
+        return series.reindex(index)
+
+    # Behavioral
+    ts = df['ts']
+    contact_rows = df[contact]
+    user_rows = df[~contact]
+
+    def avg_latency(rows):
+        stats = rows.groupby('chat')['ts'].agg(['first', 'last', 'size']).reindex(index)
+        # Series.diff().mean() on datetimes truncates to the column's resolution.
+        span_units = (stats['last'] - stats['first']) // unit_ns
+        latency = np.trunc(span_units / (stats['size'] - 1)) / (NS_PER_SECOND // unit_ns)
+        return latency.where(stats['size'] >= 2)
+
+    avg_user_latency = avg_latency(user_rows)
+    avg_contact_latency = avg_latency(contact_rows)
+    latency_ok = avg_user_latency.notna() & (avg_user_latency > 0) & avg_contact_latency.notna()
+    latency_ratio = (avg_contact_latency / avg_user_latency).where(latency_ok, 0.0)
+
+    contact_counts = per_chat(contact_rows.groupby('chat').size()).fillna(0)
+    has_question = contact_rows['text'].str.contains('?', regex=False)
+    contact_question_ratio = (per_chat(has_question.groupby(contact_rows['chat']).sum()) / contact_counts).fillna(0)
+
+    same_chat = chat.eq(chat.shift())
+    initiation = same_chat & (ts.diff() > INITIATION_GAP_NS)
+    initiations = per_chat(initiation.groupby(chat).sum()).fillna(0)
+    contact_initiations = per_chat((initiation & contact).groupby(chat).sum()).fillna(0)
+    contact_initiation_rate = (contact_initiations / initiations).where(initiations > 0, 0.0)
+
+    message_counts = per_chat(df.groupby('chat').size()).fillna(0)
+    unsociable = per_chat(df['hour'].between(1, 6).groupby(chat).sum()).fillna(0)
+    unsociable_hours_ratio = (unsociable / message_counts).where(message_counts > 0, 0.0)
+
+    # Linguistic
+    contact_texts = contact_rows['text'].tolist()
+    sentiments = pd.Series(sentiment_service.score_many(contact_texts), index=contact_rows.index, dtype=float)
+    avg_contact_sentiment = per_chat(sentiments.groupby(contact_rows['chat']).mean()).fillna(0.0)
+
+    position = contact_rows.groupby('chat').cumcount()
+    sizes = contact_rows['chat'].map(contact_counts)
+    second_half = position >= sizes // 2
+    half_means = sentiments.groupby([contact_rows['chat'], second_half]).mean().unstack()
+    half_means = half_means.reindex(index=index, columns=[False, True])
+    sentiment_escalation = (half_means[True] - half_means[False]).abs()
+    sentiment_escalation = sentiment_escalation.where((contact_counts >= 10) & sentiment_escalation.notna(), 0.0)
+
+    phrase_rows = [(c, phrase) for c, text in zip(contact_rows['chat'], contact_texts)
+                   for phrase in keyword_matcher.matched_phrases(text.lower())]
+    phrases = pd.DataFrame(phrase_rows, columns=['chat', 'phrase']).drop_duplicates()
+    keyword_chars = per_chat(phrases['phrase'].str.len().groupby(phrases['chat']).sum()).fillna(0)
+    total_chars = per_chat(contact_rows['text'].str.len().groupby(contact_rows['chat']).sum()).fillna(0) + (contact_counts - 1).clip(lower=0)
+    keyword_ratio = (keyword_chars / total_chars).where(total_chars > 0, 0.0)
+
+    money = pd.Series(entity_service.count_many(contact_texts, nlp_model), index=contact_rows.index, dtype=np.int64)
+    money_entity_count = per_chat(money.groupby(contact_rows['chat']).sum()).fillna(0).astype(np.int64)
+
+    # Graph proxy
+    span = ts.groupby(chat).agg(['min', 'max']).reindex(index)
+    duration_days = ((span['max'] - span['min']) // NS_PER_DAY).clip(lower=1)
+    messages_per_day = (message_counts / duration_days).where(message_counts > 0, 0.0)
+
+    features = pd.DataFrame({
+        'latency_ratio': latency_ratio,
+        'contact_question_ratio': contact_question_ratio,
+        'contact_initiation_rate': contact_initiation_rate,
+        'unsociable_hours_ratio': unsociable_hours_ratio,
+        'avg_contact_sentiment': avg_contact_sentiment.where(contact_counts > 0, 0.0),
+        'sentiment_escalation': sentiment_escalation,
+        'keyword_ratio': keyword_ratio,
+        'money_entity_count': money_entity_count,
+        'messages_per_day': messages_per_day,
+    }, index=index)
+
+    if keyword_categories:
+        category_rows = [keyword_matcher.category_counts(text.lower()) for text in contact_texts]
+        categories = pd.DataFrame(category_rows, index=contact_rows.index, columns=keyword_matcher.category_names)
+        categories = categories.groupby(contact_rows['chat']).sum().reindex(index).fillna(0).astype(np.int64)
+        for category in keyword_matcher.category_names:
+            features[f'{category}_keyword_hits'] = categories[category]
+
+    features.index = pd.Index(chat_keys, name='chat_key')
+    return features
+
+# --- Incremental Feature State ---
+INITIATION_GAP = timedelta(hours=1)
+class _MessageRecord:
+    """Per-message scalars kept by ChatFeatureAccumulator so aggregates never rescan text."""
+    __slots__ = ('date', 'text', 'sender_id', 'is_contact', 'has_question', 'unsociable',
+                 'initiation', 'keywords', 'category_hits', 'sentiment', 'money_entities')
+
+    def __init__(self, date, text, sender_id, is_contact, matcher):
+        self.date = date
+        self.text = text
+        self.sender_id = sender_id
+        self.is_contact = is_contact
+        self.has_question = is_contact and '?' in text
+        self.unsociable = 1 <= date.hour <= 6
+        self.initiation = False
+        self.category_hits = Counter()
+        keywords = set()
+        if is_contact:
+            for _, _, phrase in matcher.find(text.lower()):
+                keywords.add(phrase)
+                self.category_hits.update(matcher.categories[phrase])
+        self.keywords = frozenset(keywords)
+        self.sentiment = None
+        self.money_entities = None
+
+class ChatFeatureAccumulator:
+    """
+    Running feature state for a single chat.
+    Appending a message is O(1); features() returns the same vector as
+    process_chat_history_for_features over the messages currently held.
+    Sentiment and MONEY entities are scored lazily, only for messages added
+    since the last features() call. If max_messages is set, the oldest message
+    is evicted once the window is full.
+    """
+
+    def __init__(self, user_id, nlp_model, max_messages=None, sentiment=None, matcher=None):
+        self.user_id = int(user_id)
+        self.nlp_model = nlp_model
+        self.max_messages = max_messages
+        self.sentiment = sentiment or sentiment_service
+        self.matcher = matcher or keyword_matcher
+        self._records = deque()
+        self._reset_aggregates()
+
+    def _reset_aggregates(self):
+        self._user_dates = deque()
+        self._contact_records = deque()
+        self._pending = deque()
+        self._contact_questions = 0
+        self._initiations = 0
+        self._contact_initiations = 0
+        self._unsociable = 0
+        self._contact_chars = 0
+        self._keyword_counts = Counter()
+        self._category_hits = Counter()
+        # Prefix sums of contact sentiments; entries before _sentiment_offset belong to evicted messages.
+        self._sentiment_prefix = [0.0]
+        self._sentiment_offset = 0
+        self._money_entities = 0
+
+    def __len__(self):
+        return len(self._records)
+
+    def append(self, message):
+        """Adds one message dict with 'date', 'text' and 'sender_id' keys."""
+        date = pd.to_datetime(message.get('date'), errors='coerce')
+        if pd.isna(date):
+            return
+        text = message.get('text')
+        text = '' if text is None or (isinstance(text, float) and pd.isna(text)) else str(text)
+        sender_id = int(message['sender_id'])
+        record = _MessageRecord(date, text, sender_id, sender_id != self.user_id, self.matcher)
+
+        if self._records and date < self._records[-1].date:
+            # Out-of-order arrival: rebuild from cached per-message scalars, no re-scoring needed.
+            self._rebuild(sorted([*self._records, record], key=lambda r: r.date))
+        else:
+            self._ingest(record)
+
+        if self.max_messages is not None:
+            while len(self._records) > self.max_messages:
+                self._evict()
+
+    def extend(self, messages):
+        for message in messages:
+            self.append(message)
+
+    def _ingest(self, record):
+        if self._records:
+            record.initiation = record.date - self._records[-1].date > INITIATION_GAP
+        self._records.append(record)
+        self._unsociable += record.unsociable
+        if record.initiation:
+            self._initiations += 1
+            self._contact_initiations += record.is_contact
+
+        if not record.is_contact:
+            self._user_dates.append(record.date)
+            return
+
+        if self._contact_records:
+            self._contact_chars += 1  # joining space
+        self._contact_records.append(record)
+        self._contact_questions += record.has_question
+        self._contact_chars += len(record.text)
+        self._keyword_counts.update(record.keywords)
+        self._category_hits.update(record.category_hits)
+        if record.sentiment is None or self._pending:
+            self._pending.append(record)
+        else:
+            self._add_scores(record)
+
+    def _evict(self):
+        record = self._records.popleft()
+        self._unsociable -= record.unsociable
+        if record.initiation:
+            self._initiations -= 1
+            self._contact_initiations -= record.is_contact
+        if self._records and self._records[0].initiation:
+            # The new first message has no predecessor, so it can no longer count as an initiation.
+            head = self._records[0]
+            head.initiation = False
+            self._initiations -= 1
+            self._contact_initiations -= head.is_contact
+
+        if not record.is_contact:
+            self._user_dates.popleft()
+            return
+
+        self._contact_records.popleft()
+        self._contact_questions -= record.has_question
+        self._contact_chars -= len(record.text)
+        self._keyword_counts.subtract(record.keywords)
+        self._category_hits.subtract(record.category_hits)
+        if self._contact_records:
+            self._contact_chars -= 1
+        if self._pending and self._pending[0] is record:
+            self._pending.popleft()
+        else:
+            self._sentiment_offset += 1
+            self._money_entities -= record.money_entities
+            if self._sentiment_offset > 1024 and self._sentiment_offset * 2 > len(self._sentiment_prefix):
+                del self._sentiment_prefix[:self._sentiment_offset]
+                self._sentiment_offset = 0
+
+    def _rebuild(self, records):
+        self._records = deque()
+        self._reset_aggregates()
+        for record in records:
+            record.initiation = False
+            self._ingest(record)
+
+    def _add_scores(self, record):
+        self._sentiment_prefix.append(self._sentiment_prefix[-1] + record.sentiment)
+        self._money_entities += record.money_entities
+
+    def unscored_records(self):
+        """Held messages whose sentiment and MONEY entity count have not been computed yet."""
+        return [record for record in self._pending if record.sentiment is None]
+
+    @staticmethod
+    def set_scores(records, sentiments, money_counts):
+        """
+        Stores scores computed elsewhere (e.g. on a worker pool) for records
+        from unscored_records(); the next features() call only sums them.
+        """
+        for record, score, count in zip(records, sentiments, money_counts):
+            record.sentiment = score
+            record.money_entities = count
+
+    def _flush(self):
+        unscored = [record for record in self._pending if record.sentiment is None]
+        if unscored:
+            scores = self.sentiment.score_many([record.text for record in unscored])
+            counts = entity_service.count_many([record.text for record in unscored], self.nlp_model)
+            for record, score, count in zip(unscored, scores, counts):
+                record.sentiment = score
+                record.money_entities = count
+        while self._pending:
+            self._add_scores(self._pending.popleft())
+
+    def features(self, keyword_categories=False):
+        """Returns the feature dict for the current window, or None if it is empty."""
+        if not self._records:
+            return None
+        self._flush()
+        features = {}
+
+        contact_dates = self._contact_records
+        user_dates = self._user_dates
+        avg_user_latency = ((user_dates[-1] - user_dates[0]).total_seconds() / (len(user_dates) - 1)
+                            if len(user_dates) >= 2 else float('nan'))
+        avg_contact_latency = ((contact_dates[-1].date - contact_dates[0].date).total_seconds() / (len(contact_dates) - 1)
+                               if len(contact_dates) >= 2 else float('nan'))
+        if pd.notna(avg_user_latency) and avg_user_latency > 0 and pd.notna(avg_contact_latency):
+            features['latency_ratio'] = avg_contact_latency / avg_user_latency
+        else:
+            features['latency_ratio'] = 0
+        total_contact_messages = len(contact_dates)
+        features['contact_question_ratio'] = self._contact_questions / total_contact_messages if total_contact_messages > 0 else 0
+        features['contact_initiation_rate'] = self._contact_initiations / self._initiations if self._initiations > 0 else 0
+        features['unsociable_hours_ratio'] = self._unsociable / len(self._records)
+
+        if total_contact_messages == 0:
+            features.update({
+                'avg_contact_sentiment': 0, 'sentiment_escalation': 0,
+                'keyword_ratio': 0, 'money_entity_count': 0
+            })
+        else:
+            prefix, base = self._sentiment_prefix, self._sentiment_offset
+            features['avg_contact_sentiment'] = (prefix[-1] - prefix[base]) / total_contact_messages
+            features['sentiment_escalation'] = 0
+            if total_contact_messages >= 10:
+                midpoint = total_contact_messages // 2
+                first_half = (prefix[base + midpoint] - prefix[base]) / midpoint
+                second_half = (prefix[-1] - prefix[base + midpoint]) / (total_contact_messages - midpoint)
+                features['sentiment_escalation'] = abs(second_half - first_half)
+            keyword_chars = sum(len(word) for word, count in self._keyword_counts.items() if count > 0)
+            features['keyword_ratio'] = keyword_chars / self._contact_chars if self._contact_chars > 0 else 0
+            features['money_entity_count'] = self._money_entities
+
+        chat_duration_days = (self._records[-1].date - self._records[0].date).days
+        features['messages_per_day'] = len(self._records) / max(chat_duration_days, 1)
+        if keyword_categories:
+            for category in self.matcher.category_names:
+                features[f'{category}_keyword_hits'] = self._category_hits[category]
+        return features
+
+    def to_frame(self, keyword_categories=False):
+        """Same return contract as process_chat_history_for_features."""
+        features = self.features(keyword_categories)
+        if features is None:
+            logging.warning("Cannot process features: the accumulator holds no messages.")
+            return None
+        return pd.DataFrame([features])
+
+# --- Compact Ring-Buffer History ---
+# One row per message; a buffer holds two copies of every row so that the
+# current window is always one contiguous slice.
+MESSAGE_DTYPE = np.dtype([
+    ('ts', 'i8'),              # UTC epoch nanoseconds
+    ('sentiment', 'f8'),       # VADER compound score, NaN until scored
+    ('text_len', 'i4'),
+    ('money_entities', 'i2'),
+    ('is_contact', '?'),
+    ('has_question', '?'),
+    ('unsociable', '?'),
+])
+
+class _PendingText:
+    """Handle for a message awaiting scores, as returned by MessageRingBuffer.unscored_records()."""
+    __slots__ = ('seq', 'generation', 'text')
+
+    def __init__(self, seq, generation, text):
+        self.seq = seq
+        self.generation = generation
+        self.text = text
+
+def calculate_features_from_arrays(messages, keyword_chars, category_hits=None):
+    """
+    Computes the feature vector from a MESSAGE_DTYPE array of time-ordered,
+    fully scored messages (e.g. a MessageRingBuffer.view()). keyword_chars is
+    the total length of the distinct keyword phrases in the contact's messages.
+    Matches process_chat_history_for_features on the same messages.
+    """
+    if len(messages) == 0:
+        return None
+    features = {}
+    ts = messages['ts']
+    is_contact = messages['is_contact']
+    user_ts = ts[~is_contact]
+    contact_ts = ts[is_contact]
+    total_contact_messages = len(contact_ts)
+
+    avg_user_latency = (user_ts[-1] - user_ts[0]) / NS_PER_SECOND / (len(user_ts) - 1) if len(user_ts) >= 2 else float('nan')
+    avg_contact_latency = ((contact_ts[-1] - contact_ts[0]) / NS_PER_SECOND / (total_contact_messages - 1)
+                           if total_contact_messages >= 2 else float('nan'))
+    if pd.notna(avg_user_latency) and avg_user_latency > 0 and pd.notna(avg_contact_latency):
+        features['latency_ratio'] = avg_contact_latency / avg_user_latency
+    else:
+        features['latency_ratio'] = 0
+    features['contact_question_ratio'] = (int(messages['has_question'].sum()) / total_contact_messages
+                                          if total_contact_messages > 0 else 0)
+    initiations = np.diff(ts) > INITIATION_GAP_NS
+    total_initiations = int(initiations.sum())
+    features['contact_initiation_rate'] = (int((initiations & is_contact[1:]).sum()) / total_initiations
+                                           if total_initiations > 0 else 0)
+    features['unsociable_hours_ratio'] = int(messages['unsociable'].sum()) / len(messages)
+
+    if total_contact_messages == 0:
+        features.update({
+            'avg_contact_sentiment': 0, 'sentiment_escalation': 0,
+            'keyword_ratio': 0, 'money_entity_count': 0
+        })
+    else:
+        sentiments = messages['sentiment'][is_contact]
+        features['avg_contact_sentiment'] = float(sentiments.mean())
+        features['sentiment_escalation'] = 0
+        if total_contact_messages >= 10:
+            midpoint = total_contact_messages // 2
+            features['sentiment_escalation'] = abs(float(sentiments[midpoint:].mean() - sentiments[:midpoint].mean()))
+        contact_chars = int(messages['text_len'][is_contact].sum()) + total_contact_messages - 1
+        features['keyword_ratio'] = keyword_chars / contact_chars if contact_chars > 0 else 0
+        features['money_entity_count'] = int(messages['money_entities'][is_contact].sum())
+
+    features['messages_per_day'] = len(messages) / max(int((ts[-1] - ts[0]) // NS_PER_DAY), 1)
+    if category_hits is not None:
+        for category, hits in category_hits.items():
+            features[f'{category}_keyword_hits'] = hits
+    return features
+
+class MessageRingBuffer:
+    """
+    Fixed-capacity history of a chat's last `capacity` messages for real-time
+    feature extraction. Per-message scalars live in one MESSAGE_DTYPE array
+    (2 * capacity rows), and text and keyword matches live in side lists of
+    `capacity` slots, so memory per chat is bounded no matter how long the
+    chat runs. Appending is O(1); view() is a zero-copy slice of the window.
+    Offers the same features()/unscored_records()/set_scores() interface as
+    ChatFeatureAccumulator.
+    """
+
+    def __init__(self, user_id, nlp_model, capacity, sentiment=None, matcher=None):
+        self.user_id = int(user_id)
+        self.nlp_model = nlp_model
+        self.capacity = capacity
+        self.sentiment = sentiment or sentiment_service
+        self.matcher = matcher or keyword_matcher
+        self._rows = np.zeros(2 * capacity, dtype=MESSAGE_DTYPE)
+        self._texts = [None] * capacity
+        self._keywords = [()] * capacity
+        self._reset()
+
+    def _reset(self):
+        self._start = 0          # sequence number of the oldest held message
+        self._end = 0            # sequence number the next message will get
+        self._generation = getattr(self, '_generation', -1) + 1
+        self._keyword_counts = Counter()
+        self._keyword_chars = 0
+        self._category_hits = Counter()
+
+    def __len__(self):
+        return self._end - self._start
+
+    def view(self):
+        """The held messages, oldest first, as a read-only view into the buffer."""
+        offset = self._start % self.capacity
+        window = self._rows[offset:offset + len(self)]
+        window.flags.writeable = False
+        return window
+
+    def texts(self):
+        return [self._texts[seq % self.capacity] for seq in range(self._start, self._end)]
+
+    def append(self, message):
+        """Adds one message dict with 'date', 'text' and 'sender_id' keys."""
+        date = pd.to_datetime(message.get('date'), errors='coerce')
+        if pd.isna(date):
+            return
+        text = message.get('text')
+        text = '' if text is None or (isinstance(text, float) and pd.isna(text)) else str(text)
+        is_contact = int(message['sender_id']) != self.user_id
+        # Every match, so category hits count repeats; keyword_ratio only uses distinct phrases.
+        keywords = tuple(phrase for _, _, phrase in self.matcher.find(text.lower())) if is_contact else ()
+        row = (date.value, np.nan if is_contact else 0.0, len(text), 0,
+               is_contact, is_contact and '?' in text, 1 <= date.hour <= 6)
+
+        if len(self) and date.value < self._rows[(self._end - 1) % self.capacity]['ts']:
+            self._insert_out_of_order(row, text, keywords)
+        else:
+            self._push(row, text, keywords)
+
+    def extend(self, messages):
+        for message in messages:
+            self.append(message)
+
+    def _push(self, row, text, keywords):
+        if len(self) == self.capacity:
+            self._evict()
+        seq = self._end
+        slot = seq % self.capacity
+        self._rows[slot] = row
+        self._rows[slot + self.capacity] = row
+        self._texts[slot] = text
+        self._keywords[slot] = keywords
+        for phrase in set(keywords):
+            self._keyword_counts[phrase] += 1
+            if self._keyword_counts[phrase] == 1:
+                self._keyword_chars += len(phrase)
+        for phrase in keywords:
+            self._category_hits.update(self.matcher.categories[phrase])
+        self._end += 1
+
+    def _evict(self):
+        slot = self._start % self.capacity
+        keywords = self._keywords[slot]
+        for phrase in set(keywords):
+            self._keyword_counts[phrase] -= 1
+            if self._keyword_counts[phrase] == 0:
+                del self._keyword_counts[phrase]
+                self._keyword_chars -= len(phrase)
+        for phrase in keywords:
+            self._category_hits.subtract(self.matcher.categories[phrase])
+        self._texts[slot] = None
+        self._keywords[slot] = ()
+        self._start += 1
+
+    def _insert_out_of_order(self, row, text, keywords):
+        """Rebuilds the window in time order; scores already computed are kept."""
+        held = [(tuple(self._rows[seq % self.capacity].item()), self._texts[seq % self.capacity],
+                 self._keywords[seq % self.capacity]) for seq in range(self._start, self._end)]
+        held.append((row, text, keywords))
+        held.sort(key=lambda entry: entry[0][0])
+        self._reset()
+        for entry in held[-self.capacity:]:
+            self._push(*entry)
+
+    def unscored_records(self):
+        """Handles (with .text) for contact messages still missing sentiment and MONEY scores."""
+        window = self.view()
+        pending = np.flatnonzero(np.isnan(window['sentiment']))
+        return [_PendingText(self._start + int(i), self._generation, self._texts[(self._start + int(i)) % self.capacity])
+                for i in pending]
+
+    def set_scores(self, records, sentiments, money_counts):
+        """Stores scores for handles from unscored_records(); messages evicted since are skipped."""
+        for record, score, count in zip(records, sentiments, money_counts):
+            if record.generation != self._generation or not self._start <= record.seq < self._end:
+                continue
+            slot = record.seq % self.capacity
+            self._rows['sentiment'][[slot, slot + self.capacity]] = score
+            self._rows['money_entities'][[slot, slot + self.capacity]] = count
+
+    def features(self, keyword_categories=False):
+        """Returns the feature dict for the current window, or None if it is empty."""
+        if not len(self):
+            return None
+        records = self.unscored_records()
+        if records:
+            texts = [record.text for record in records]
+            self.set_scores(records, self.sentiment.score_many(texts), entity_service.count_many(texts, self.nlp_model))
+        category_hits = None
+        if keyword_categories:
+            category_hits = {category: self._category_hits[category] for category in self.matcher.category_names}
+        return calculate_features_from_arrays(self.view(), self._keyword_chars, category_hits)
@@ -0,0 +1,166 @@
+# inference_executor.py
+"""
+Runs message scoring and model prediction off the asyncio event loop.
+
+A spaCy pass or a LightGBM predict on the event loop stalls every Telegram
+update for its duration. ClassificationExecutor moves both onto a pool:
+either threads in this process, or worker processes that each load spaCy
+and the joblib models once and are replaced after a fixed number of tasks.
+
+Classification of a ChatFeatureAccumulator happens in two pool calls:
+  1. sentiment and MONEY entity scores for the messages not scored yet,
+  2. every model's prediction for the resulting feature row, micro-batched
+     with the rows of other chats classified at the same moment.
+The accumulator itself is only read and updated on the event loop, so a
+call that times out leaves it untouched.
+"""
+import os
+import time
+import asyncio
+import logging
+import multiprocessing
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+import pandas as pd
+
+from feature_extractor import SPACY_MODEL_NAME, load_ner_model, sentiment_service, entity_service
+from inference_service import BatchingInferenceService, MAX_BATCH_SIZE, MAX_BATCH_WAIT
+from lean_predictor import load_model
+
+# --- Configuration ---
+MODE_THREAD = 'thread'
+MODE_PROCESS = 'process'
+DEFAULT_WORKERS = os.cpu_count() or 1
+CLASSIFY_TIMEOUT = 30          # Seconds before a classification is abandoned
+RECYCLE_AFTER_TASKS = 1000     # Process workers are replaced after this many tasks
+PREFER_LEAN_MODELS = True      # Use a model's up-to-date .lean.npz export when there is one
+MODEL_MMAP_MODE = 'r'          # Memory-map joblib model arrays (shared by process workers)
+
+
+# --- Worker State ---
+# Process workers fill this once via the pool initializer; in thread mode the
+# parent fills it and every thread shares it.
+_worker_state = {}
+
+
+def _init_worker(model_paths, ner_model_name=SPACY_MODEL_NAME, nlp_model=None):
+    _worker_state['nlp'] = nlp_model if nlp_model is not None else load_ner_model(ner_model_name)
+    _worker_state['models'] = {name: load_model(path, prefer_lean=PREFER_LEAN_MODELS, mmap_mode=MODEL_MMAP_MODE)
+                               for name, path in model_paths.items()}
+
+
+def _ping():
+    return os.getpid()
+
+
+def _score_texts(texts):
+    """
+    Pool task: VADER compound scores and MONEY entity counts for each text,
+    plus the seconds spent on each of the two.
+    """
+    start = time.perf_counter()
+    sentiments = sentiment_service.score_many(texts)
+    scored = time.perf_counter()
+    money_counts = entity_service.count_many(texts, _worker_state['nlp'])
+    return sentiments, money_counts, (scored - start, time.perf_counter() - scored)
+
+
+def _predict(features_df):
+    """
+    Pool task: one predict_proba per model over every row, each model fed only
+    the columns it was trained on. Returns a {model name: label} dict per row.
+    """
+    labels = {}
+    for name, model in _worker_state['models'].items():
+        columns = getattr(model, 'feature_names_in_', None)
+        model_input = features_df[list(columns)] if columns is not None else features_df
+        labels[name] = model.classes_[model.predict_proba(model_input).argmax(axis=1)]
+    return [{name: values[i] for name, values in labels.items()} for i in range(len(features_df))]
+
+
+class ClassificationExecutor:
+    """Awaitable feature extraction and prediction on a thread or process pool."""
+
+    def __init__(self, model_paths, mode=MODE_THREAD, max_workers=DEFAULT_WORKERS,
+                 timeout=CLASSIFY_TIMEOUT, recycle_after=RECYCLE_AFTER_TASKS,
+                 ner_model_name=SPACY_MODEL_NAME, nlp_model=None,
+                 batch_size=MAX_BATCH_SIZE, batch_wait=MAX_BATCH_WAIT, stage_histogram=None):
+        """
+        model_paths maps a model name to its joblib file; an up-to-date lean
+        export next to it is loaded instead (see lean_predictor). In thread
+        mode the models and nlp_model (loaded from ner_model_name if not
+        given) live in this process; recycle_after only applies to process
+        workers, since threads share the parent's bounded caches.
+        Predictions are batched across chats by up to batch_size rows or
+        batch_wait seconds. stage_histogram, a metrics.Histogram with a
+        'stage' label, receives the time spent on sentiment, ner (spaCy) and
+        predict (including the batching wait).
+        """
+        for path in model_paths.values():
+            if not os.path.exists(path):
+                raise FileNotFoundError(f"Model file not found at '{path}'.")
+        self.mode = mode
+        self.timeout = timeout
+        self.stage_histogram = stage_histogram
+        if mode == MODE_THREAD:
+            _init_worker(model_paths, ner_model_name, nlp_model)
+            self._pool = ThreadPoolExecutor(max_workers, thread_name_prefix='classify')
+        elif mode == MODE_PROCESS:
+            # max_tasks_per_child requires the 'spawn' start method.
+            self._pool = ProcessPoolExecutor(max_workers, mp_context=multiprocessing.get_context('spawn'),
+                                             initializer=_init_worker, initargs=(model_paths, ner_model_name),
+                                             max_tasks_per_child=recycle_after)
+        else:
+            raise ValueError(f"Unsupported executor mode: {mode}")
+        self.max_workers = max_workers
+        self.batcher = BatchingInferenceService(self._predict_batch, max_batch_size=batch_size, max_wait=batch_wait)
+        logging.info(f"Classification executor started: {mode} mode, {max_workers} workers.")
+
+    async def warm_up(self):
+        """Starts the process workers now so the first classification does not pay for loading spaCy."""
+        if self.mode == MODE_PROCESS:
+            loop = asyncio.get_running_loop()
+            await asyncio.gather(*(loop.run_in_executor(self._pool, _ping) for _ in range(self.max_workers)))
+
+    async def classify(self, accumulator, extra_features=None, keyword_categories=False):
+        """
+        Returns (features_df, {model name: prediction}) for a ChatFeatureAccumulator,
+        or (None, {}) if it holds no messages or classification timed out.
+        extra_features (e.g. id_is_recent) are added to the feature row.
+        """
+        try:
+            return await asyncio.wait_for(self._classify(accumulator, extra_features, keyword_categories),
+                                          timeout=self.timeout)
+        except asyncio.TimeoutError:
+            logging.error(f"Classification exceeded its timeout ({self.timeout}s); skipping this round.")
+            return None, {}
+
+    async def _classify(self, accumulator, extra_features, keyword_categories):
+        loop = asyncio.get_running_loop()
+        # Messages appended while a batch was being scored are scored in the next pass,
+        # so features() never has to score on the event loop.
+        while records := accumulator.unscored_records():
+            sentiments, money_counts, (sentiment_time, ner_time) = await loop.run_in_executor(
+                self._pool, _score_texts, [record.text for record in records])
+            accumulator.set_scores(records, sentiments, money_counts)
+            if self.stage_histogram is not None:
+                self.stage_histogram.observe(sentiment_time, stage='sentiment')
+                self.stage_histogram.observe(ner_time, stage='ner')
+
+        features = accumulator.features(keyword_categories)
+        if features is None:
+            return None, {}
+        features.update(extra_features or {})
+        with self._timed('predict'):
+            predictions = await self.batcher.submit(features)
+        return pd.DataFrame([features]), predictions
+
+    def _timed(self, stage):
+        return self.stage_histogram.time(stage=stage) if self.stage_histogram is not None else nullcontext()
+
+    async def _predict_batch(self, features_df):
+        return await asyncio.get_running_loop().run_in_executor(self._pool, _predict, features_df)
+
+    def close(self):
+        self._pool.shutdown(wait=False, cancel_futures=True)
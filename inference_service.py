@@ -0,0 +1,79 @@
+# inference_service.py
+"""
+Micro-batching for single-row model inference.
+
+Calling a sklearn Pipeline or LightGBM model on a one-row DataFrame is
+dominated by per-call overhead (input validation, pandas conversion, thread
+setup), not by tree evaluation. BatchingInferenceService lets many chats
+submit one feature row each; rows are held for at most max_wait seconds or
+until max_batch_size rows are waiting, scored in a single call, and each
+caller gets back its own row's result.
+"""
+import asyncio
+import logging
+import pandas as pd
+
+# --- Configuration ---
+MAX_BATCH_SIZE = 64
+MAX_BATCH_WAIT = 0.005     # Seconds a row may wait for others to join its batch
+
+
+class BatchingInferenceService:
+    """Coalesces concurrent single-row predictions into batched calls."""
+
+    def __init__(self, run_batch, max_batch_size=MAX_BATCH_SIZE, max_wait=MAX_BATCH_WAIT):
+        """
+        run_batch is an async callable that takes a DataFrame with one row per
+        request and returns a list with one result per row, in order.
+        """
+        self.run_batch = run_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self._pending = []
+        self._timer = None
+        self._tasks = set()
+        self.batches = 0
+        self.rows = 0
+
+    async def submit(self, row):
+        """Queues one feature dict and returns its result once its batch has run."""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((row, future))
+        if len(self._pending) >= self.max_batch_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.max_wait, self._flush)
+        return await future
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        # Callers that timed out while waiting no longer need a result.
+        batch = [(row, future) for row, future in batch if not future.done()]
+        if not batch:
+            return
+        task = asyncio.create_task(self._run(batch))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, batch):
+        self.batches += 1
+        self.rows += len(batch)
+        try:
+            results = await self.run_batch(pd.DataFrame([row for row, _ in batch]))
+        except Exception as e:
+            logging.error(f"Batched inference over {len(batch)} rows failed: {e}")
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
+
+    def stats(self):
+        return {'batches': self.batches, 'rows': self.rows,
+                'avg_batch_size': self.rows / self.batches if self.batches else 0}
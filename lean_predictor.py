@@ -0,0 +1,264 @@
+# lean_predictor.py
+"""
+Compiles the saved sklearn models into small NumPy-only predictors.
+
+For the honeytrap pipeline (SelectKBest, optional StandardScaler,
+LGBMClassifier) the selection mask and scaler collapse into one gather plus
+an affine transform, and every LightGBM tree is flattened into shared node
+arrays. A prediction walks all trees at once, one NumPy step per tree level,
+so a single row costs microseconds instead of the milliseconds spent in
+pandas validation and sklearn dispatch. Binary LogisticRegression models
+(the sentiment model) compile to a weight vector.
+
+Predictors are saved as .npz files that load without pickle, sklearn or
+LightGBM. They expose predict, predict_proba, classes_ and
+feature_names_in_, so they are drop-in replacements for the joblib models.
+"""
+import os
+import logging
+import numpy as np
+
+# --- Configuration ---
+LEAN_SUFFIX = '.lean.npz'
+EXPORT_TOLERANCE = 1e-6     # Max allowed |p_lean - p_original| when exporting
+
+# LightGBM missing-value handling per split node
+MISSING_NONE, MISSING_ZERO, MISSING_NAN = 0, 1, 2
+_MISSING_TYPES = {'None': MISSING_NONE, 'Zero': MISSING_ZERO, 'NaN': MISSING_NAN}
+_ZERO_THRESHOLD = 1e-35     # LightGBM's kZeroThreshold
+
+
+def lean_path_for(model_path):
+    """'honeytrap_detector.joblib' -> 'honeytrap_detector.lean.npz'"""
+    return os.path.splitext(model_path)[0] + LEAN_SUFFIX
+
+
+def _sigmoid(z):
+    return 1.0 / (1.0 + np.exp(-z))
+
+
+class LeanPredictor:
+    """Binary classifier over a raw feature vector: gather + affine, then trees or a linear model."""
+
+    def __init__(self, arrays):
+        self.arrays = arrays
+        self.kind = str(arrays['kind'])
+        self.feature_names_in_ = arrays['feature_names']
+        self.classes_ = arrays['classes']
+        self.columns = arrays['columns']
+        self.mean = arrays['mean']
+        self.scale = arrays['scale']
+        if self.kind == 'trees':
+            self.roots = arrays['roots']
+            self.feature = arrays['feature']
+            self.threshold = arrays['threshold']
+            self.left = arrays['left']
+            self.default_left = arrays['default_left']
+            self.missing_type = arrays['missing_type']
+            self.value = arrays['value']
+            self.depth = int(arrays['depth'])
+            self.sigmoid = float(arrays['sigmoid'])
+            self._has_missing_rules = bool((self.missing_type != MISSING_NONE).any())
+        else:
+            self.coef = arrays['coef']
+            self.intercept = float(arrays['intercept'])
+
+    # --- Persistence ---
+    def save(self, path):
+        with open(path, 'wb') as f:
+            np.savez(f, **self.arrays)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path, allow_pickle=False) as data:
+            return cls({key: data[key] for key in data.files})
+
+    # --- Prediction ---
+    def _transform(self, X):
+        X = np.asarray(X, dtype=np.float64)
+        if X.ndim == 1:
+            X = X[np.newaxis, :]
+        return (X[:, self.columns] - self.mean) / self.scale
+
+    def _go_right(self, X):
+        """Evaluates every split node for every row at once: True where the row goes right."""
+        if not self._has_missing_rules:
+            # LightGBM treats NaN as 0.0 at splits without a missing-value rule.
+            X = np.where(np.isnan(X), 0.0, X)
+            return X.take(self.feature, axis=1) > self.threshold
+        values = X.take(self.feature, axis=1)
+        missing_type = self.missing_type
+        is_nan = np.isnan(values)
+        values = np.where(is_nan & (missing_type != MISSING_NAN), 0.0, values)
+        use_default = (((missing_type == MISSING_ZERO) & (np.abs(values) <= _ZERO_THRESHOLD))
+                       | ((missing_type == MISSING_NAN) & is_nan))
+        return np.where(use_default, ~self.default_left, values > self.threshold)
+
+    def decision_function(self, X):
+        X = self._transform(X)
+        if self.kind == 'linear':
+            return X @ self.coef + self.intercept
+
+        # Children are stored side by side (right = left + 1) and leaves point
+        # at themselves with an infinite threshold, so every tree advances one
+        # level per step and a fixed number of steps reaches every leaf.
+        go_right = self._go_right(X).view(np.int8)
+        if len(X) == 1:
+            go_right = go_right[0]
+            nodes = self.roots
+            for _ in range(self.depth):
+                nodes = self.left[nodes] + go_right[nodes]
+            return np.array([self.value[nodes].sum() * self.sigmoid])
+
+        rows = np.arange(len(X))[:, np.newaxis]
+        nodes = np.broadcast_to(self.roots, (len(X), len(self.roots)))
+        for _ in range(self.depth):
+            nodes = self.left[nodes] + go_right[rows, nodes]
+        return self.value[nodes].sum(axis=1) * self.sigmoid
+
+    def predict_proba(self, X):
+        """Probabilities for classes_, shape (n_rows, 2); X is one raw vector or a 2-D array."""
+        p = _sigmoid(self.decision_function(X))
+        return np.column_stack([1.0 - p, p])
+
+    def predict(self, X):
+        return self.classes_[(self.predict_proba(X)[:, 1] > 0.5).astype(int)]
+
+
+# --- Compilation ---
+def _flatten_trees(booster_dump):
+    """Flattens LightGBM's dump_model() trees into node arrays shared by all trees."""
+    if booster_dump.get('num_class', 1) != 1 or booster_dump.get('average_output'):
+        raise ValueError("Only single-output boosted LightGBM models can be compiled.")
+    objective = booster_dump.get('objective', '')
+    if not objective.startswith('binary'):
+        raise ValueError(f"Unsupported LightGBM objective: '{objective}'.")
+    sigmoid = 1.0
+    for token in objective.split()[1:]:
+        if token.startswith('sigmoid:'):
+            sigmoid = float(token.split(':', 1)[1])
+
+    feature, threshold, left, default_left, missing_type, value = [], [], [], [], [], []
+    roots = []
+    depth = 0
+
+    def allocate():
+        for column in (feature, threshold, left, default_left, missing_type, value):
+            column.append(None)
+        return len(feature) - 1
+
+    for tree in booster_dump['tree_info']:
+        root = allocate()
+        roots.append(root)
+        queue = [(tree['tree_structure'], root, 0)]
+        while queue:
+            node, index, level = queue.pop()
+            depth = max(depth, level)
+            if 'leaf_value' in node:
+                feature[index], threshold[index], left[index] = 0, np.inf, index
+                default_left[index], missing_type[index], value[index] = False, MISSING_NONE, node['leaf_value']
+                continue
+            if node['decision_type'] != '<=':
+                raise ValueError("Categorical splits are not supported by the lean predictor.")
+            left_index = allocate()
+            right_index = allocate()
+            feature[index], threshold[index], left[index] = node['split_feature'], node['threshold'], left_index
+            default_left[index] = node['default_left']
+            missing_type[index] = _MISSING_TYPES[node['missing_type']]
+            value[index] = 0.0
+            queue.append((node['left_child'], left_index, level + 1))
+            queue.append((node['right_child'], right_index, level + 1))
+
+    return {
+        'roots': np.asarray(roots, dtype=np.intp),
+        'feature': np.asarray(feature, dtype=np.intp),
+        'threshold': np.asarray(threshold, dtype=np.float64),
+        'left': np.asarray(left, dtype=np.intp),
+        'default_left': np.asarray(default_left, dtype=bool),
+        'missing_type': np.asarray(missing_type, dtype=np.int8),
+        'value': np.asarray(value, dtype=np.float64),
+        'depth': np.asarray(depth),
+        'sigmoid': np.asarray(sigmoid),
+    }
+
+
+def compile_model(model):
+    """
+    Compiles a fitted Pipeline([SelectKBest, StandardScaler?, LGBMClassifier])
+    or a binary LogisticRegression into a LeanPredictor.
+    """
+    steps = [step for _, step in model.steps] if hasattr(model, 'steps') else [model]
+    estimator = steps[-1]
+    feature_names = getattr(model, 'feature_names_in_', None)
+    n_features = getattr(model, 'n_features_in_', None)
+    if feature_names is None:
+        feature_names = np.asarray([f"x{i}" for i in range(n_features)])
+
+    columns = np.arange(n_features)
+    mean = np.zeros(n_features)
+    scale = np.ones(n_features)
+    for step in steps[:-1]:
+        step_name = type(step).__name__
+        if hasattr(step, 'get_support'):
+            mask = step.get_support()
+            columns, mean, scale = columns[mask], mean[mask], scale[mask]
+        elif step_name == 'StandardScaler':
+            # (x - m0) / s0 followed by (y - m1) / s1 is (x - (m0 + m1 * s0)) / (s0 * s1)
+            step_mean = step.mean_ if step.with_mean else np.zeros(len(columns))
+            step_scale = step.scale_ if step.with_std else np.ones(len(columns))
+            mean, scale = mean + step_mean * scale, scale * step_scale
+        else:
+            raise ValueError(f"Unsupported pipeline step: {step_name}.")
+
+    arrays = {
+        'feature_names': np.asarray(feature_names, dtype=str),
+        'classes': np.asarray(estimator.classes_),
+        'columns': columns.astype(np.int32),
+        'mean': np.asarray(mean, dtype=np.float64),
+        'scale': np.asarray(scale, dtype=np.float64),
+    }
+    if len(arrays['classes']) != 2:
+        raise ValueError("Only binary classifiers can be compiled.")
+    if hasattr(estimator, 'booster_'):
+        arrays['kind'] = np.asarray('trees')
+        arrays.update(_flatten_trees(estimator.booster_.dump_model()))
+    elif type(estimator).__name__ == 'LogisticRegression':
+        arrays['kind'] = np.asarray('linear')
+        arrays['coef'] = np.asarray(estimator.coef_[0], dtype=np.float64)
+        arrays['intercept'] = np.asarray(estimator.intercept_[0], dtype=np.float64)
+    else:
+        raise ValueError(f"Unsupported estimator: {type(estimator).__name__}.")
+    return LeanPredictor(arrays)
+
+
+def export_lean_predictor(model, X, path, tolerance=EXPORT_TOLERANCE):
+    """
+    Compiles model, checks its probabilities on X against the original and
+    saves it to path. Raises ValueError if they differ by more than tolerance.
+    """
+    predictor = compile_model(model)
+    expected = model.predict_proba(X)[:, 1]
+    actual = predictor.predict_proba(np.asarray(X[list(predictor.feature_names_in_)]
+                                                if hasattr(X, 'columns') else X))[:, 1]
+    max_error = float(np.max(np.abs(expected - actual))) if len(expected) else 0.0
+    if max_error > tolerance:
+        raise ValueError(f"Lean predictor differs from the original by {max_error:.2e} (tolerance {tolerance:.0e}).")
+    predictor.save(path)
+    logging.info(f"Lean predictor saved to '{path}' (max probability error {max_error:.2e} over {len(expected)} rows).")
+    return predictor
+
+
+def load_model(path, prefer_lean=True, mmap_mode=None):
+    """
+    Loads a saved model, using its compiled .lean.npz sibling instead when one
+    exists and is at least as new, so a stale export is never picked up.
+    mmap_mode (e.g. 'r') memory-maps the NumPy arrays of an uncompressed
+    joblib file instead of reading them in, so processes loading the same
+    model share its pages; it has no effect on .lean.npz files.
+    """
+    lean_path = lean_path_for(path)
+    if prefer_lean and os.path.exists(lean_path) and (
+            not os.path.exists(path) or os.path.getmtime(lean_path) >= os.path.getmtime(path)):
+        return LeanPredictor.load(lean_path)
+    import joblib
+    return joblib.load(path, mmap_mode=mmap_mode)
@@ -4,18 +4,20 @@ import json
 import logging
 
 class LLMAnalyzer:
-    def __init__(self, llm_backend, api_key=None):
+    def __init__(self, llm_backend, api_key=None, cache=None):
+        """cache, an LLMResponseCache, makes re-analysis of an unchanged conversation free."""
         self.llm_backend = llm_backend
         self.api_key = api_key
+        self.cache = cache
         self.llm = self._initialize_llm()
 
     def _initialize_llm(self):
         if self.llm_backend == 'gemini':
             if not self.api_key:
                 raise ValueError("API Key is required for Gemini LLM backend.")
-            return GeminiLLM(model_name="gemini-1.5-flash", api_key=self.api_key)
+            return GeminiLLM(model_name="gemini-1.5-flash", api_key=self.api_key, cache=self.cache)
         elif self.llm_backend == 'ollama':
-            return OllamaLLM(model_name="mistral")
+            return OllamaLLM(model_name="mistral", cache=self.cache)
         else:
             raise ValueError(f"Unsupported LLM backend: {self.llm_backend}")
 
@@ -41,7 +43,7 @@ class LLMAnalyzer:
         """
 
         try:
-            response_text = self.llm.generate_response(prompt=extraction_prompt)
+            response_text = await self.llm.agenerate_response(prompt=extraction_prompt)
             if response_text and not response_text.startswith("Error:"):
                 # Attempt to parse the JSON response. The LLM might include conversational filler.
                 json_start = response_text.find('{')
@@ -1,54 +1,508 @@
 # llm_interaction.py
-import requests
+import os
+import asyncio
 import json
+import time
+import hashlib
 import logging
-import google.generativeai as genai
+import re
+import threading
+import weakref
+from collections import OrderedDict
+import aiohttp
+
+from sqlite_writer import BatchedSQLiteWriter, connect
+
+# --- Connection Pool Configuration ---
+REQUEST_TIMEOUT = 60      # Seconds allowed for a single HTTP request
+TOTAL_DEADLINE = 90       # Seconds allowed for a whole call, including waiting for a pooled connection
+POOL_SIZE = 32            # Concurrent connections per Ollama host
+KEEP_ALIVE = '30m'        # How long Ollama keeps the model loaded after a request
+# Same variable the Ollama CLI reads; may omit the scheme, e.g. '127.0.0.1:11434'
+OLLAMA_HOST = os.environ.get('OLLAMA_HOST', 'http://localhost:11434')
+if '://' not in OLLAMA_HOST:
+    OLLAMA_HOST = f"http://{OLLAMA_HOST}"
+
+# One pooled session per (event loop, host), shared by every OllamaLLM instance.
+_sessions = weakref.WeakKeyDictionary()
+
+
+def _get_session(host):
+    loop = asyncio.get_running_loop()
+    sessions = _sessions.setdefault(loop, {})
+    session = sessions.get(host)
+    if session is None or session.closed:
+        connector = aiohttp.TCPConnector(limit=POOL_SIZE, keepalive_timeout=60)
+        session = aiohttp.ClientSession(connector=connector)
+        sessions[host] = session
+    return session
+
+
+async def close_sessions():
+    """Closes the pooled HTTP sessions owned by the running event loop."""
+    sessions = _sessions.pop(asyncio.get_running_loop(), {})
+    for session in sessions.values():
+        await session.close()
+
+
+# --- Streaming Stop Conditions ---
+# A run of terminators counts only once whitespace follows it: a partial stream ending in
+# "$3." may go on as "$3.5k", and one ending in "really?" as "really??".
+SENTENCE_END = re.compile(r'[.!?]+\s')
+
+def stop_after_words(max_words):
+    """Stop condition that ends generation once the text has max_words words."""
+    return lambda text: len(text.split()) >= max_words
+
+def stop_at_sentence_end(min_words=1):
+    """Stop condition that ends generation at the first sentence boundary after min_words words."""
+    def should_stop(text):
+        match = SENTENCE_END.search(text)
+        return match is not None and len(text[:match.end()].split()) >= min_words
+    return should_stop
+
+def any_of(*conditions):
+    return lambda text: any(condition(text) for condition in conditions)
+
+
+# --- Response Cache ---
+LLM_CACHE_PATH = 'llm_cache.db'
+CACHE_MEMORY_ENTRIES = 1024     # Responses kept in the in-memory LRU
+CACHE_TTL = 7 * 24 * 3600       # Seconds a cached response stays valid
+CACHE_PURGE_EVERY = 500         # Expired rows are deleted from disk every CACHE_PURGE_EVERY stores
+
+CACHE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS llm_responses (
+    key TEXT PRIMARY KEY,
+    namespace TEXT NOT NULL,
+    response TEXT NOT NULL,
+    created_at REAL NOT NULL
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS idx_llm_responses_created ON llm_responses (namespace, created_at);
+"""
+
+
+class LLMResponseCache:
+    """
+    Caches complete LLM responses keyed on (namespace, backend, model, system
+    prompt, prompt). Lookups hit an in-memory LRU first and then the SQLite
+    store, which aget() reads off the event loop; writes are queued to a
+    background thread. Entries older than ttl seconds are misses. Error
+    responses are never stored.
+    """
+
+    def __init__(self, namespace, path=LLM_CACHE_PATH, ttl=CACHE_TTL, memory_entries=CACHE_MEMORY_ENTRIES):
+        """namespace separates caches sharing one file, e.g. 'analysis' and 'reply'."""
+        self.namespace = namespace
+        self.path = path
+        self.ttl = ttl
+        self.memory_entries = memory_entries
+        self._memory = OrderedDict()
+        self._writer = BatchedSQLiteWriter(path, setup=lambda conn: conn.executescript(CACHE_SCHEMA),
+                                           name=f'llm-cache-{namespace}')
+        self._reader = connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        self._read_lock = threading.Lock()
+        self._stores_since_purge = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._purge()
+
+    def key(self, backend, model, system_prompt, prompt):
+        parts = [self.namespace, backend, model, system_prompt or '', prompt]
+        return hashlib.sha256(json.dumps(parts).encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        """Returns the cached response for key, or None. May read SQLite; async code uses aget()."""
+        now = time.time()
+        response = self._get_memory(key, now)
+        return response if response is not None else self._get_disk(key, now)
+
+    async def aget(self, key):
+        """Like get(), but a memory miss is looked up on disk off the event loop."""
+        now = time.time()
+        response = self._get_memory(key, now)
+        if response is not None:
+            return response
+        return await asyncio.to_thread(self._get_disk, key, now)
+
+    def _get_memory(self, key, now):
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is None or now - entry[1] >= self.ttl:
+                return None
+            self._memory.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def _get_disk(self, key, now):
+        # The reader has its own lock, so memory lookups on the loop never wait on SQLite.
+        with self._read_lock:
+            row = self._reader.execute("SELECT response, created_at FROM llm_responses WHERE key = ?", (key,)).fetchone()
+        with self._lock:
+            if row is not None and now - row[1] < self.ttl:
+                self._remember(key, row[0], row[1])
+                self.hits += 1
+                self.disk_hits += 1
+                return row[0]
+            entry = self._memory.get(key)
+            if entry is not None and now - entry[1] >= self.ttl:
+                del self._memory[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, response):
+        if not response or response.startswith("Error:"):
+            return
+        created_at = time.time()
+        with self._lock:
+            self._remember(key, response, created_at)
+            self._stores_since_purge += 1
+            purge = self._stores_since_purge >= CACHE_PURGE_EVERY
+            if purge:
+                self._stores_since_purge = 0
+        self._writer.execute(
+            "INSERT OR REPLACE INTO llm_responses (key, namespace, response, created_at) VALUES (?, ?, ?, ?)",
+            (key, self.namespace, response, created_at)
+        )
+        if purge:
+            self._purge()
+
+    def _remember(self, key, response, created_at):
+        self._memory[key] = (response, created_at)
+        self._memory.move_to_end(key)
+        if len(self._memory) > self.memory_entries:
+            self._memory.popitem(last=False)
+            self.evictions += 1
+
+    def _purge(self):
+        self._writer.execute("DELETE FROM llm_responses WHERE namespace = ? AND created_at < ?",
+                             (self.namespace, time.time() - self.ttl))
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {'hits': self.hits, 'disk_hits': self.disk_hits, 'misses': self.misses,
+                'evictions': self.evictions, 'hit_rate': self.hits / lookups if lookups else 0.0}
+
+    def close(self):
+        self._writer.close()
+        with self._read_lock:
+            self._reader.close()
+
+
+async def _replay_cached(text, stop_when):
+    """Yields a cached response word by word, honouring stop_when like a live stream."""
+    streamed = ""
+    for token in re.findall(r'\S+\s*|\s+', text):
+        streamed += token
+        yield token
+        if stop_when is not None and stop_when(streamed):
+            break
+
+
+class _BackgroundLoop:
+    """Event loop on a daemon thread that backs the synchronous wrappers."""
+    _lock = threading.Lock()
+    _loop = None
+
+    @classmethod
+    def run(cls, coro):
+        with cls._lock:
+            if cls._loop is None:
+                cls._loop = asyncio.new_event_loop()
+                threading.Thread(target=cls._loop.run_forever, name="llm-sync-loop", daemon=True).start()
+        return asyncio.run_coroutine_threadsafe(coro, cls._loop).result()
+
+
+class _CachingLLM:
+    """
+    Shared front end of the LLM classes: consults the optional response cache
+    before calling the backend's _agenerate/_astream.
+    """
+    backend = None
+    cache = None
+
+    async def agenerate_response(self, prompt, system_prompt=None):
+        """Returns the response text, or a string starting with "Error:" on failure."""
+        if self.cache is None:
+            return await self._agenerate(prompt, system_prompt)
+        key = self.cache.key(self.backend, self.model_name, system_prompt, self._cache_prompt(prompt))
+        response = await self.cache.aget(key)
+        if response is None:
+            response = await self._agenerate(prompt, system_prompt)
+            self.cache.put(key, response)
+        return response
+
+    async def astream_response(self, prompt, system_prompt=None, stop_when=None):
+        """
+        Yields response tokens as they are generated. If stop_when(text_so_far)
+        returns True the stream is closed, which stops generation. Errors are
+        logged and end the stream early.
+        """
+        if self.cache is None:
+            async for token in self._astream(prompt, system_prompt, stop_when, {}):
+                yield token
+            return
+        # Streams may be cut short by stop_when, so they are cached apart from full responses.
+        key = self.cache.key(f"{self.backend}:stream", self.model_name, system_prompt, self._cache_prompt(prompt))
+        cached = await self.cache.aget(key)
+        if cached is not None:
+            async for token in _replay_cached(cached, stop_when):
+                yield token
+            return
+        outcome = {}
+        text = ""
+        async for token in self._astream(prompt, system_prompt, stop_when, outcome):
+            text += token
+            yield token
+        if outcome.get('complete'):
+            self.cache.put(key, text)
+
+    def generate_response(self, prompt, system_prompt=None):
+        """Blocking wrapper around agenerate_response."""
+        return _BackgroundLoop.run(self.agenerate_response(prompt, system_prompt))
+
+    def _cache_prompt(self, prompt):
+        """Everything besides the system prompt that determines the response."""
+        return prompt
+
 
 # --- Ollama Class ---
-class OllamaLLM:
+class OllamaLLM(_CachingLLM):
     """A class to interact with a local LLM served by Ollama."""
-    def __init__(self, model_name='mistral', host='http://localhost:11434'):
+    backend = 'ollama'
+
+    def __init__(self, model_name='mistral', host=None,
+                 request_timeout=REQUEST_TIMEOUT, deadline=TOTAL_DEADLINE, cache=None, keep_alive=KEEP_ALIVE):
         self.model_name = model_name
-        self.host = host
-        self.api_url = f"{host}/api/generate"
+        self.host = host or OLLAMA_HOST
+        self.api_url = f"{self.host}/api/generate"
+        self.request_timeout = request_timeout
+        self.deadline = deadline
+        self.cache = cache
+        self.keep_alive = keep_alive
+        self.last_timings = {}
         logging.info(f"OllamaLLM initialized for model: '{self.model_name}' at {self.host}")
 
-    def generate_response(self, prompt, system_prompt):
-        """Sends a prompt to the Ollama API and gets a response."""
+    def _payload(self, prompt, system_prompt, stream):
         payload = {
             "model": self.model_name,
             "prompt": prompt,
-            "system": system_prompt,
-            "stream": False
+            "stream": stream,
+            "keep_alive": self.keep_alive
         }
+        if system_prompt:
+            payload["system"] = system_prompt
+        return payload
+
+    def _response_text(self, response_data):
+        return response_data.get('response', '')
+
+    def _record_timings(self, response_data):
+        """Keeps Ollama's token counts and durations (ns); a stream stopped early reports none."""
+        self.last_timings = {key: response_data[key] for key in
+                             ('prompt_eval_count', 'prompt_eval_duration', 'eval_count', 'eval_duration')
+                             if key in response_data}
+
+    async def _agenerate(self, prompt, system_prompt=None):
+        """
+        Sends a prompt to the Ollama API over a pooled connection and gets a response.
+        Cancelling the awaiting task aborts the HTTP request.
+        """
+        self.last_timings = {}
+        payload = self._payload(prompt, system_prompt, stream=False)
         try:
-            response = requests.post(self.api_url, json=payload, timeout=60)
-            response.raise_for_status()
-            response_data = response.json()
-            return response_data.get('response', '').strip()
-        except requests.exceptions.RequestException as e:
+            return await asyncio.wait_for(self._post(payload), timeout=self.deadline)
+        except asyncio.TimeoutError:
+            logging.error(f"Ollama API request exceeded its deadline ({self.deadline}s).")
+            return f"Error: Ollama request to {self.host} timed out."
+        except aiohttp.ClientError as e:
             logging.error(f"Ollama API request failed: {e}")
             return f"Error: Could not connect to Ollama server at {self.host}."
         except json.JSONDecodeError:
             logging.error("Failed to decode JSON response from Ollama.")
             return "Error: Invalid response from Ollama server."
 
+    async def _post(self, payload):
+        session = _get_session(self.host)
+        timeout = aiohttp.ClientTimeout(total=self.request_timeout)
+        async with session.post(self.api_url, json=payload, timeout=timeout) as response:
+            response.raise_for_status()
+            response_data = json.loads(await response.text())
+            self._record_timings(response_data)
+            return self._response_text(response_data).strip()
+
+    async def _astream(self, prompt, system_prompt, stop_when, outcome):
+        """Streams tokens from Ollama; sets outcome['complete'] unless an error ended the stream."""
+        self.last_timings = {}
+        payload = self._payload(prompt, system_prompt, stream=True)
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.deadline
+        text = ""
+        try:
+            session = _get_session(self.host)
+            timeout = aiohttp.ClientTimeout(total=None, sock_read=self.request_timeout)
+            response = await asyncio.wait_for(session.post(self.api_url, json=payload, timeout=timeout),
+                                              timeout=self.deadline)
+            async with response:
+                response.raise_for_status()
+                while True:
+                    line = await asyncio.wait_for(response.content.readline(), timeout=max(deadline - loop.time(), 0))
+                    if not line:
+                        break
+                    if not line.strip():
+                        continue
+                    chunk = json.loads(line)
+                    token = self._response_text(chunk)
+                    if token:
+                        text += token
+                        yield token
+                    if chunk.get('done'):
+                        self._record_timings(chunk)
+                        break
+                    if stop_when is not None and stop_when(text):
+                        break
+            outcome['complete'] = True
+        except asyncio.TimeoutError:
+            logging.error(f"Ollama stream exceeded its deadline ({self.deadline}s).")
+        except aiohttp.ClientError as e:
+            logging.error(f"Ollama streaming request failed: {e}")
+        except json.JSONDecodeError:
+            logging.error("Failed to decode a streamed JSON chunk from Ollama.")
+
+# --- Ollama Chat Sessions ---
+CHAT_TOKEN_BUDGET = 2048    # Estimated tokens of earlier turns sent with each chat request
+CHAT_TRIM_TO = 0.5          # Over budget, the oldest turns are dropped down to this fraction of it
+CHARS_PER_TOKEN = 4         # Rough token estimate; no tokenizer is needed
+
+
+def estimate_tokens(text):
+    return len(text) // CHARS_PER_TOKEN + 1
+
+
+class OllamaChatSession(OllamaLLM):
+    """
+    One conversation with an Ollama model over /api/chat. Each request sends
+    the system prompt and the earlier turns, so replies stay coherent, and
+    keep_alive keeps the model loaded. Ollama reuses its KV cache for the
+    unchanged prefix of the message list, so only the newest turns are
+    re-evaluated. Once the window exceeds token_budget the oldest turns are
+    dropped in one go (down to CHAT_TRIM_TO of the budget) rather than one per
+    turn, which keeps that prefix stable between trims.
+    """
+    backend = 'ollama-chat'
+
+    def __init__(self, model_name='mistral', host=None,
+                 request_timeout=REQUEST_TIMEOUT, deadline=TOTAL_DEADLINE, cache=None, keep_alive=KEEP_ALIVE,
+                 token_budget=CHAT_TOKEN_BUDGET):
+        super().__init__(model_name, host, request_timeout, deadline, cache, keep_alive)
+        self.api_url = f"{self.host}/api/chat"
+        self.token_budget = token_budget
+        self.history = []
+        self._history_tokens = 0
+
+    def _messages(self, prompt, system_prompt):
+        messages = [{"role": "system", "content": system_prompt}] if system_prompt else []
+        return messages + self.history + [{"role": "user", "content": prompt}]
+
+    def _payload(self, prompt, system_prompt, stream):
+        return {
+            "model": self.model_name,
+            "messages": self._messages(prompt, system_prompt),
+            "stream": stream,
+            "keep_alive": self.keep_alive
+        }
+
+    def _response_text(self, response_data):
+        return response_data.get('message', {}).get('content', '')
+
+    def _cache_prompt(self, prompt):
+        return json.dumps([self.history, prompt])
+
+    # --- History ---
+    def add_turn(self, role, content):
+        """Appends one 'user' or 'assistant' message, e.g. to seed a session from a restored chat."""
+        self.history.append({"role": role, "content": content})
+        self._history_tokens += estimate_tokens(content)
+        if self._history_tokens > self.token_budget:
+            target = self.token_budget * CHAT_TRIM_TO
+            while self.history and self._history_tokens > target:
+                self._history_tokens -= estimate_tokens(self.history.pop(0)["content"])
+
+    def reset(self):
+        self.history = []
+        self._history_tokens = 0
+
+    async def agenerate_response(self, prompt, system_prompt=None):
+        response = await super().agenerate_response(prompt, system_prompt)
+        if response and not response.startswith("Error:"):
+            self.add_turn("user", prompt)
+            self.add_turn("assistant", response)
+        return response
+
+    async def astream_response(self, prompt, system_prompt=None, stop_when=None, final_text=None):
+        """
+        Like OllamaLLM.astream_response, then records the exchange. final_text(text),
+        if given, maps the streamed text to the reply the caller actually sends
+        (e.g. trimmed), which is what gets recorded as the assistant's turn.
+        """
+        text = ""
+        async for token in super().astream_response(prompt, system_prompt, stop_when):
+            text += token
+            yield token
+        reply = final_text(text) if final_text is not None else text
+        if reply.strip():
+            self.add_turn("user", prompt)
+            self.add_turn("assistant", reply.strip())
+
+
 # --- Gemini Class ---
-class GeminiLLM:
+class GeminiLLM(_CachingLLM):
     """A class to interact with the Google Gemini API."""
-    def __init__(self, model_name='gemini-1.5-flash', api_key=None):
+    backend = 'gemini'
+
+    def __init__(self, model_name='gemini-1.5-flash', api_key=None, deadline=TOTAL_DEADLINE, cache=None):
         if not api_key:
             raise ValueError("Gemini API key is required.")
+        # Imported here: the SDK takes most of a second to import and the Ollama backend never needs it.
+        import google.generativeai as genai
         genai.configure(api_key=api_key)
+        self.model_name = model_name
         self.model = genai.GenerativeModel(model_name)
+        self.deadline = deadline
+        self.cache = cache
         logging.info(f"GeminiLLM initialized for model: '{model_name}'")
 
-    def generate_response(self, prompt, system_prompt):
-        """Sends a prompt to the Gemini API and gets a response."""
-        full_prompt = f"{system_prompt}\n\nUser: {prompt}\nAI:"
+    async def _agenerate(self, prompt, system_prompt=None):
+        """Sends a prompt to the Gemini API and gets a response without blocking the event loop."""
+        full_prompt = f"{system_prompt}\n\nUser: {prompt}\nAI:" if system_prompt else prompt
         try:
-            response = self.model.generate_content(full_prompt)
+            response = await asyncio.wait_for(self.model.generate_content_async(full_prompt), timeout=self.deadline)
             return response.text.strip()
+        except asyncio.TimeoutError:
+            logging.error(f"Gemini API request exceeded its deadline ({self.deadline}s).")
+            return "Error: Gemini API call timed out."
         except Exception as e:
             logging.error(f"Gemini API request failed: {e}")
-            return f"Error: Gemini API call failed."
\ No newline at end of file
+            return f"Error: Gemini API call failed."
+
+    async def _astream(self, prompt, system_prompt, stop_when, outcome):
+        """Streams text chunks from Gemini; sets outcome['complete'] unless an error ended the stream."""
+        full_prompt = f"{system_prompt}\n\nUser: {prompt}\nAI:" if system_prompt else prompt
+        text = ""
+        try:
+            response = await asyncio.wait_for(self.model.generate_content_async(full_prompt, stream=True),
+                                              timeout=self.deadline)
+            async for chunk in response:
+                token = chunk.text
+                text += token
+                yield token
+                if stop_when is not None and stop_when(text):
+                    break
+            outcome['complete'] = True
+        except asyncio.TimeoutError:
+            logging.error(f"Gemini stream exceeded its deadline ({self.deadline}s).")
+        except Exception as e:
+            logging.error(f"Gemini streaming request failed: {e}")
@@ -0,0 +1,318 @@
+# metrics.py
+"""
+In-process metrics for the live bots, in the Prometheus text format.
+
+A MetricsRegistry holds counters, gauges and histograms, optionally with
+labels (e.g. one latency histogram with a 'stage' label). Updates take a
+per-metric lock and cost well under a microsecond, so they are safe on the
+event loop and from pool threads. Counters and gauges may instead be given
+a callback that computes their value at collection time, for numbers that
+already live elsewhere (queue lengths, cache statistics).
+
+The registry can serve its metrics over HTTP on a background thread, which
+keeps answering even while the event loop is stuck, and/or rewrite a file
+periodically (e.g. for node_exporter's textfile collector).
+"""
+import os
+import time
+import bisect
+import logging
+import threading
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# --- Configuration ---
+# Seconds; spans a cached reply (milliseconds) to a slow LLM analysis (a minute)
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+METRICS_HOST = '127.0.0.1'
+DUMP_INTERVAL = 15                 # Seconds between metric file rewrites
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _label_text(names, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in (*zip(names, values), *extra)]
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+# --- Metric Types ---
+class _Metric:
+    kind = None
+
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"Metric '{self.name}' takes labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self._samples())
+        return lines
+
+
+class Counter(_Metric):
+    """A monotonically increasing count, e.g. messages handled or LLM errors."""
+    kind = 'counter'
+
+    def __init__(self, name, help_text, labelnames=(), callback=None):
+        """callback() returns the current total (or {label values tuple: total}) at collection time."""
+        super().__init__(name, help_text, labelnames)
+        self.callback = callback
+        self._values = {}
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._collect().get(self._key(labels), 0)
+
+    def _collect(self):
+        if self.callback is not None:
+            value = self.callback()
+            return value if isinstance(value, dict) else {(): value}
+        with self._lock:
+            return dict(self._values)
+
+    def _samples(self):
+        return [f"{self.name}{_label_text(self.labelnames, key)} {_format_value(value)}"
+                for key, value in sorted(self._collect().items())]
+
+
+class Gauge(Counter):
+    """A value that goes up and down, e.g. active chats or in-memory history size."""
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(_Metric):
+    """Observations counted into cumulative buckets, e.g. the latency of a handler stage."""
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._values = {}   # label values -> [per-bucket counts (last is +Inf), sum]
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            state[0][index] += 1
+            state[1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        """Observes the wall time of the with-block, which may contain awaits; exceptions are timed too."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def count(self, **labels):
+        with self._lock:
+            state = self._values.get(self._key(labels))
+            return sum(state[0]) if state else 0
+
+    def _samples(self):
+        with self._lock:
+            values = {key: (list(counts), total) for key, (counts, total) in self._values.items()}
+        lines = []
+        for key, (counts, total) in sorted(values.items()):
+            cumulative = 0
+            for bound, count in zip((*self.buckets, float('inf')), counts):
+                cumulative += count
+                labels = _label_text(self.labelnames, key, (('le', _format_value(bound)),))
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _label_text(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+# --- Registry ---
+class MetricsRegistry:
+    """Named metrics, exposed over HTTP and/or dumped to a file."""
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+        self._server = None
+        self._dump_stop = None
+        self._dump_thread = None
+
+    def _register(self, cls, name, *args, **kwargs):
+        """Returns the metric called name, creating it first; re-registering a name returns the existing one."""
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, *args, **kwargs)
+            elif type(metric) is not cls:
+                raise ValueError(f"Metric '{name}' is already registered as a {metric.kind}")
+            return metric
+
+    def counter(self, name, help_text, labelnames=(), callback=None):
+        return self._with_callback(self._register(Counter, name, help_text, labelnames), callback)
+
+    def gauge(self, name, help_text, labelnames=(), callback=None):
+        return self._with_callback(self._register(Gauge, name, help_text, labelnames), callback)
+
+    @staticmethod
+    def _with_callback(metric, callback):
+        # A restarted main() registers its callbacks again, over the old run's objects.
+        if callback is not None:
+            metric.callback = callback
+        return metric
+
+    def histogram(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram, name, help_text, labelnames, buckets=buckets)
+
+    def render(self):
+        """All metrics in the Prometheus text exposition format."""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            try:
+                lines.extend(metric.render())
+            except Exception as e:
+                # A failing callback must not take the other metrics down with it.
+                logging.error(f"Could not collect metric '{metric.name}': {e}")
+        return '\n'.join(lines) + '\n'
+
+    # --- HTTP Endpoint ---
+    def start_http_server(self, port, host=METRICS_HOST):
+        """Serves GET /metrics on a daemon thread. Returns the bound (host, port); port 0 picks a free one."""
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] not in ('/', '/metrics'):
+                    self.send_error(404)
+                    return
+                body = registry.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', CONTENT_TYPE)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, name='metrics-http', daemon=True).start()
+        address = self._server.server_address[:2]
+        logging.info(f"Metrics available at http://{address[0]}:{address[1]}/metrics")
+        return address
+
+    # --- File Dump ---
+    def dump(self, path):
+        """Writes all metrics to path, replacing it atomically."""
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(self.render())
+        os.replace(tmp_path, path)
+
+    def start_file_dump(self, path, interval=DUMP_INTERVAL):
+        """Rewrites path every interval seconds on a daemon thread, and once more on close()."""
+        self._dump_stop = threading.Event()
+
+        def run():
+            while not self._dump_stop.wait(interval):
+                try:
+                    self.dump(path)
+                except OSError as e:
+                    logging.error(f"Could not write metrics to '{path}': {e}")
+            self.dump(path)
+
+        self._dump_thread = threading.Thread(target=run, name='metrics-dump', daemon=True)
+        self._dump_thread.start()
+
+    def close(self):
+        """Stops the HTTP server and writes the final file dump."""
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+        if self._dump_thread is not None:
+            self._dump_stop.set()
+            self._dump_thread.join()
+            self._dump_thread = None
+
+
+class StartupTimer:
+    """
+    Wall time of named start-up phases, which may overlap (e.g. models warming
+    up in the background while Telegram connects). Each phase is also set on
+    gauge, if given, under a 'phase' label.
+    """
+
+    def __init__(self, started=None, gauge=None):
+        """started is the perf_counter() reading start-up is measured from (default: now)."""
+        self.started = time.perf_counter() if started is None else started
+        self.gauge = gauge
+        self.phases = {}
+
+    def record(self, phase, seconds):
+        self.phases[phase] = seconds
+        if self.gauge is not None:
+            self.gauge.set(seconds, phase=phase)
+
+    @contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start)
+
+    def mark(self, phase):
+        """Records the time from start-up to now as phase (e.g. 'listening', 'ready')."""
+        self.record(phase, time.perf_counter() - self.started)
+
+    def summary(self):
+        return ", ".join(f"{phase} {seconds:.2f}s" for phase, seconds in self.phases.items())
+
+
+def start_exporters(registry, port=None, dump_path=None, dump_interval=DUMP_INTERVAL, host=METRICS_HOST):
+    """Starts whichever of the HTTP endpoint (port) and the file dump (dump_path) is configured."""
+    if port is not None:
+        try:
+            registry.start_http_server(port, host)
+        except OSError as e:
+            logging.error(f"Could not serve metrics on {host}:{port}: {e}")
+    if dump_path:
+        registry.start_file_dump(dump_path, dump_interval)
+
+
+# Shared by everything in the process, like feature_extractor's services
+registry = MetricsRegistry()
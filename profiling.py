@@ -0,0 +1,245 @@
+# profiling.py
+"""
+On-demand profiling of the live message handlers.
+
+HandlerProfiler.wrap(handler) returns a handler that, while profiling is
+off, only checks a flag before calling the original. Profiling is switched
+on at start-up by setting PROFILE_EVERY=N in the environment, or toggled at
+runtime with SIGUSR1 (kill -USR1 <pid>). While it is on:
+  - every call is timed, and the SLOWEST_K slowest are listed in
+    slowest.json with their chat sizes before and after the call,
+  - every Nth call runs under cProfile; the .prof files of the SLOWEST_K
+    slowest profiled calls are kept (and listed in slowest.json), the rest
+    are deleted,
+  - tracemalloc traces allocations, and every MEMORY_SNAPSHOT_INTERVAL
+    seconds the growth since profiling started is written out, by allocation
+    site, next to the sizes reported by the memory probes (e.g. how many
+    chats and messages conversation_history holds).
+
+cProfile is per thread, so a profile also covers whatever else the event
+loop ran while the sampled call was waiting. Only one call is profiled at
+a time. Open a .prof file with `python -m pstats` or snakeviz.
+"""
+import os
+import json
+import time
+import heapq
+import signal
+import asyncio
+import cProfile
+import logging
+import itertools
+import tracemalloc
+from collections import deque
+from datetime import datetime, timezone
+
+# --- Configuration ---
+PROFILE_ENV = 'PROFILE_EVERY'      # PROFILE_EVERY=N: profiling on from start-up, cProfile every Nth call
+PROFILE_SIGNAL = getattr(signal, 'SIGUSR1', None)
+SAMPLE_EVERY = 50
+SLOWEST_K = 10
+TRACEMALLOC_FRAMES = 1                # Growth is reported per allocating line
+MEMORY_SNAPSHOT_INTERVAL = 300     # Seconds; taking a snapshot pauses the event loop briefly
+MEMORY_SNAPSHOTS_KEPT = 10
+MEMORY_TOP_STATS = 25
+
+
+class HandlerProfiler:
+    """Samples a message handler with cProfile and tracemalloc while enabled."""
+
+    def __init__(self, output_dir, sample_every=SAMPLE_EVERY, slowest_k=SLOWEST_K, chat_size=None,
+                 memory_probes=None, memory_interval=MEMORY_SNAPSHOT_INTERVAL):
+        """
+        chat_size(event), if given, returns the size of the event's chat history.
+        memory_probes maps a name to a function returning the size of what it
+        watches (a number or a dict of numbers), written with each memory snapshot.
+        """
+        self.output_dir = output_dir
+        self.sample_every = max(1, sample_every)
+        self.slowest_k = slowest_k
+        self.chat_size = chat_size
+        self.memory_probes = memory_probes or {}
+        self.memory_interval = memory_interval
+        self.enabled = False
+        self._calls = 0
+        self._active = None             # The cProfile.Profile currently running, if any
+        self._slowest = []              # Min-heaps of (seconds, sequence number, record): every call,
+        self._slowest_profiled = []     # and the profiled calls whose .prof files are kept
+        self._sequence = itertools.count()
+        self._memory_files = deque()
+        self._baseline = None
+        self._last_snapshot = 0.0
+        self._started_tracemalloc = False
+
+    @classmethod
+    def from_env(cls, output_dir, **kwargs):
+        """A profiler that is already enabled if PROFILE_EVERY is set, sampling every that many calls."""
+        value = os.environ.get(PROFILE_ENV)
+        if value:
+            try:
+                kwargs['sample_every'] = int(value)
+            except ValueError:
+                logging.error(f"Ignoring {PROFILE_ENV}={value!r}: expected a number of calls.")
+                return cls(output_dir, **kwargs)
+        profiler = cls(output_dir, **kwargs)
+        if value:
+            profiler.enable()
+        return profiler
+
+    # --- Switching ---
+    def enable(self):
+        if self.enabled:
+            return
+        os.makedirs(self.output_dir, exist_ok=True)
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(TRACEMALLOC_FRAMES)
+            self._started_tracemalloc = True
+        self._baseline = tracemalloc.take_snapshot()
+        self._last_snapshot = time.monotonic()
+        self._calls = 0
+        self.enabled = True
+        logging.warning(f"Handler profiling enabled: cProfile every {self.sample_every} calls, "
+                        f"output in '{self.output_dir}'.")
+
+    def disable(self):
+        """Stops profiling after writing the slowest calls and a final memory snapshot."""
+        if not self.enabled:
+            return
+        self.enabled = False
+        self.write_slowest()
+        self.snapshot_memory()
+        if self._started_tracemalloc:
+            tracemalloc.stop()
+            self._started_tracemalloc = False
+        self._baseline = None
+        logging.warning(f"Handler profiling disabled; results are in '{self.output_dir}'.")
+
+    def toggle(self):
+        self.disable() if self.enabled else self.enable()
+
+    def install_signal_handler(self, sig=PROFILE_SIGNAL):
+        """Toggles profiling when the process receives sig (SIGUSR1). Call from within the event loop."""
+        if sig is None:
+            return
+        try:
+            asyncio.get_running_loop().add_signal_handler(sig, self.toggle)
+        except (NotImplementedError, RuntimeError, ValueError) as e:
+            # No signal support on this platform, or not running in the main thread.
+            logging.debug(f"Profiling signal handler not installed: {e}")
+
+    # --- Handler Wrapping ---
+    def wrap(self, handler):
+        async def wrapper(event):
+            if not self.enabled:
+                return await handler(event)
+            return await self._profiled_call(handler, event)
+        return wrapper
+
+    async def _profiled_call(self, handler, event):
+        self._calls += 1
+        profile = None
+        if self._calls % self.sample_every == 0 and self._active is None:
+            profile = self._active = cProfile.Profile()
+            profile.enable()
+        size_before = self._chat_size(event)
+        start = time.perf_counter()
+        try:
+            return await handler(event)
+        finally:
+            seconds = time.perf_counter() - start
+            if profile is not None:
+                profile.disable()
+                self._active = None
+            if self.enabled:
+                self._record(event, seconds, size_before, profile)
+                if time.monotonic() - self._last_snapshot >= self.memory_interval:
+                    self.snapshot_memory()
+
+    def _chat_size(self, event):
+        if self.chat_size is None:
+            return None
+        try:
+            return self.chat_size(event)
+        except Exception:
+            return None
+
+    # --- Slowest Calls ---
+    def _is_slowest(self, heap, seconds):
+        return len(heap) < self.slowest_k or seconds > heap[0][0]
+
+    def _push(self, heap, entry):
+        """Adds entry to a top-K heap; returns the record it pushed out, if any."""
+        if len(heap) < self.slowest_k:
+            heapq.heappush(heap, entry)
+            return None
+        return heapq.heapreplace(heap, entry)[2]
+
+    def _record(self, event, seconds, size_before, profile):
+        keep_profile = profile is not None and self._is_slowest(self._slowest_profiled, seconds)
+        if not keep_profile and not self._is_slowest(self._slowest, seconds):
+            return
+        sequence = next(self._sequence)
+        chat_id = getattr(event, 'chat_id', None)
+        record = {
+            'seconds': round(seconds, 6),
+            'chat_id': chat_id,
+            'chat_size_before': size_before,
+            'chat_size_after': self._chat_size(event),
+            'finished_at': datetime.now(timezone.utc).isoformat(),
+            'profile': None,
+        }
+        if keep_profile:
+            record['profile'] = f"slow_{sequence:06d}_chat{chat_id}_{seconds * 1000:.0f}ms.prof"
+            profile.dump_stats(os.path.join(self.output_dir, record['profile']))
+            evicted = self._push(self._slowest_profiled, (seconds, sequence, record))
+            if evicted is not None:
+                self._remove(evicted['profile'])
+                # The record may still be listed under 'slowest', which shares it.
+                evicted['profile'] = None
+        if self._is_slowest(self._slowest, seconds):
+            self._push(self._slowest, (seconds, sequence, record))
+        self.write_slowest()
+
+    def write_slowest(self):
+        """Writes the slowest calls and the slowest profiled calls so far, slowest first, to slowest.json."""
+        summary = {
+            'calls_seen': self._calls,
+            'sample_every': self.sample_every,
+            'slowest': [record for _, _, record in sorted(self._slowest, reverse=True)],
+            'slowest_profiled': [record for _, _, record in sorted(self._slowest_profiled, reverse=True)],
+        }
+        with open(os.path.join(self.output_dir, 'slowest.json'), 'w') as f:
+            json.dump(summary, f, indent=2)
+
+    def _remove(self, filename):
+        if filename:
+            try:
+                os.remove(os.path.join(self.output_dir, filename))
+            except OSError:
+                pass
+
+    # --- Memory ---
+    def snapshot_memory(self):
+        """Writes allocation growth since profiling started, with the memory probes' sizes."""
+        if self._baseline is None or not tracemalloc.is_tracing():
+            return
+        self._last_snapshot = time.monotonic()
+        snapshot = tracemalloc.take_snapshot().filter_traces([tracemalloc.Filter(False, tracemalloc.__file__)])
+        growth = snapshot.compare_to(self._baseline, 'lineno')
+        current, peak = tracemalloc.get_traced_memory()
+
+        filename = f"memory_{next(self._sequence):06d}_{datetime.now(timezone.utc):%Y%m%d_%H%M%S}.txt"
+        with open(os.path.join(self.output_dir, filename), 'w') as f:
+            f.write(f"Traced memory: {current / 1e6:.1f} MB (peak {peak / 1e6:.1f} MB)\n")
+            for name, probe in self.memory_probes.items():
+                try:
+                    f.write(f"{name}: {probe()}\n")
+                except Exception as e:
+                    f.write(f"{name}: probe failed ({e})\n")
+            f.write(f"\nTop {MEMORY_TOP_STATS} allocation sites by growth since profiling started:\n")
+            for stat in growth[:MEMORY_TOP_STATS]:
+                f.write(f"{stat}\n")
+
+        self._memory_files.append(filename)
+        while len(self._memory_files) > MEMORY_SNAPSHOTS_KEPT:
+            self._remove(self._memory_files.popleft())
@@ -6,8 +6,6 @@ pre-trained machine learning model to predict and alert for potential honeytraps
 """
 
 import asyncio
-import joblib
-import pandas as pd
 from telethon import TelegramClient, events
 from collections import defaultdict
 import logging
@@ -25,18 +23,32 @@ MODEL_PATH = 'honeytrap_detector.joblib'
 THREAT_THRESHOLD = 3
 # Maximum number of messages to keep in memory for each chat history.
 MAX_HISTORY_LENGTH = 50
+# Where spaCy and the model run: 'thread', or 'process' for workers that preload them.
+CLASSIFY_MODE = 'thread'
+CLASSIFY_WORKERS = 4
+# Messages are handled one at a time per chat, with up to this many chats in parallel.
+MAX_CONCURRENT_CHATS = 32
+MAX_QUEUE_DEPTH = 20                # Pending messages per chat before new ones wait for room
+# Histories and threat counters survive restarts here.
+STATE_DB_PATH = 'monitor_state.db'
+# Prometheus endpoint on 127.0.0.1 (None disables it), and an optional file rewritten periodically.
+METRICS_PORT = 9109
+METRICS_DUMP_PATH = None
+METRICS_DUMP_INTERVAL = 15
+# Handler profiling: off unless PROFILE_EVERY=N is set or SIGUSR1 toggles it (see profiling.py).
+PROFILE_DIR = 'profiles/realtime_detector'
 
 # --- Feature Extraction ---
 # (Assuming feature_extractor.py is in the same directory)
 try:
-    from feature_extractor import (
-        calculate_behavioral_features,
-        calculate_linguistic_features,
-        calculate_graph_proxy_features,
-    )
-    import spacy
-    # Load the spaCy model once
-    nlp = spacy.load("en_core_web_sm")
+    from feature_extractor import MessageRingBuffer, load_ner_model
+    from inference_executor import ClassificationExecutor
+    from chat_scheduler import ChatScheduler
+    from state_store import ConversationStateStore
+    from metrics import registry as metrics, start_exporters
+    from profiling import HandlerProfiler
+    # Load the spaCy model once, trimmed to the NER component
+    nlp = load_ner_model()
 except (ImportError, OSError) as e:
     print(f"Error loading dependencies: {e}")
     print("Please ensure feature_extractor.py is in the same directory and you have run:")
@@ -50,43 +62,49 @@ logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(
 
 # --- Global Variables ---
 # In-memory storage for conversation histories and threat counters.
-conversation_history = defaultdict(list)
+# Each history is a MessageRingBuffer: a fixed-size typed array of the last
+# MAX_HISTORY_LENGTH messages, so memory per chat is bounded.
+conversation_history = {}
 threat_counters = defaultdict(int)
 
+# --- Metrics ---
+MESSAGE_SECONDS = metrics.histogram('detector_message_seconds', "Time to handle one incoming message, end to end.")
+STAGE_SECONDS = metrics.histogram('detector_stage_seconds', "Time spent in each step of handling a message.",
+                                  ('stage',))
+CLASSIFICATIONS = metrics.counter('detector_classifications_total', "Messages classified, by prediction.",
+                                  ('result',))
+ALERTS = metrics.counter('detector_alerts_total', "High-risk alerts sent to Saved Messages.")
+metrics.gauge('detector_active_chats', "Chats whose history is held in memory.",
+              callback=lambda: len(conversation_history))
+metrics.gauge('detector_history_messages', "Messages held in memory across all chat histories.",
+              callback=lambda: sum(map(len, list(conversation_history.values()))))
 
-def extract_features_from_history(chat_history_df, user_id, contact_id):
-    """
-    Extracts all required features from the chat history DataFrame.
-    """
-    if chat_history_df.empty:
-        return None
-
-    behavioral = calculate_behavioral_features(chat_history_df, user_id, contact_id)
-    linguistic = calculate_linguistic_features(chat_history_df, nlp)
-    graph = calculate_graph_proxy_features(chat_history_df)
-
-    all_features = {**behavioral, **linguistic, **graph}
-
-    # Add the id_is_recent feature — critical for real-time prediction
-    all_features['id_is_recent'] = int(str(contact_id).startswith(('74', '75', '76')))
 
-    # The conceptual feature is not used by the model
-    if 'isolation_index_CONCEPTUAL' in all_features:
-        del all_features['isolation_index_CONCEPTUAL']
+def set_threat_counter(state_store, chat_id, value):
+    threat_counters[chat_id] = value
+    state_store.set_state(chat_id, 'threat_counter', value)
 
-    return pd.DataFrame([all_features])
 
-
-
-async def main():
+async def main(client=None):
     """
     Main function to initialize the client, load the model,
-    and start listening for messages.
+    and start listening for messages. client replaces the TelegramClient
+    (e.g. replay_harness.FakeTelegramClient).
     """
+    # --- Initialize Telegram Client ---
+    if client is None:
+        if API_ID == 'YOUR_API_ID' or API_HASH == 'YOUR_API_HASH':
+            logging.error("Please replace 'YOUR_API_ID' and 'YOUR_API_HASH' with your credentials.")
+            return
+        client = TelegramClient(SESSION_NAME, API_ID, API_HASH)
+
     # --- Load the Model ---
     try:
         logging.info(f"Loading model from {MODEL_PATH}...")
-        model = joblib.load(MODEL_PATH)
+        classifier = ClassificationExecutor({'main': MODEL_PATH}, mode=CLASSIFY_MODE,
+                                            max_workers=CLASSIFY_WORKERS, nlp_model=nlp,
+                                            stage_histogram=STAGE_SECONDS)
+        await classifier.warm_up()
         logging.info("Model loaded successfully.")
     except FileNotFoundError:
         logging.error(f"Error: Model file not found at '{MODEL_PATH}'.")
@@ -95,13 +113,6 @@ async def main():
         logging.error(f"An error occurred while loading the model: {e}")
         return
 
-    # --- Initialize Telegram Client ---
-    if API_ID == 'YOUR_API_ID' or API_HASH == 'YOUR_API_HASH':
-        logging.error("Please replace 'YOUR_API_ID' and 'YOUR_API_HASH' with your credentials.")
-        return
-
-    client = TelegramClient(SESSION_NAME, API_ID, API_HASH)
-
     try:
         await client.start()
         logging.info("Telegram client started successfully.")
@@ -109,56 +120,75 @@ async def main():
         logging.info(f"Logged in as {me.first_name} (ID: {me.id})")
     except Exception as e:
         logging.error(f"Failed to start Telegram client: {e}")
+        classifier.close()
         return
+    state_store = ConversationStateStore(STATE_DB_PATH, keep_last=MAX_HISTORY_LENGTH)
+
+    start_exporters(metrics, METRICS_PORT, METRICS_DUMP_PATH, METRICS_DUMP_INTERVAL)
+    profiler = HandlerProfiler.from_env(
+        PROFILE_DIR,
+        chat_size=lambda event: len(conversation_history[event.chat_id]) if event.chat_id in conversation_history else 0,
+        memory_probes={
+            'conversation_history': lambda: {'chats': len(conversation_history),
+                                             'messages': sum(map(len, list(conversation_history.values())))},
+            'threat_counters': lambda: len(threat_counters),
+        })
+    profiler.install_signal_handler()
 
-    @client.on(events.NewMessage(incoming=True))
     async def handle_new_message(event):
         """
-        Event handler for new incoming messages.
+        Event handler for new incoming messages. The scheduler runs at most one
+        of these per chat at a time, so a chat's history is never scored by two.
         """
-        # We are only interested in private chats
-        if not event.is_private:
-            return
-
         chat_id = event.chat_id
-        sender = await event.get_sender()
+        with STAGE_SECONDS.time(stage='get_sender'):
+            sender = await event.get_sender()
         message_text = event.message.text
         message_date = event.message.date
 
         logging.info(f"New message from {sender.first_name} (Chat ID: {chat_id}): '{message_text}'")
 
         # --- Maintain Conversation History ---
-        # Add the new message to the history
-        conversation_history[chat_id].append({
+        # Appending is O(1); once MAX_HISTORY_LENGTH is reached the oldest
+        # message's slot is overwritten.
+        if chat_id not in conversation_history:
+            conversation_history[chat_id] = MessageRingBuffer(me.id, nlp, capacity=MAX_HISTORY_LENGTH)
+            # First message since start-up: pick up where the previous run left off.
+            with STAGE_SECONDS.time(stage='restore'):
+                restored = await asyncio.to_thread(state_store.restore_chat, chat_id, limit=MAX_HISTORY_LENGTH)
+                if restored:
+                    messages, state = restored
+                    conversation_history[chat_id].extend(messages)
+                    threat_counters[chat_id] = state.get('threat_counter', 0)
+        message = {
             'date': message_date,
             'text': message_text,
             'sender_id': sender.id,
             'sender_type': 'contact' # Since it's an incoming message
-        })
-
-        # Keep the history from getting too long
-        if len(conversation_history[chat_id]) > MAX_HISTORY_LENGTH:
-            conversation_history[chat_id].pop(0)
-
-        # Create a DataFrame from the history
-        history_df = pd.DataFrame(conversation_history[chat_id])
-        history_df['date'] = pd.to_datetime(history_df['date'])
-
-        # --- Analyze in Real-Time ---
-        features_df = extract_features_from_history(history_df, me.id, sender.id)
-
-        if features_df is None:
-            logging.warning(f"Could not extract features for chat {chat_id}. Not enough data.")
-            return
+        }
+        conversation_history[chat_id].append(message)
+        state_store.append_message(chat_id, message)
 
-        # --- Predict Risk ---
+        # --- Analyze and Predict Risk ---
+        # Scoring and prediction run on the classifier's pool, off the event loop.
         try:
-            prediction = model.predict(features_df)[0]
+            # The id_is_recent feature is critical for real-time prediction
+            id_is_recent = int(str(sender.id).startswith(('74', '75', '76')))
+            with STAGE_SECONDS.time(stage='classification'):
+                features_df, votes = await classifier.classify(conversation_history[chat_id], {'id_is_recent': id_is_recent})
+
+            if features_df is None:
+                CLASSIFICATIONS.inc(result='failed')
+                logging.warning(f"Could not extract features for chat {chat_id}. Not enough data.")
+                return
+
+            prediction = votes['main']
+            CLASSIFICATIONS.inc(result=prediction)
             logging.info(f"Prediction for chat {chat_id}: {prediction}")
 
             # --- Alert Intelligently ---
             if prediction == 'Honeytrap':
-                threat_counters[chat_id] += 1
+                set_threat_counter(state_store, chat_id, threat_counters[chat_id] + 1)
                 logging.warning(f"Threat detected for chat {chat_id}. Counter: {threat_counters[chat_id]}")
                 if threat_counters[chat_id] >= THREAT_THRESHOLD:
                     alert_message = (
@@ -167,22 +197,45 @@ async def main():
                         f"Please review this conversation carefully."
                     )
                     # Send alert to your "Saved Messages"
-                    await client.send_message('me', alert_message)
+                    with STAGE_SECONDS.time(stage='send'):
+                        await client.send_message('me', alert_message)
+                    ALERTS.inc()
                     logging.critical(f"High-risk alert sent for chat {chat_id}.")
                     # Reset counter after sending an alert to avoid spamming
-                    threat_counters[chat_id] = 0
+                    set_threat_counter(state_store, chat_id, 0)
             else: # Benign
                 # If the conversation is benign, reset the counter.
                 if threat_counters[chat_id] > 0:
                     logging.info(f"Threat counter for chat {chat_id} reset to 0.")
-                    threat_counters[chat_id] = 0
+                    set_threat_counter(state_store, chat_id, 0)
 
         except Exception as e:
             logging.error(f"An error occurred during prediction for chat {chat_id}: {e}")
 
+    async def timed_handler(event):
+        with MESSAGE_SECONDS.time():
+            await handle_new_message(event)
+
+    scheduler = ChatScheduler(profiler.wrap(timed_handler), max_concurrent_chats=MAX_CONCURRENT_CHATS,
+                              max_queue_depth=MAX_QUEUE_DEPTH)
+
+    @client.on(events.NewMessage(incoming=True))
+    async def on_new_message(event):
+        # We are only interested in private chats
+        if not event.is_private:
+            return
+        # Queued per chat: ordered within a chat, parallel across chats.
+        await scheduler.submit(event.chat_id, event)
 
     logging.info("Listening for new messages...")
-    await client.run_until_disconnected()
+    try:
+        await client.run_until_disconnected()
+    finally:
+        await scheduler.close()
+        profiler.disable()
+        classifier.close()
+        state_store.close()
+        metrics.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,506 @@
+# replay_harness.py
+"""
+Offline end-to-end load test for approach2.py and realtime_detector.py.
+
+Chat exports (the benign_chats/ and honeypot_chats/ format written by
+faker-generation*.py) are replayed through the bots' real message handlers
+by FakeTelegramClient, which stands in for telethon's TelegramClient. The
+contact's messages arrive as a Poisson stream at --rate messages per second
+spread over --chats concurrently active chats, stamped with dates from a
+SimulatedClock that runs --speed times faster than the wall clock. LLM calls
+go to StubOllamaServer, which answers /api/generate and /api/chat after a
+configurable delay. Handler latency (arrival to handler completion, so it
+includes per-chat queueing), throughput and peak RSS are reported.
+
+    python replay_harness.py approach2 benign_chats honeypot_chats --chats 50 --rate 100
+    python replay_harness.py realtime_detector honeypot_chats --rate 0 --json result.json
+"""
+import os
+import re
+import sys
+import json
+import glob
+import time
+import random
+import asyncio
+import logging
+import argparse
+import resource
+import tempfile
+import importlib
+import threading
+import multiprocessing
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+
+import llm_interaction
+
+# --- Configuration ---
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+APPS = ('approach2', 'realtime_detector')
+DEFAULT_RATE = 50.0          # Incoming messages per second across all chats (0 = as fast as possible)
+DEFAULT_CHATS = 20           # Chats replaying at the same time
+DEFAULT_SPEED = 60.0         # Simulated seconds per wall-clock second
+DRAIN_TIMEOUT = 120          # Seconds to wait for handlers after the last message
+STUB_LLM_LATENCY = 0.2       # Seconds before the stub LLM answers
+STUB_TOKEN_DELAY = 0.01      # Seconds between streamed stub tokens
+STUB_REPLY = "omg really?? how does it work, is it easy?"
+STUB_ANALYSIS = {
+    "scam_type": "Investment Scam",
+    "scammer_tactic": "replayed stub analysis",
+    "red_flags_identified": "pressure to act quickly, request for money",
+    "extracted_details": ["replay harness"],
+    "hacker_strategy_summary": "Stub response from the replay harness."
+}
+PEER_USER = re.compile(r'PeerUser\(user_id=(\d+)\)')
+
+
+# --- Chat Exports ---
+def _message_text(text):
+    """Telegram exports store formatted text as a list of strings and entity dicts."""
+    if isinstance(text, list):
+        return "".join(part if isinstance(part, str) else part.get('text', '') for part in text)
+    return text or ""
+
+
+def _sender_id(from_id):
+    if isinstance(from_id, int):
+        return from_id
+    match = PEER_USER.search(str(from_id)) if from_id else None
+    return int(match.group(1)) if match else None
+
+
+def load_replay_chats(paths, repeat=1):
+    """
+    Reads chat exports from files or directories and returns one script per
+    chat: {'chat_id', 'contact_id', 'contact_name', 'owner', 'texts'}, where
+    texts are the contact's messages in order. Each export is used repeat
+    times under distinct chat ids.
+    """
+    files = []
+    for path in paths:
+        files.extend(sorted(glob.glob(os.path.join(path, '*.json'))) if os.path.isdir(path) else [path])
+    chats = []
+    for file_path in files:
+        try:
+            with open(file_path, encoding='utf-8') as f:
+                data = json.load(f)
+            owner = data['user_info']
+        except (OSError, ValueError, KeyError) as e:
+            logging.warning(f"Skipping '{file_path}': {e}")
+            continue
+        contact_id, texts = None, []
+        for message in data.get('messages', []):
+            sender = _sender_id(message.get('from_id'))
+            if sender is None or sender == owner.get('id'):
+                continue
+            contact_id = contact_id or sender
+            texts.append(_message_text(message.get('text')))
+        if contact_id is None or not texts:
+            continue
+        for copy in range(repeat):
+            chats.append({
+                'chat_id': contact_id + copy * 10**10,
+                'contact_id': contact_id + copy * 10**10,
+                'contact_name': f"Contact{len(chats)}",
+                'owner': owner,
+                'texts': texts,
+            })
+    return chats
+
+
+# --- Simulated Clock ---
+class SimulatedClock:
+    """Wall time since construction, scaled by speed, added to a fixed start date."""
+
+    def __init__(self, start=None, speed=DEFAULT_SPEED):
+        self.start_date = start or datetime(2025, 1, 1, 9, tzinfo=timezone.utc)
+        self.speed = speed
+        self._t0 = time.monotonic()
+
+    def now(self):
+        return self.start_date + timedelta(seconds=(time.monotonic() - self._t0) * self.speed)
+
+
+# --- Fake Telethon Objects ---
+class FakeUser:
+    def __init__(self, user_id, first_name):
+        self.id = user_id
+        self.first_name = first_name
+
+
+class FakeMessage:
+    def __init__(self, message_id, text, date):
+        self.id = message_id
+        self.text = text
+        self.message = text
+        self.date = date
+
+
+class FakeEvent:
+    """The parts of telethon's events.NewMessage.Event the bots use, plus timing."""
+
+    def __init__(self, chat_id, message, sender):
+        self.chat_id = chat_id
+        self.message = message
+        self.sender = sender
+        self.is_private = True
+        self.arrived = time.perf_counter()
+        self.finished = None
+        self.done = asyncio.get_running_loop().create_future()
+
+    async def get_sender(self):
+        return self.sender
+
+    def handled(self):
+        if not self.done.done():
+            self.finished = time.perf_counter()
+            self.done.set_result(self.finished - self.arrived)
+
+
+class FakeTelegramClient:
+    """
+    Stand-in for telethon.TelegramClient. Handlers registered with on() get
+    every event passed to dispatch(); run_until_disconnected() returns once
+    disconnect() is called. Outgoing messages are only counted.
+    """
+
+    def __init__(self, me, completes_events=True):
+        """With completes_events False, something else (e.g. a scheduler hook) marks events handled."""
+        self.me = me
+        self.completes_events = completes_events
+        self.handlers = []
+        self.sent = 0
+        self._disconnected = asyncio.Event()
+        self._tasks = set()
+
+    def on(self, event_builder):
+        def register(handler):
+            self.handlers.append(handler)
+            return handler
+        return register
+
+    async def start(self):
+        return self
+
+    async def get_me(self):
+        return self.me
+
+    async def send_message(self, entity, message):
+        self.sent += 1
+
+    @asynccontextmanager
+    async def action(self, entity, action):
+        yield
+
+    def dispatch(self, event):
+        task = asyncio.create_task(self._dispatch(event))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _dispatch(self, event):
+        for handler in self.handlers:
+            try:
+                await handler(event)
+            except Exception as e:
+                logging.error(f"Handler raised for chat {event.chat_id}: {e}", exc_info=True)
+        if self.completes_events:
+            event.handled()
+
+    async def run_until_disconnected(self):
+        await self._disconnected.wait()
+
+    def disconnect(self):
+        """Like TelegramClient.disconnect() in a running loop, returns an awaitable."""
+        self._disconnected.set()
+        done = asyncio.get_running_loop().create_future()
+        done.set_result(None)
+        return done
+
+
+# --- Stub Ollama ---
+class StubOllamaServer:
+    """
+    Minimal Ollama API (/api/generate, /api/chat, streaming or not) on its own
+    thread and event loop, so its work does not skew the bot's latencies.
+    Scam analysis prompts get a fixed JSON analysis, everything else STUB_REPLY.
+    """
+
+    def __init__(self, latency=STUB_LLM_LATENCY, token_delay=STUB_TOKEN_DELAY, port=0):
+        self.latency = latency
+        self.token_delay = token_delay
+        self.port = port
+        self.requests = 0
+        self._loop = None
+        self._runner = None
+        self._thread = None
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.port}"
+
+    def start(self):
+        ready = threading.Event()
+        self._thread = threading.Thread(target=self._serve, args=(ready,), name='stub-ollama', daemon=True)
+        self._thread.start()
+        ready.wait()
+        return self
+
+    def stop(self):
+        if self._loop is not None:
+            asyncio.run_coroutine_threadsafe(self._runner.cleanup(), self._loop).result()
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join()
+
+    def _serve(self, ready):
+        from aiohttp import web
+        self._loop = asyncio.new_event_loop()
+        app = web.Application()
+        app.router.add_post('/api/generate', self._handle)
+        app.router.add_post('/api/chat', self._handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        self._loop.run_until_complete(self._runner.setup())
+        site = web.TCPSite(self._runner, '127.0.0.1', self.port)
+        self._loop.run_until_complete(site.start())
+        self.port = site._server.sockets[0].getsockname()[1]
+        ready.set()
+        self._loop.run_forever()
+
+    async def _handle(self, request):
+        from aiohttp import web
+        self.requests += 1
+        body = await request.json()
+        is_chat = 'messages' in body
+        prompt = body['messages'][-1]['content'] if is_chat else body.get('prompt', '')
+        text = json.dumps(STUB_ANALYSIS) if 'Analyze the following conversation' in prompt else STUB_REPLY
+
+        def chunk(content, done):
+            data = {'message': {'role': 'assistant', 'content': content}} if is_chat else {'response': content}
+            data['done'] = done
+            if done:
+                data.update(prompt_eval_count=len(prompt) // 4, eval_count=len(text) // 4)
+            return data
+
+        await asyncio.sleep(self.latency)
+        if not body.get('stream', True):
+            return web.json_response(chunk(text, True))
+        response = web.StreamResponse()
+        await response.prepare(request)
+        try:
+            for token in re.findall(r'\S+\s*', text):
+                await response.write((json.dumps(chunk(token, False)) + '\n').encode('utf-8'))
+                await asyncio.sleep(self.token_delay)
+            await response.write((json.dumps(chunk('', True)) + '\n').encode('utf-8'))
+        except ConnectionResetError:
+            pass    # The client stopped the stream early
+        return response
+
+
+# --- Replay ---
+def _peak_rss_mb():
+    """Peak resident set size of this process (ru_maxrss is KiB on Linux, bytes on macOS)."""
+    divisor = 1024 * 1024 if sys.platform == 'darwin' else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / divisor
+
+
+def _worker_peak_rss_mb():
+    """
+    Summed peak RSS of live worker processes (e.g. process-mode classification
+    pools), from /proc; 0 where /proc is unavailable.
+    """
+    total_kb = 0
+    for child in multiprocessing.active_children():
+        try:
+            with open(f"/proc/{child.pid}/status") as f:
+                for line in f:
+                    if line.startswith('VmHWM:'):
+                        total_kb += int(line.split()[1])
+        except OSError:
+            continue
+    return total_kb / 1024
+
+
+def _latency_summary(latencies):
+    if not latencies:
+        return {}
+    values = np.asarray(latencies) * 1000
+    p50, p95, p99 = np.percentile(values, [50, 95, 99])
+    return {'p50': round(float(p50), 2), 'p95': round(float(p95), 2), 'p99': round(float(p99), 2),
+            'mean': round(float(values.mean()), 2), 'max': round(float(values.max()), 2)}
+
+
+def _prepare_app(app_name, log_level, classify_mode):
+    """
+    Imports the bot module with absolute model paths, so it can run inside the
+    replay's working directory, where it writes its databases and saved chats.
+    """
+    module = importlib.import_module(app_name)
+    logging.getLogger().setLevel(log_level)
+    if classify_mode is not None:
+        module.CLASSIFY_MODE = classify_mode
+    if app_name == 'approach2':
+        module.MAIN_MODEL_PATH = os.path.join(REPO_DIR, module.MAIN_MODEL_PATH)
+        module.SENTIMENT_MODEL_PATH = os.path.join(REPO_DIR, module.SENTIMENT_MODEL_PATH)
+    else:
+        module.MODEL_PATH = os.path.join(REPO_DIR, module.MODEL_PATH)
+
+    # Both bots queue events on a ChatScheduler; an event is handled when its
+    # handle_new_message call returns, not when on_new_message does.
+    class TimedChatScheduler(module.ChatScheduler):
+        def __init__(self, handler, *args, **kwargs):
+            async def timed_handler(event):
+                try:
+                    await handler(event)
+                finally:
+                    event.handled()
+            super().__init__(timed_handler, *args, **kwargs)
+    module.ChatScheduler = TimedChatScheduler
+    return module
+
+
+async def _feed(client, chats, clock, rate, concurrent_chats, seed):
+    """Delivers the chats' messages as a Poisson stream; returns every dispatched event."""
+    rnd = random.Random(seed)
+    pending = list(chats)
+    active = []
+    events = []
+    message_id = 0
+    loop = asyncio.get_running_loop()
+    next_arrival = loop.time()
+    while pending or active:
+        while pending and len(active) < concurrent_chats:
+            chat = pending.pop(0)
+            active.append([chat, 0, FakeUser(chat['contact_id'], chat['contact_name'])])
+        slot = rnd.randrange(len(active))
+        chat, position, sender = active[slot]
+        if rate:
+            next_arrival += rnd.expovariate(rate)
+            await asyncio.sleep(max(next_arrival - loop.time(), 0))
+        else:
+            await asyncio.sleep(0)
+        message_id += 1
+        event = FakeEvent(chat['chat_id'], FakeMessage(message_id, chat['texts'][position], clock.now()), sender)
+        events.append(event)
+        client.dispatch(event)
+        active[slot][1] += 1
+        if active[slot][1] >= len(chat['texts']):
+            active.pop(slot)
+    return events
+
+
+async def replay(app_name, chats, rate=DEFAULT_RATE, concurrent_chats=DEFAULT_CHATS, speed=DEFAULT_SPEED,
+                 workdir=None, drain_timeout=DRAIN_TIMEOUT, stub=None, seed=0, log_level=logging.WARNING,
+                 classify_mode=None):
+    """
+    Replays chats through app_name's handlers and returns the measurements.
+    Point llm_interaction.OLLAMA_HOST at a stub server before calling.
+    """
+    workdir = os.path.abspath(workdir or tempfile.mkdtemp(prefix='replay_'))
+    os.makedirs(workdir, exist_ok=True)
+    module = _prepare_app(app_name, log_level, classify_mode)
+    previous_cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        return await _replay(module, app_name, chats, rate, concurrent_chats, speed, workdir, drain_timeout,
+                             stub, seed)
+    finally:
+        os.chdir(previous_cwd)
+
+
+async def _replay(module, app_name, chats, rate, concurrent_chats, speed, workdir, drain_timeout, stub, seed):
+    owner = chats[0]['owner'] if chats else {'id': 1}
+    client = FakeTelegramClient(FakeUser(owner['id'], owner.get('first_name', 'Replay')), completes_events=False)
+    app_task = asyncio.create_task(module.main(client=client))
+
+    # Wait for main() to load its models and register its handler.
+    while not client.handlers:
+        if app_task.done():
+            raise RuntimeError(f"{app_name}.main() exited before registering a handler.")
+        await asyncio.sleep(0.05)
+
+    clock = SimulatedClock(speed=speed)
+    started = time.perf_counter()
+    events = await _feed(client, chats, clock, rate, concurrent_chats, seed)
+    fed = time.perf_counter()
+    done, unfinished = await asyncio.wait([event.done for event in events], timeout=drain_timeout) \
+        if events else (set(), set())
+    finished = max((event.finished for event in events if event.finished is not None), default=fed)
+    worker_rss = _worker_peak_rss_mb()
+
+    client.disconnect()
+    await app_task
+    latencies = [event.finished - event.arrived for event in events if event.finished is not None]
+    elapsed = finished - started
+    return {
+        'app': app_name,
+        'chats': len(chats),
+        'messages': len(events),
+        'handled': len(latencies),
+        'unfinished': len(unfinished),
+        'rate': rate,
+        'concurrent_chats': concurrent_chats,
+        'classify_mode': module.CLASSIFY_MODE,
+        'feed_seconds': round(fed - started, 3),
+        'wall_seconds': round(elapsed, 3),
+        'throughput_msgs_per_s': round(len(latencies) / elapsed, 2) if elapsed > 0 else 0.0,
+        'latency_ms': _latency_summary(latencies),
+        'peak_rss_mb': round(_peak_rss_mb(), 1),
+        'worker_peak_rss_mb': round(worker_rss, 1),
+        'replies_sent': client.sent,
+        'llm_requests': stub.requests if stub is not None else None,
+        'workdir': workdir,
+    }
+
+
+def run_replay(app_name, paths, repeat=1, llm_latency=STUB_LLM_LATENCY, token_delay=STUB_TOKEN_DELAY, **kwargs):
+    """Starts the stub Ollama server, replays the exports under paths and returns the measurements."""
+    chats = load_replay_chats(paths, repeat)
+    if not chats:
+        raise ValueError(f"No replayable chats found in {paths}.")
+    stub = StubOllamaServer(llm_latency, token_delay).start()
+    llm_interaction.OLLAMA_HOST = stub.url
+    try:
+        return asyncio.run(replay(app_name, chats, stub=stub, **kwargs))
+    finally:
+        stub.stop()
+
+
+def print_report(result):
+    latency = result['latency_ms']
+    print(f"\n--- Replay of {result['messages']} messages in {result['chats']} chats through {result['app']} ---")
+    print(f"Handled: {result['handled']}  Unfinished: {result['unfinished']}  Replies sent: {result['replies_sent']}  "
+          f"LLM requests: {result['llm_requests']}")
+    print(f"Wall time: {result['wall_seconds']}s  Throughput: {result['throughput_msgs_per_s']} msg/s")
+    if latency:
+        print(f"Handler latency (ms): p50 {latency['p50']}  p95 {latency['p95']}  p99 {latency['p99']}  "
+              f"max {latency['max']}")
+    print(f"Peak RSS: {result['peak_rss_mb']} MB (worker processes: {result['worker_peak_rss_mb']} MB)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay exported chats through a bot with a fake Telegram client.")
+    parser.add_argument('app', choices=APPS)
+    parser.add_argument('paths', nargs='+', help="Chat export files or directories of them.")
+    parser.add_argument('--rate', type=float, default=DEFAULT_RATE, help="Messages per second (0 = unthrottled).")
+    parser.add_argument('--chats', type=int, default=DEFAULT_CHATS, help="Concurrently active chats.")
+    parser.add_argument('--speed', type=float, default=DEFAULT_SPEED, help="Simulated seconds per real second.")
+    parser.add_argument('--repeat', type=int, default=1, help="Replay each export this many times.")
+    parser.add_argument('--llm-latency', type=float, default=STUB_LLM_LATENCY, help="Stub LLM delay in seconds.")
+    parser.add_argument('--token-delay', type=float, default=STUB_TOKEN_DELAY, help="Stub delay per streamed token.")
+    parser.add_argument('--workdir', help="Where the bot writes its databases and saved chats (default: a temp dir).")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--classify-mode', choices=('thread', 'process'), help="Override the bot's CLASSIFY_MODE.")
+    parser.add_argument('--log-level', default='WARNING', help="Log level for the bot while replaying.")
+    parser.add_argument('--json', help="Also write the results to this file.")
+    args = parser.parse_args()
+
+    result = run_replay(args.app, args.paths, repeat=args.repeat, llm_latency=args.llm_latency,
+                        token_delay=args.token_delay, rate=args.rate, concurrent_chats=args.chats,
+                        speed=args.speed, workdir=args.workdir, seed=args.seed, log_level=args.log_level.upper(),
+                        classify_mode=args.classify_mode)
+    print_report(result)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(result, f, indent=2)
@@ -2,7 +2,6 @@
 import pandas as pd
 import os
 import json
-import spacy
 import joblib
 import lightgbm as lgb
 from sklearn.linear_model import LogisticRegression
@@ -12,21 +11,32 @@ from sklearn.feature_selection import SelectKBest, f_classif
 from sklearn.metrics import classification_report
 
 # Use the same feature extractor as the live detector
-from feature_extractor import process_chat_history_for_features, is_recent_id
+from feature_extractor import process_many_chat_histories, is_recent_id, sentiment_service, entity_service, load_ner_model
+from training_store import open_training_store, TRAINING_STORE_DIR
+from lean_predictor import export_lean_predictor, lean_path_for
 
 # --- Configuration ---
 APPROVED_FOLDER = 'APPROVED_FOR_TRAINING/'
 BENIGN_FOLDER = 'BENIGN_FOR_TRAINING/'
 ARCHIVE_FOLDER = 'ARCHIVED_TRAINING_DATA/'
-TRAINING_CSV = 'training_data.csv'
 MAIN_MODEL_PATH = 'honeytrap_detector.joblib'
 SENTIMENT_MODEL_PATH = 'sentiment_model.joblib'
 MIN_FILES_TO_RETRAIN = 10
 
+def export_lean_model(model, X, model_path):
+    """Writes the compiled NumPy predictor next to a saved model; the live detector prefers it."""
+    lean_path = lean_path_for(model_path)
+    try:
+        export_lean_predictor(model, X, lean_path)
+        print(f"✅ Lean predictor saved to '{lean_path}'")
+    except ValueError as e:
+        # The older export, if any, is now older than the model and is ignored by load_model.
+        print(f"⚠️ Lean predictor not exported for '{model_path}': {e}")
+
 def prepare_data_and_check_for_updates():
     """
     Checks for new files, processes them using the main feature extractor,
-    appends to the master CSV, and returns True if retraining should proceed.
+    appends to the training store, and returns True if retraining should proceed.
     """
     print("--- 1. Checking for new training data ---")
     os.makedirs(APPROVED_FOLDER, exist_ok=True)
@@ -43,9 +53,12 @@ def prepare_data_and_check_for_updates():
 
     if all_new_files:
         print(f"Found {len(all_new_files)} new files to process...")
-        nlp = spacy.load("en_core_web_sm")
-        master_df = pd.read_csv(TRAINING_CSV) if os.path.exists(TRAINING_CSV) else pd.DataFrame()
-        
+        nlp = load_ner_model()
+        store = open_training_store()
+
+        chats = []
+        labels = {}
+        contact_ids = {}
         for filepath, label in all_new_files:
             filename = os.path.basename(filepath)
             try:
@@ -63,27 +76,35 @@ def prepare_data_and_check_for_updates():
                             break
                 
                 if contact_id:
-                    features_df = process_chat_history_for_features(history, user_id, contact_id, nlp)
-                    if features_df is not None:
-                        features = features_df.to_dict('records')[0]
-                        features['id_is_recent'] = is_recent_id(contact_id)
-                        features['label'] = label
-                        master_df = pd.concat([master_df, pd.DataFrame([features])], ignore_index=True)
-                
-                os.rename(filepath, os.path.join(ARCHIVE_FOLDER, filename))
+                    chats.append((filepath, history, user_id, contact_id))
+                    labels[filepath] = label
+                    contact_ids[filepath] = contact_id
+                else:
+                    os.rename(filepath, os.path.join(ARCHIVE_FOLDER, filename))
             except Exception as e:
                 print(f"Error processing {filename}: {e}")
+
+        # Extract every new chat in one batch, then append them to the store as one partition.
+        features_df = process_many_chat_histories(chats, nlp)
+        features_df['id_is_recent'] = [is_recent_id(contact_ids[key]) for key in features_df.index]
+        features_df['label'] = [labels[key] for key in features_df.index]
+        added = store.append(features_df)
+
+        for filepath, _, _, _ in chats:
+            os.rename(filepath, os.path.join(ARCHIVE_FOLDER, os.path.basename(filepath)))
         
-        master_df.drop_duplicates(inplace=True, ignore_index=True)
-        master_df.to_csv(TRAINING_CSV, index=False)
-        print(f"✅ Updated '{TRAINING_CSV}' with new data.")
+        stats = sentiment_service.stats()
+        print(f"Sentiment cache: {stats['hits']} hits, {stats['misses']} misses.")
+        stats = entity_service.stats()
+        print(f"NER cache: {stats['hits']} hits, {stats['misses']} misses.")
+        print(f"✅ Added {added} new rows to '{TRAINING_STORE_DIR}' ({len(store)} total).")
     
     return True
 
 def train_main_model():
     """Trains and saves the main complex model pipeline."""
     print("\n--- 2a. Training Main Detector Model ---")
-    df = pd.read_csv(TRAINING_CSV)
+    df = open_training_store().read()
     X = df.drop('label', axis=1)
     y = df['label']
     
@@ -104,11 +125,12 @@ def train_main_model():
     
     joblib.dump(random_search.best_estimator_, MAIN_MODEL_PATH)
     print(f"✅ Main model pipeline saved to '{MAIN_MODEL_PATH}'")
+    export_lean_model(random_search.best_estimator_, X, MAIN_MODEL_PATH)
 
 def train_sentiment_model():
     """Trains and saves the simple sentiment escalation model."""
     print("\n--- 2b. Training Sentiment Escalation Model ---")
-    df = pd.read_csv(TRAINING_CSV)
+    df = open_training_store().read(columns=['sentiment_escalation', 'label'])
     X = df[['sentiment_escalation']]
     y = df['label']
     
@@ -117,6 +139,7 @@ def train_sentiment_model():
     
     joblib.dump(model, SENTIMENT_MODEL_PATH)
     print(f"✅ Sentiment model saved to '{SENTIMENT_MODEL_PATH}'")
+    export_lean_model(model, X, SENTIMENT_MODEL_PATH)
 
 if __name__ == "__main__":
     if prepare_data_and_check_for_updates():
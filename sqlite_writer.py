@@ -0,0 +1,146 @@
+# sqlite_writer.py
+"""
+Background writer for SQLite databases shared by the live bots.
+
+Callers queue statements without blocking; one thread owns the write
+connection and commits whatever has queued up (up to batch_size statements,
+or flush_interval seconds' worth) in a single transaction. With WAL mode,
+readers on other connections are never blocked by these commits.
+"""
+import time
+import queue
+import sqlite3
+import logging
+import threading
+import asyncio
+
+# --- Configuration ---
+WRITE_BATCH_SIZE = 500
+FLUSH_INTERVAL = 0.05      # Seconds a batch may wait for more statements before committing
+DEFAULT_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',   # Durable across process crashes; WAL fsyncs at checkpoints
+    'busy_timeout': 5000,
+}
+
+
+def connect(path, pragmas=None, **kwargs):
+    """Opens a connection with the given PRAGMAs (DEFAULT_PRAGMAS if None)."""
+    conn = sqlite3.connect(path, **kwargs)
+    for name, value in (DEFAULT_PRAGMAS if pragmas is None else pragmas).items():
+        conn.execute(f"PRAGMA {name}={value}")
+    return conn
+
+
+class _Marker:
+    __slots__ = ('done',)
+
+    def __init__(self):
+        self.done = threading.Event()
+
+
+class _Flush(_Marker):
+    pass
+
+
+class _Stop(_Marker):
+    pass
+
+
+class BatchedSQLiteWriter:
+    """Owns one SQLite connection on a background thread and commits queued writes in batches."""
+
+    def __init__(self, path, setup=None, batch_size=WRITE_BATCH_SIZE, flush_interval=FLUSH_INTERVAL,
+                 pragmas=None, name='sqlite-writer'):
+        """setup(conn), if given, runs once on the writer connection before any write (e.g. CREATE TABLE)."""
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._pragmas = pragmas
+        self._setup = setup
+        self._queue = queue.Queue()
+        self._ready = threading.Event()
+        self._startup_error = None
+        self.committed = 0
+        self.failed = 0
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+        self._ready.wait()
+        if self._startup_error is not None:
+            raise self._startup_error
+
+    def execute(self, sql, params=()):
+        """Queues one statement; returns immediately."""
+        self._queue.put((sql, params))
+
+    def flush(self, timeout=None):
+        """Blocks until every statement queued so far has been committed. Returns False on timeout."""
+        marker = _Flush()
+        self._queue.put(marker)
+        return marker.done.wait(timeout)
+
+    async def aflush(self):
+        await asyncio.to_thread(self.flush)
+
+    def close(self):
+        """Commits the remaining statements and stops the writer thread."""
+        if not self._thread.is_alive():
+            return
+        marker = _Stop()
+        self._queue.put(marker)
+        self._thread.join()
+
+    # --- Writer thread ---
+    def _run(self):
+        try:
+            conn = connect(self.path, self._pragmas)
+            if self._setup is not None:
+                self._setup(conn)
+                conn.commit()
+        except Exception as e:
+            self._startup_error = e
+            self._ready.set()
+            return
+        self._ready.set()
+
+        while True:
+            batch = self._next_batch()
+            statements = [item for item in batch if not isinstance(item, _Marker)]
+            if statements:
+                self._commit(conn, statements)
+            markers = [item for item in batch if isinstance(item, _Marker)]
+            for marker in markers:
+                marker.done.set()
+            if any(isinstance(marker, _Stop) for marker in markers):
+                conn.close()
+                return
+
+    def _next_batch(self):
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size and not isinstance(batch[-1], _Marker):
+            remaining = deadline - time.monotonic()
+            try:
+                batch.append(self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _commit(self, conn, statements):
+        try:
+            with conn:
+                for sql, params in statements:
+                    conn.execute(sql, params)
+            self.committed += len(statements)
+            return
+        except sqlite3.Error as e:
+            logging.error(f"Batched write of {len(statements)} statements to '{self.path}' failed ({e}); retrying one by one.")
+        # Isolate the bad statement(s) so the rest of the batch is not lost.
+        for sql, params in statements:
+            try:
+                with conn:
+                    conn.execute(sql, params)
+                self.committed += 1
+            except sqlite3.Error as e:
+                self.failed += 1
+                logging.error(f"Dropped write to '{self.path}': {e}")
@@ -0,0 +1,140 @@
+# state_store.py
+"""
+Durable per-chat conversation state for the live bots.
+
+Message appends and state checkpoints (e.g. monitoring status, threat
+counters) are queued to a BatchedSQLiteWriter, so recording them costs the
+event loop a queue put. After a restart nothing is loaded up front: a chat's
+history and state are read back the first time that chat is seen again.
+"""
+import json
+import threading
+from datetime import datetime
+
+from sqlite_writer import BatchedSQLiteWriter, connect
+
+# --- Configuration ---
+STATE_DB_PATH = 'conversation_state.db'
+TRIM_EVERY = 64        # With keep_last set, old messages are pruned every TRIM_EVERY appends per chat
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY,
+    chat_id INTEGER NOT NULL,
+    date TEXT,
+    text TEXT,
+    sender_id INTEGER,
+    sender_type TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_messages_chat ON messages (chat_id, id);
+CREATE TABLE IF NOT EXISTS chat_state (
+    chat_id INTEGER NOT NULL,
+    key TEXT NOT NULL,
+    value TEXT NOT NULL,
+    PRIMARY KEY (chat_id, key)
+) WITHOUT ROWID;
+"""
+
+
+def _encode_date(value):
+    return value.isoformat() if isinstance(value, datetime) else (None if value is None else str(value))
+
+
+def _decode_date(value):
+    if value is None:
+        return None
+    try:
+        return datetime.fromisoformat(value)
+    except ValueError:
+        return value
+
+
+class ConversationStateStore:
+    """SQLite-backed chat histories and per-chat state with lazy restore."""
+
+    def __init__(self, path=STATE_DB_PATH, keep_last=None):
+        """keep_last, if set, bounds how many of each chat's newest messages are kept on disk."""
+        self.path = path
+        self.keep_last = keep_last
+        self._writer = BatchedSQLiteWriter(path, setup=lambda conn: conn.executescript(SCHEMA), name='state-writer')
+        self._reader = connect(path, check_same_thread=False)
+        self._read_lock = threading.Lock()
+        self._seen = set()
+        self._appends_since_trim = {}
+
+    # --- Writes (queued) ---
+    def append_message(self, chat_id, message):
+        self._writer.execute(
+            "INSERT INTO messages (chat_id, date, text, sender_id, sender_type) VALUES (?, ?, ?, ?, ?)",
+            (chat_id, _encode_date(message.get('date')), message.get('text'),
+             message.get('sender_id'), message.get('sender_type'))
+        )
+        if self.keep_last is not None:
+            count = self._appends_since_trim.get(chat_id, 0) + 1
+            if count >= TRIM_EVERY:
+                self._trim(chat_id)
+                count = 0
+            self._appends_since_trim[chat_id] = count
+
+    def _trim(self, chat_id):
+        self._writer.execute(
+            "DELETE FROM messages WHERE chat_id = ? AND id <= "
+            "(SELECT id FROM messages WHERE chat_id = ? ORDER BY id DESC LIMIT 1 OFFSET ?)",
+            (chat_id, chat_id, self.keep_last)
+        )
+
+    def set_state(self, chat_id, key, value):
+        """Checkpoints one JSON-serializable value for a chat."""
+        self._writer.execute(
+            "INSERT INTO chat_state (chat_id, key, value) VALUES (?, ?, ?) "
+            "ON CONFLICT (chat_id, key) DO UPDATE SET value = excluded.value",
+            (chat_id, key, json.dumps(value))
+        )
+
+    def delete_state(self, chat_id, key):
+        self._writer.execute("DELETE FROM chat_state WHERE chat_id = ? AND key = ?", (chat_id, key))
+
+    def clear_chat(self, chat_id):
+        """Forgets a chat's history and state."""
+        self._writer.execute("DELETE FROM messages WHERE chat_id = ?", (chat_id,))
+        self._writer.execute("DELETE FROM chat_state WHERE chat_id = ?", (chat_id,))
+        self._appends_since_trim.pop(chat_id, None)
+
+    # --- Restore ---
+    def is_restored(self, chat_id):
+        """True once restore_chat() has been called for chat_id; a set lookup, safe on the event loop."""
+        return chat_id in self._seen
+
+    def restore_chat(self, chat_id, limit=None):
+        """
+        Returns (messages, state) persisted for a chat the first time this
+        process asks about it, and None on every later call, since from then
+        on the in-memory copy is authoritative. limit keeps only the newest
+        messages.
+        """
+        if chat_id in self._seen:
+            return None
+        self._seen.add(chat_id)
+        with self._read_lock:
+            if limit is None:
+                rows = self._reader.execute(
+                    "SELECT date, text, sender_id, sender_type FROM messages WHERE chat_id = ? ORDER BY id",
+                    (chat_id,)
+                ).fetchall()
+            else:
+                rows = self._reader.execute(
+                    "SELECT date, text, sender_id, sender_type FROM messages WHERE chat_id = ? ORDER BY id DESC LIMIT ?",
+                    (chat_id, limit)
+                ).fetchall()[::-1]
+            state_rows = self._reader.execute("SELECT key, value FROM chat_state WHERE chat_id = ?", (chat_id,)).fetchall()
+        messages = [{'date': _decode_date(date), 'text': text, 'sender_id': sender_id, 'sender_type': sender_type}
+                    for date, text, sender_id, sender_type in rows]
+        return messages, {key: json.loads(value) for key, value in state_rows}
+
+    def flush(self):
+        self._writer.flush()
+
+    def close(self):
+        self._writer.close()
+        with self._read_lock:
+            self._reader.close()
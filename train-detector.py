@@ -13,9 +13,10 @@ from sklearn.feature_selection import SelectKBest, f_classif
 import matplotlib.pyplot as plt
 import seaborn as sns
 from sklearn.metrics import classification_report, confusion_matrix, ConfusionMatrixDisplay
+from lean_predictor import export_lean_predictor, lean_path_for
+from training_store import open_training_store, TRAINING_STORE_DIR
 
 # --- Configuration ---
-TRAINING_CSV = 'training_data.csv'
 MODEL_OUTPUT_PATH = 'honeytrap_detector.joblib'
 
 # --- VIZ: Function to plot the training (logloss) curve ---
@@ -53,9 +54,10 @@ def plot_confusion_matrix(y_true, y_pred, class_names):
         print(f"Could not plot confusion matrix: {e}")
 
 def main():
-    print(f"--- Loading Data from '{TRAINING_CSV}' ---")
+    # Same table as run_retraining.py; picks up a training_data.csv rebuilt by create_dataset.py.
+    print(f"--- Loading Data from '{TRAINING_STORE_DIR}' ---")
     try:
-        df = pd.read_csv(TRAINING_CSV)
+        df = open_training_store().read()
         if 'label' not in df.columns or len(df.index) < 50:
             print("Error: Not enough data for a 3-way split. Need at least 50 rows.")
             return
@@ -154,6 +156,14 @@ def main():
         joblib.dump(final_pipeline_to_save, MODEL_OUTPUT_PATH)
         print(f"\n✅ New OPTIMIZED pipeline saved to '{MODEL_OUTPUT_PATH}'!")
 
+        # --- Export the compiled NumPy predictor used by the live detector ---
+        lean_path = lean_path_for(MODEL_OUTPUT_PATH)
+        try:
+            export_lean_predictor(final_pipeline_to_save, X, lean_path)
+            print(f"✅ Lean predictor saved to '{lean_path}'")
+        except ValueError as e:
+            print(f"⚠️ Lean predictor not exported: {e}")
+
     except Exception as e:
         print(f"An error occurred during model training: {e}")
 
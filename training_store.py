@@ -0,0 +1,244 @@
+# training_store.py
+"""
+Append-only columnar storage for the master training table.
+
+Rows live in immutable Parquet partitions under one directory. New rows are
+written as a new partition, and duplicates are dropped against a persisted,
+sorted index of row hashes rather than by scanning the whole table. A small
+manifest records the schema and which partitions the hash index covers, so a
+partition written just before a crash is picked up again on the next open.
+
+The training CSV that create_dataset.py writes is imported whenever it
+changes. The manifest remembers which partitions each import produced, and a
+rebuilt CSV replaces them, so rows of chats or features the rebuild dropped
+do not linger next to the new ones.
+"""
+import os
+import json
+import logging
+import numpy as np
+import pandas as pd
+
+# --- Configuration ---
+TRAINING_STORE_DIR = 'training_data/'
+TRAINING_CSV = 'training_data.csv'     # Written by create_dataset.py; imported whenever it changes
+MANIFEST_FILE = '_manifest.json'
+HASH_INDEX_FILE = '_row_hashes.npy'
+LABEL_COLUMN = 'label'
+FIRST_PARTITION = 'part-000000.parquet'
+
+
+def _atomic_write(path, write):
+    tmp_path = f"{path}.tmp"
+    write(tmp_path)
+    os.replace(tmp_path, path)
+
+
+class TrainingStore:
+    """Partitioned Parquet training table with hash-based deduplication."""
+
+    def __init__(self, root=TRAINING_STORE_DIR):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+        self._manifest_path = os.path.join(root, MANIFEST_FILE)
+        self._index_path = os.path.join(root, HASH_INDEX_FILE)
+        self.manifest = self._load_manifest()
+        self._hashes = self._load_hashes()
+        self._recover_unindexed_partitions()
+
+    # --- Persistence ---
+    def _load_manifest(self):
+        if os.path.exists(self._manifest_path):
+            with open(self._manifest_path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        return {'columns': None, 'partitions': {}}
+
+    def _save_manifest(self):
+        def write(path):
+            with open(path, 'w', encoding='utf-8') as f:
+                json.dump(self.manifest, f, indent=2)
+        _atomic_write(self._manifest_path, write)
+
+    def _load_hashes(self):
+        if os.path.exists(self._index_path):
+            return np.load(self._index_path, mmap_mode='r')
+        return np.empty(0, dtype=np.uint64)
+
+    def _save_hashes(self, hashes):
+        def write(path):
+            with open(path, 'wb') as f:
+                np.save(f, hashes)
+        _atomic_write(self._index_path, write)
+        self._hashes = self._load_hashes()
+
+    def _partition_files(self):
+        return sorted(f for f in os.listdir(self.root) if f.startswith('part-') and f.endswith('.parquet'))
+
+    def _next_partition(self):
+        names = set(self.manifest['partitions']) | set(self._partition_files())
+        return f"part-{max((int(name[5:11]) for name in names), default=-1) + 1:06d}.parquet"
+
+    def _recover_unindexed_partitions(self):
+        """Adds partitions that were written but never recorded in the manifest to the hash index."""
+        if self.manifest.get('removing'):
+            self._finish_removal()
+        missing = [f for f in self._partition_files() if f not in self.manifest['partitions']]
+        if not missing:
+            return
+        logging.warning(f"Re-indexing {len(missing)} training partition(s) missing from the manifest.")
+        hashes = [np.asarray(self._hashes)]
+        for filename in missing:
+            df = pd.read_parquet(os.path.join(self.root, filename))
+            if self.manifest['columns'] is None:
+                self.manifest['columns'] = list(df.columns)
+            hashes.append(self._row_hashes(df))
+            self.manifest['partitions'][filename] = len(df)
+        self._save_hashes(np.unique(np.concatenate(hashes)))
+        self._save_manifest()
+
+    # --- Rows ---
+    @property
+    def columns(self):
+        return self.manifest['columns']
+
+    def __len__(self):
+        return sum(self.manifest['partitions'].values())
+
+    def _canonical(self, df):
+        """Orders columns by the schema and casts features to float64 and the label to int64."""
+        if self.columns is None:
+            columns = [c for c in df.columns if c != LABEL_COLUMN] + ([LABEL_COLUMN] if LABEL_COLUMN in df.columns else [])
+        else:
+            unknown = set(df.columns) - set(self.columns)
+            if unknown:
+                raise ValueError(f"Columns not in the training store schema: {sorted(unknown)}")
+            columns = self.columns
+        df = df.reindex(columns=columns).fillna(0)
+        dtypes = {c: ('int64' if c == LABEL_COLUMN else 'float64') for c in columns}
+        return df.astype(dtypes).reset_index(drop=True)
+
+    @staticmethod
+    def _row_hashes(df):
+        return pd.util.hash_pandas_object(df, index=False).to_numpy(dtype=np.uint64)
+
+    def append(self, df):
+        """
+        Appends the rows of df that are not already stored as a new partition.
+        Returns the number of rows written.
+        """
+        if df.empty:
+            return 0
+        df = self._canonical(df)
+        hashes = self._row_hashes(df)
+
+        # Drop rows already stored, then duplicates within the batch itself.
+        positions = np.searchsorted(self._hashes, hashes)
+        positions = np.minimum(positions, max(len(self._hashes) - 1, 0))
+        stored = (self._hashes[positions] == hashes) if len(self._hashes) else np.zeros(len(hashes), dtype=bool)
+        _, first_seen = np.unique(hashes, return_index=True)
+        keep = np.zeros(len(hashes), dtype=bool)
+        keep[first_seen] = True
+        keep &= ~stored
+        if not keep.any():
+            return 0
+        df = df[keep].reset_index(drop=True)
+
+        filename = self._next_partition()
+        _atomic_write(os.path.join(self.root, filename), lambda path: df.to_parquet(path, index=False))
+        self._save_hashes(np.union1d(np.asarray(self._hashes), hashes[keep]))
+        if self.columns is None:
+            self.manifest['columns'] = list(df.columns)
+        self.manifest['partitions'][filename] = len(df)
+        self._save_manifest()
+        return len(df)
+
+    def read(self, columns=None):
+        """Reads the table, or only the given columns, memory-mapping the partition files."""
+        files = [os.path.join(self.root, f) for f in sorted(self.manifest['partitions'])]
+        if not files:
+            return pd.DataFrame(columns=columns or self.columns or [])
+        frames = [pd.read_parquet(path, columns=columns, memory_map=True) for path in files]
+        return pd.concat(frames, ignore_index=True)
+
+    def remove_partitions(self, filenames):
+        """Drops whole partitions and their row hashes from the table."""
+        filenames = [f for f in filenames if f in self.manifest['partitions']]
+        if not filenames:
+            return
+        for filename in filenames:
+            del self.manifest['partitions'][filename]
+        if not self.manifest['partitions']:
+            self.manifest['columns'] = None
+        # Recorded first, so a removal interrupted by a crash is finished on the next open.
+        self.manifest['removing'] = filenames
+        self._save_manifest()
+        self._finish_removal()
+
+    def _finish_removal(self):
+        """Drops the row hashes of the partitions being removed, then their files."""
+        filenames = [f for f in self.manifest['removing'] if os.path.exists(os.path.join(self.root, f))]
+        if filenames:
+            removed = [self._row_hashes(pd.read_parquet(os.path.join(self.root, f))) for f in filenames]
+            # Every stored row hash belongs to exactly one partition, so the rest of the index is unaffected.
+            self._save_hashes(np.setdiff1d(np.asarray(self._hashes), np.concatenate(removed)))
+            for filename in filenames:
+                os.remove(os.path.join(self.root, filename))
+        del self.manifest['removing']
+        self._save_manifest()
+
+    # --- CSV Imports ---
+    def _imported(self, csv_path):
+        """The manifest's record of csv_path's last import: {'modified': mtime, 'partitions': [...]}."""
+        imports = self.manifest.get('imported_csvs')
+        if imports is None:
+            # Stores migrated before imports were recorded got the CSV, once, as their first partition.
+            partitions = [FIRST_PARTITION] if FIRST_PARTITION in self.manifest['partitions'] else []
+            return {'modified': None, 'partitions': partitions}
+        record = imports.get(os.path.abspath(csv_path))
+        return record if isinstance(record, dict) else {'modified': None, 'partitions': []}
+
+    def import_csv(self, csv_path):
+        """
+        Imports a training CSV, replacing the partitions an earlier version of
+        the same file produced. Rows already stored by other appends are skipped.
+        Returns the number of rows written.
+        """
+        modified = os.path.getmtime(csv_path)
+        df = pd.read_csv(csv_path)
+        replaced = self._imported(csv_path)['partitions']
+        if self.columns is not None and set(self.manifest['partitions']) - set(replaced):
+            # Other rows stay, so the CSV must fit their schema; check before removing anything.
+            self._canonical(df.head(0))
+        self.remove_partitions(replaced)
+        before = set(self.manifest['partitions'])
+        added = self.append(df)
+        self.manifest.setdefault('imported_csvs', {})[os.path.abspath(csv_path)] = {
+            'modified': modified,
+            'partitions': sorted(set(self.manifest['partitions']) - before),
+        }
+        self._save_manifest()
+        logging.info(f"Imported {added} rows from '{csv_path}' into the training store, "
+                     f"replacing {len(replaced)} partition(s) from its previous import.")
+        return added
+
+    def csv_changed(self, csv_path):
+        """True if csv_path exists and was modified since it was last imported."""
+        if not os.path.exists(csv_path):
+            return False
+        return self._imported(csv_path)['modified'] != os.path.getmtime(csv_path)
+
+
+def open_training_store(root=TRAINING_STORE_DIR, csv_path=TRAINING_CSV):
+    """
+    Opens the training store, first importing csv_path if create_dataset.py
+    rebuilt it since the last import, so both trainers see the rebuilt rows.
+    """
+    store = TrainingStore(root)
+    if csv_path and store.csv_changed(csv_path):
+        print(f"Importing '{csv_path}' into '{root}'...")
+        try:
+            store.import_csv(csv_path)
+        except ValueError as e:
+            # The dataset gained feature columns that rows from retraining lack.
+            print(f"⚠️ '{csv_path}' not imported: {e}. Move '{root}' aside to rebuild the store from it.")
+    return store